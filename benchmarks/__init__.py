@@ -0,0 +1,12 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmarks
+    ~~~~~~~~~~
+
+    Benchmarks for the visuals extension, run against generated (synthetic) Sphinx projects.
+
+    Run them with ``python -m benchmarks --help`` (or ``tox -e bench``).
+
+    :copyright: Copyright 2015 by the contributors, see AUTHORS.
+    :license: BSD, see LICENSE for details.
+"""
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmarks.__main__
+    ~~~~~~~~~~~~~~~~~~~
+
+    Command line runner: python -m benchmarks --docs 100 --visuals 20
+
+    Each scenario generates a project (see benchmarks.corpus), builds it with the
+    placeholder and dummy backends, and reports the time the extension spent per phase
+    (see benchmarks.phases) next to the total build time.
+
+    :copyright: Copyright 2015 by the contributors, see AUTHORS.
+    :license: BSD, see LICENSE for details.
+"""
+
+import argparse
+import io
+import json
+import shutil
+import sys
+import tempfile
+import time
+from os import path
+
+from benchmarks.corpus import CorpusShape, generate_project, touch_docs
+from benchmarks.phases import PHASES, PhaseTimer
+
+
+def build(srcdir, builddir, builder, parallel, freshenv):
+    """
+    Run one Sphinx build of srcdir, timing the extension's phases.
+
+    :return dict: {'total': seconds, 'phases': PhaseTimer.results(), 'warnings': int}
+    """
+    from sphinx.application import Sphinx
+
+    warnings = io.StringIO()
+    with PhaseTimer() as timer:
+        start = time.perf_counter()
+        app = Sphinx(srcdir, srcdir, path.join(builddir, builder), path.join(builddir, 'doctrees'), builder,
+                     status=None, warning=warnings, freshenv=freshenv, parallel=parallel)
+        app.build()
+        total = time.perf_counter() - start
+    return {
+        'total': total,
+        'phases': timer.results(),
+        'warnings': len([line for line in warnings.getvalue().splitlines() if line.strip()]),
+    }
+
+
+def run_scenarios(shape, builder='html', parallel=1, changed_ratio=0.1, keep=None):
+    """
+    Scenarios:
+        full:        a fresh build of the generated project
+        noop:        a rebuild with nothing changed
+        incremental: a rebuild after changing changed_ratio of the docs
+
+    :param CorpusShape shape:
+    :param str builder: Sphinx builder name
+    :param int parallel: Sphinx -j
+    :param float changed_ratio: share of docs changed for the incremental scenario
+    :param str keep: keep the generated project in this directory (else a temp dir is removed)
+    :return dict: {scenario: build() results}
+    """
+    directory = keep or tempfile.mkdtemp(prefix='visuals-bench-')
+    srcdir = path.join(directory, 'src')
+    builddir = path.join(directory, '_build')
+    try:
+        docnames = generate_project(srcdir, shape)
+        results = {'full': build(srcdir, builddir, builder, parallel, freshenv=True),
+                   'noop': build(srcdir, builddir, builder, parallel, freshenv=False)}
+        touch_docs(srcdir, docnames[:max(1, int(len(docnames) * changed_ratio))])
+        results['incremental'] = build(srcdir, builddir, builder, parallel, freshenv=False)
+        return results
+    finally:
+        if keep is None:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+def format_results(results):
+    lines = []
+    header = '{0:<26}'.format('phase') + ''.join('{0:>14}'.format(scenario) for scenario in results)
+    lines.append(header)
+    lines.append('-' * len(header))
+    for phase, functions in PHASES:
+        lines.append('{0:<26}'.format(phase) + ''.join(
+            '{0:>14.4f}'.format(result['phases'][phase]['seconds']) for result in results.values()))
+    lines.append('-' * len(header))
+    lines.append('{0:<26}'.format('total build (incl. sphinx)') + ''.join(
+        '{0:>14.4f}'.format(result['total']) for result in results.values()))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description=__doc__.split('\n\n')[1].strip())
+    parser.add_argument('--docs', type=int, default=20, help='number of documents')
+    parser.add_argument('--visuals', type=int, default=10, help='visual directives per document')
+    parser.add_argument('--refs', type=float, default=0.3, help='share of visuals that are references')
+    parser.add_argument('--cross-doc', type=float, default=0.5, help='share of references to other docs')
+    parser.add_argument('--legends', type=float, default=0.3, help='share of visuals with a legend')
+    parser.add_argument('--captions', type=float, default=0.5, help='share of visuals with a caption')
+    parser.add_argument('--content-lines', type=int, default=5, help='content lines per definition')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--builder', default='html')
+    parser.add_argument('-j', '--parallel', type=int, default=1)
+    parser.add_argument('--changed', type=float, default=0.1, help='share of docs changed for incremental')
+    parser.add_argument('--keep', help='generate the project here and keep it')
+    parser.add_argument('--json', help='also write the results as JSON to this file')
+    args = parser.parse_args(argv)
+
+    shape = CorpusShape(docs=args.docs, visuals_per_doc=args.visuals, ref_ratio=args.refs,
+                        cross_doc_ratio=args.cross_doc, legend_ratio=args.legends,
+                        caption_ratio=args.captions, content_lines=args.content_lines, seed=args.seed)
+    results = run_scenarios(shape, builder=args.builder, parallel=args.parallel, changed_ratio=args.changed,
+                            keep=args.keep)
+    print(format_results(results))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'shape': shape.as_dict(), 'builder': args.builder, 'parallel': args.parallel,
+                       'results': results}, f, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmarks.corpus
+    ~~~~~~~~~~~~~~~~~
+
+    Generates synthetic Sphinx projects full of visual directives.
+
+    :copyright: Copyright 2015 by the contributors, see AUTHORS.
+    :license: BSD, see LICENSE for details.
+"""
+
+import os
+import random
+from os import path
+
+conf_template = '''\
+# Generated by benchmarks.corpus
+import sys
+sys.path.insert(0, {package_root!r})
+
+extensions = ['visuals.sphinx_ext']
+master_doc = 'index'
+exclude_patterns = ['_build']
+visuals_asset_backends = {{
+    'visuals': {{}},
+    'placeholder': {{}},
+    'dummy': {{'enabled': True}},
+}}
+# Keep runs independent and free of waiting: no shared cache, no polling delays.
+visuals_cache_max_bytes = 0
+visuals_availability_polling = {{'attempts': 1}}
+'''
+
+
+class CorpusShape(object):
+    """
+    The shape of a generated project.
+
+    docs documents, each with visuals_per_doc visual directives. Of those visuals:
+      - ref_ratio are references (no content); the rest are definitions
+      - cross_doc_ratio of the references point at a definition in another doc
+        (the others point at a definition in the same doc, if it has one)
+      - legend_ratio have a legend, caption_ratio have a caption
+    content_lines is the number of content lines in each definition.
+    """
+
+    def __init__(self, docs=10, visuals_per_doc=10, ref_ratio=0.3, cross_doc_ratio=0.5,
+                 legend_ratio=0.3, caption_ratio=0.5, content_lines=5, seed=0):
+        self.docs = docs
+        self.visuals_per_doc = visuals_per_doc
+        self.ref_ratio = ref_ratio
+        self.cross_doc_ratio = cross_doc_ratio
+        self.legend_ratio = legend_ratio
+        self.caption_ratio = caption_ratio
+        self.content_lines = content_lines
+        self.seed = seed
+
+    def as_dict(self):
+        return dict(vars(self))
+
+
+def docname_for(number):
+    return 'doc{0:05d}'.format(number)
+
+
+def visual_id_for(doc_number, visual_number):
+    return 'visual {0}-{1}'.format(doc_number, visual_number)
+
+
+def generate_visual(lines, visual_id, is_ref, has_caption, has_legend, content_lines):
+    lines.append('.. visual:: {0}'.format(visual_id))
+    if has_caption:
+        lines.append('   :caption: The *caption* of {0}'.format(visual_id))
+    if has_legend or not is_ref:
+        lines.append('')
+    if has_legend:
+        lines.extend([
+            '   .. legend::',
+            '',
+            '      The legend of {0}'.format(visual_id),
+            '',
+        ])
+    if not is_ref:
+        for line in range(content_lines):
+            lines.append('   Content line {0} of {1}'.format(line, visual_id))
+    lines.append('')
+
+
+def generate_doc(shape, doc_number, rng):
+    """
+    :return str: the rst source of one doc
+    """
+    title = 'Document {0}'.format(doc_number)
+    lines = [title, '=' * len(title), '']
+    definitions = []
+    for visual_number in range(shape.visuals_per_doc):
+        is_ref = rng.random() < shape.ref_ratio
+        has_legend = rng.random() < shape.legend_ratio
+        if not is_ref:
+            visual_id = visual_id_for(doc_number, visual_number)
+            definitions.append(visual_id)
+        elif shape.docs > 1 and (not definitions or rng.random() < shape.cross_doc_ratio):
+            other_doc = rng.choice([number for number in (doc_number - 1, doc_number + 1)
+                                    if 0 <= number < shape.docs])
+            visual_id = visual_id_for(other_doc, 0)
+        elif definitions:
+            visual_id = rng.choice(definitions)
+        else:
+            visual_id = visual_id_for(doc_number, visual_number)
+        lines.append('Paragraph {0} before a visual.'.format(visual_number))
+        lines.append('')
+        generate_visual(lines, visual_id, is_ref, rng.random() < shape.caption_ratio, has_legend,
+                        shape.content_lines)
+    return '\n'.join(lines) + '\n'
+
+
+def generate_project(directory, shape):
+    """
+    Write conf.py, index.rst, and shape.docs documents to directory.
+
+    Cross-doc references point at the first visual of a neighbouring doc, which may itself
+    be a reference (a reference without a definition is a normal case for the extension).
+
+    :param str directory: Where to write the project (created if needed)
+    :param CorpusShape shape:
+    :return list: the docnames
+    """
+    rng = random.Random(shape.seed)
+    if not path.isdir(directory):
+        os.makedirs(directory)
+    package_root = path.dirname(path.dirname(path.abspath(__file__)))
+    with open(path.join(directory, 'conf.py'), 'w') as f:
+        f.write(conf_template.format(package_root=package_root))
+
+    docnames = [docname_for(number) for number in range(shape.docs)]
+    with open(path.join(directory, 'index.rst'), 'w') as f:
+        f.write('Benchmark\n=========\n\n.. toctree::\n   :maxdepth: 1\n\n')
+        for docname in docnames:
+            f.write('   {0}\n'.format(docname))
+
+    for number, docname in enumerate(docnames):
+        with open(path.join(directory, docname + '.rst'), 'w') as f:
+            f.write(generate_doc(shape, number, rng))
+    return docnames
+
+
+def touch_docs(directory, docnames):
+    """
+    Change docnames (append a paragraph), for incremental build benchmarks.
+    """
+    for docname in docnames:
+        with open(path.join(directory, docname + '.rst'), 'a') as f:
+            f.write('\nAnother paragraph.\n')
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmarks.phases
+    ~~~~~~~~~~~~~~~~~
+
+    Times the visuals extension's own work, per build phase.
+
+    :copyright: Copyright 2015 by the contributors, see AUTHORS.
+    :license: BSD, see LICENSE for details.
+"""
+
+import functools
+import time
+
+import visuals.sphinx_ext as sphinx_ext
+from visuals.rst.directives import Visual
+
+PHASES = (
+    ('builder-inited', ('event_builder_inited', 'monkey_patch_builder_finish')),
+    ('read', ('Visual.run', 'event_env_get_outdated', 'event_env_purge_doc', 'event_doctree_read',
+              'event_env_merge_info')),
+    ('env-updated', ('event_env_updated',)),
+    ('doctree-extra-processing', ('event_doctree_extra_processing',)),
+    ('doctree-resolved', ('event_doctree_resolved',)),
+    ('write', ('visit_visual', 'depart_visual')),
+    ('build-finished', ('event_build_finished',)),
+)
+"""(phase, functions timed for that phase). doctree-extra-processing is also included in env-updated."""
+
+
+class PhaseTimer(object):
+    """
+    Wraps the extension's event handlers (and Visual.run and the node visitors) with timers.
+
+    Use it as a context manager around creating and running the Sphinx application:
+    visuals.sphinx_ext.setup() connects whatever the module attributes are when it runs,
+    so the wrappers must be installed before Sphinx loads the extension.
+
+    Only time spent in this process is recorded (parallel read/write workers are not).
+    """
+
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self.seconds = dict((phase, 0.0) for phase, functions in PHASES)
+        self.calls = dict((phase, 0) for phase, functions in PHASES)
+        self._originals = []
+
+    def _wrap(self, phase, function):
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            start = self.clock()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.seconds[phase] += self.clock() - start
+                self.calls[phase] += 1
+        return timed
+
+    def __enter__(self):
+        for phase, functions in PHASES:
+            for name in functions:
+                owner, attribute = (Visual, name.split('.', 1)[1]) if name.startswith('Visual.') \
+                    else (sphinx_ext, name)
+                original = getattr(owner, attribute)
+                self._originals.append((owner, attribute, original))
+                setattr(owner, attribute, self._wrap(phase, original))
+        return self
+
+    def __exit__(self, *exc_info):
+        for owner, attribute, original in reversed(self._originals):
+            setattr(owner, attribute, original)
+        self._originals = []
+
+    def results(self):
+        """
+        :return dict: {phase: {'seconds': float, 'calls': int}}
+        """
+        return dict((phase, {'seconds': self.seconds[phase], 'calls': self.calls[phase]})
+                    for phase, functions in PHASES)
@@ -35,9 +35,13 @@ setup(
         'Topic :: Utilities',
     ],
     platforms='any',
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks']),
     include_package_data=True,
     install_requires=requires,
+    extras_require={
+        # visuals_state_store = 'table' (see visuals.asset.statetable)
+        'table': ['numpy'],
+    },
     namespace_packages=['visuals'],
     requires=['docutils', 'sphinx']
 )
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""
+    conftest
+    ~~~~~~~~
+
+    Fixtures for the visuals tests.
+
+    :copyright: Copyright 2015 by the contributors, see AUTHORS.
+    :license: BSD, see LICENSE for details.
+"""
+
+import io
+import os
+import textwrap
+from os import path
+
+import pytest
+
+conf_py = '''\
+extensions = ['visuals.sphinx_ext']
+master_doc = 'index'
+# No dummy backend: it makes assets available at random.
+visuals_asset_backends = {'placeholder': {}}
+visuals_cache_max_bytes = 0
+visuals_availability_polling = {'attempts': 1}
+'''
+
+
+class Project(object):
+    """
+    A throwaway Sphinx project in a temp dir.
+
+    project.write('doc', rst) adds docs, project.build() runs sphinx-build and returns the app.
+    """
+
+    def __init__(self, directory):
+        self.srcdir = str(directory / 'src')
+        self.builddir = str(directory / '_build')
+        self.write('conf', conf_py, suffix='.py')
+
+    def write(self, docname, source, suffix='.rst'):
+        filename = path.join(self.srcdir, docname + suffix)
+        if not path.isdir(path.dirname(filename)):
+            os.makedirs(path.dirname(filename))
+        with open(filename, 'w') as f:
+            f.write(textwrap.dedent(source))
+
+    def build(self, builder='html', parallel=1, freshenv=False, builddir=None, **confoverrides):
+        """
+        :return sphinx.application.Sphinx: the app, after building
+        """
+        from sphinx.application import Sphinx
+
+        builddir = builddir or self.builddir
+        self.warnings = io.StringIO()
+        app = Sphinx(self.srcdir, self.srcdir, path.join(builddir, builder), path.join(builddir, 'doctrees'),
+                     builder, status=None, warning=self.warnings, freshenv=freshenv, parallel=parallel,
+                     confoverrides=confoverrides)
+        app.build()
+        return app
+
+
+@pytest.fixture
+def project(tmp_path):
+    return Project(tmp_path)
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""
+    standins
+    ~~~~~~~~
+
+    In-process stand-ins for the external services that visuals talks to.
+    They never leave localhost.
+
+    :copyright: Copyright 2015 by the contributors, see AUTHORS.
+    :license: BSD, see LICENSE for details.
+"""
+
+import json
+import threading
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+
+class StandInServer(object):
+    """
+    Base class for a JSON web service that runs in a background thread on localhost.
+
+    Usage:
+        with SomeStandInServer() as server:
+            do_something_with(server.uri)
+
+    Subclasses implement handle(method, path, body, headers) -> (status, headers, body).
+    A bytes body is sent as it is (eg to send something that is not JSON), and a status of None
+    closes the connection without any response.
+    """
+
+    def __init__(self):
+        self.connections = 0
+        """Number of TCP connections accepted (to check that clients reuse connections)"""
+        self.requests = 0
+        """Number of HTTP requests handled"""
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def uri(self):
+        host, port = self._server.server_address[:2]
+        return 'http://{0}:{1}'.format(host, port)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def handle(self, method, path, body, headers):
+        """
+        :param str method: HTTP method
+        :param str path: request path
+        :param body: decoded JSON request body (or None)
+        :param headers: request headers
+        :return tuple: (status, {header: value}, JSON-serializable body, bytes, or None)
+        """
+        raise NotImplementedError('must be implemented in subclasses')
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # keep-alive
+
+            def setup(self):
+                super().setup()
+                with server._lock:
+                    server.connections += 1
+
+            def log_message(self, *args):
+                pass
+
+            def _dispatch(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                raw = self.rfile.read(length) if length else b''
+                body = json.loads(raw.decode('utf-8')) if raw else None
+                with server._lock:
+                    server.requests += 1
+                status, headers, response_body = server.handle(self.command, self.path, body, self.headers)
+                if status is None:
+                    self.close_connection = True
+                    return
+                if isinstance(response_body, bytes):
+                    data = response_body
+                else:
+                    data = json.dumps(response_body).encode('utf-8') if response_body is not None else b''
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST = _dispatch
+
+        return Handler
+
+
+class StandInVisualsServer(StandInServer):
+    """
+    A stand-in for the visuals web service (see visuals.client.VisualsClient).
+
+    Every asset that gets requested is immediately 'done' (or generate_status),
+    and status responses are paginated with page_size results per page.
+    """
+
+    def __init__(self, page_size=100, generate_status='done'):
+        super().__init__()
+        self.page_size = page_size
+        self.generate_status = generate_status
+        self.assets = {}
+        """{asset_key: result} for every asset that was requested"""
+
+    def handle(self, method, path, body, headers):
+        if method != 'POST' or body is None:
+            return 405, {}, {'error': 'method not allowed'}
+        if path.endswith('/assets/generate'):
+            keys = []
+            with self._lock:
+                for payload in body['assets']:
+                    key = payload['key']
+                    self.assets[key] = {
+                        'key': key,
+                        'status': self.generate_status,
+                        'uri': '{0}/assets/{1}'.format(self.uri, payload.get('content_hash') or payload['id']),
+                        'error': None,
+                    }
+                    keys.append(key)
+        elif path.endswith('/assets/status'):
+            keys = body['keys']
+        else:
+            return 404, {}, {'error': 'not found'}
+
+        start = body.get('cursor') or 0
+        page = keys[start:start + self.page_size]
+        next_cursor = start + self.page_size if start + self.page_size < len(keys) else None
+        results = [self.assets.get(key, {'key': key, 'status': 'new', 'uri': None, 'error': None})
+                   for key in page]
+        return 200, {}, {'assets': results, 'next': next_cursor}
+
+
+class StandInOEmbedProvider(StandInServer):
+    """
+    A stand-in oEmbed provider (see visuals.asset.oembed.OEmbedResolver).
+
+    GET /oembed?url=<uri>&format=json returns a 'rich' payload whose html embeds uri.
+    Responses carry an ETag and Cache-Control max-age=max_age, and a matching
+    If-None-Match gets a 304. lookups counts the requests per uri.
+    """
+
+    def __init__(self, max_age=3600, version=1):
+        super().__init__()
+        self.max_age = max_age
+        self.version = version
+        """Bump this to change every payload (and ETag)"""
+        self.lookups = {}
+        """{uri: number of requests for uri}"""
+        self.not_modified = 0
+        """Number of 304 responses"""
+
+    def handle(self, method, path, body, headers):
+        parsed = urlsplit(path)
+        uri = parse_qs(parsed.query).get('url', [None])[0]
+        if method != 'GET' or not parsed.path.endswith('/oembed'):
+            return 404, {}, {'error': 'not found'}
+        if uri is None:
+            return 400, {}, {'error': 'url is required'}
+        with self._lock:
+            self.lookups[uri] = self.lookups.get(uri, 0) + 1
+
+        etag = '"{0}-{1}"'.format(zlib.crc32(uri.encode('utf-8')), self.version)
+        response_headers = {'ETag': etag, 'Cache-Control': 'max-age={0}'.format(self.max_age)}
+        if headers.get('If-None-Match') == etag:
+            with self._lock:
+                self.not_modified += 1
+            return 304, response_headers, None
+        return 200, response_headers, {
+            'version': '1.0',
+            'type': 'rich',
+            'title': 'version {0}'.format(self.version),
+            'html': '<iframe src="{0}"></iframe>'.format(uri),
+            'width': 640,
+            'height': 360,
+        }
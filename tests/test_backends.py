@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+    test_backends
+    ~~~~~~~~~~~~~
+
+    Tests for the asset backend interface and how the AssetsStateMachine dispatches to backends.
+
+    :copyright: Copyright 2015 by the contributors, see AUTHORS.
+    :license: BSD, see LICENSE for details.
+"""
+
+import asyncio
+
+from visuals.asset import AssetLocation
+from visuals.asset.backends import AssetBackend
+from visuals.asset.statemachine import AssetsStateMachine, AssetState
+from visuals.asset.visual_asset_bridge import VisualAsset
+
+
+def test_apply_config_does_not_modify_the_config():
+    class ConfiguredBackend(AssetBackend):
+        name = 'configured'
+
+    config = {'enabled': True, 'priority': 7, 'concurrency': 3, 'batch_size': 50, 'use_oembed': True, 'x': 1}
+    original = dict(config)
+    assert ConfiguredBackend.is_enabled(config)
+    # Sphinx compares the config with the pickled one: a modified config means re-reading every doc.
+    assert config == original
+    assert (ConfiguredBackend.priority, ConfiguredBackend.concurrency, ConfiguredBackend.batch_size) == (7, 3, 50)
+    assert ConfiguredBackend.use_oembed
+    assert ConfiguredBackend.config['x'] == 1
+    assert 'x' not in AssetBackend.config
+
+
+class SlowChecks(object):
+    """Records how many backends are checking availability at the same time."""
+    running = []
+    most_running = []
+
+    async def check_availability_async(self, assets):
+        self.running.append(self.name)
+        self.most_running.append(len(self.running))
+        await asyncio.sleep(0.05)
+        self.running.remove(self.name)
+
+
+# The state machine only finds direct subclasses of AssetBackend
+class FirstSlowBackend(SlowChecks, AssetBackend):
+    name = 'first'
+    priority = 10
+
+
+class SecondSlowBackend(SlowChecks, AssetBackend):
+    name = 'second'
+    priority = 20
+
+
+class Asset(object):
+
+    def __init__(self, asset_id, instance):
+        self.id = asset_id
+        self.location = AssetLocation('index', instance)
+        self.type = 'photo'
+        self.backend = None
+        self.state = AssetState()
+
+
+def test_backends_run_concurrently(monkeypatch):
+    monkeypatch.setattr(AssetsStateMachine, 'backends_config', {
+        'first': {'enabled': True, 'ids': ['first *']},
+        'second': {'enabled': True, 'ids': ['second *']},
+    })
+    statemachine = AssetsStateMachine()
+    assert [backend.name for backend in statemachine.backends] == ['first', 'second', 'placeholder']
+    del SlowChecks.most_running[:]
+
+    statemachine.ensure_available([Asset('first asset', 0), Asset('second asset', 1)])
+    assert max(SlowChecks.most_running) == 2
+
+
+def test_shipped_backends_are_found(monkeypatch):
+    from visuals.asset.backends.visuals import VisualsBackend
+
+    # is_enabled applies the config to the class
+    monkeypatch.setattr(VisualsBackend, 'config', VisualsBackend.config)
+    monkeypatch.setattr(AssetsStateMachine, 'backends_config',
+                        {'visuals': {}, 'placeholder': {}, 'dummy': {'enabled': True}})
+    assert [backend.name for backend in AssetsStateMachine().backends] == ['dummy', 'placeholder']
+
+    # The visuals backend needs the uri of the service, and the dummy backend must be enabled.
+    monkeypatch.setattr(AssetsStateMachine, 'backends_config',
+                        {'visuals': {'uri': 'https://visuals.example.com/api'}, 'placeholder': {}})
+    assert [backend.name for backend in AssetsStateMachine().backends] == ['visuals', 'placeholder']
+
+
+class NamedBackend(AssetBackend):
+    name = 'named'
+    priority = 10
+
+    def request_generation(self, assets):
+        self.statemachine.mark_requested(assets)
+
+    def check_availability(self, assets):
+        pass
+
+
+def test_backend_option_never_routes_to_a_placeholder_backend(project):
+    project.write('index', '''
+        Routing
+        =======
+
+        .. visual:: named
+           :backend: named
+
+           content
+
+        .. visual:: placeholder
+           :backend: placeholder
+
+           content
+
+        .. visual:: misspelled
+           :backend: nmaed
+
+           content
+        ''')
+    app = project.build(visuals_asset_backends={'named': {'enabled': True, 'ids': ['named']}})
+
+    routed = dict((asset_id, app.assets_statemachine.router.route(VisualAsset.for_location(asset_id, location)))
+                  for asset_id, location in app.env.assets.iter_instances())
+    assert routed['named'].name == 'named'
+    assert routed['placeholder'] is None and routed['misspelled'] is None
+    warnings = project.warnings.getvalue()
+    assert "backend 'placeholder' provides placeholders" in warnings
+    assert "backend 'nmaed' is not enabled" in warnings
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+    test_cache
+    ~~~~~~~~~~
+
+    Tests for the asset cache: its keys, where it is, and how it is kept within its budget.
+
+    :copyright: Copyright 2015 by the contributors, see AUTHORS.
+    :license: BSD, see LICENSE for details.
+"""
+
+import os
+from os import path
+
+from visuals.asset import AssetLocation
+from visuals.asset.backends import AssetBackend
+from visuals.asset.cache import AssetCache
+
+
+class Asset(object):
+    is_ref = False
+    id = 'an asset'
+    content_hash = 'md5:0123'
+    type = 'photo'
+    options = {'width': '10px'}
+    location = AssetLocation('index', 0)
+
+
+def make_backend(name, uri=None):
+    backend = AssetBackend(None)
+    backend.name = name
+    backend.config = {'uri': uri} if uri else {}
+    return backend
+
+
+def test_key_depends_on_the_backend_and_its_service():
+    keys = set(AssetCache.make_key(Asset(), backend) for backend in [
+        make_backend('dummy'),
+        make_backend('visuals', 'https://visuals.example.com/api'),
+        make_backend('visuals', 'https://staging.visuals.example.com/api'),
+    ])
+    assert len(keys) == 3
+    assert AssetCache.make_key(Asset(), make_backend('dummy')) == AssetCache.make_key(Asset(), make_backend('dummy'))
+
+
+def write(filename, size, mtime):
+    if not path.isdir(path.dirname(filename)):
+        os.makedirs(path.dirname(filename))
+    with open(filename, 'wb') as f:
+        f.write(b'x' * size)
+    os.utime(filename, (mtime, mtime))
+
+
+def test_evict_counts_unfinished_downloads(tmp_path):
+    cache = AssetCache(str(tmp_path), max_bytes=250)
+    write(cache._filename('aa01', '.json'), 50, 100)
+    write(cache._filename('aa01', '.data'), 50, 100)
+    write(cache._filename('bb02', '.data.part'), 100, 200)
+    write(cache._filename('bb02', '.data.part.validator'), 10, 200)
+    write(cache._filename('cc03', '.json'), 50, 300)
+
+    # 260 bytes: the least recently used entry (with its .json and .data) goes.
+    assert cache.evict() == 1
+    assert not path.exists(cache._filename('aa01', '.data'))
+    assert path.exists(cache._filename('bb02', '.data.part'))
+
+    cache.max_bytes = 100
+    assert cache.evict() == 1
+    assert not path.exists(cache._filename('bb02', '.data.part'))
+    assert not path.exists(cache._filename('bb02', '.data.part.validator'))
+    assert path.exists(cache._filename('cc03', '.json'))
+
+
+def test_evict_only_walks_the_cache_when_it_may_be_over_budget(tmp_path, monkeypatch):
+    cache = AssetCache(str(tmp_path), max_bytes=1000)
+    cache.put('aa01', 'https://visuals.example.com/a')
+    assert cache.evict() == 0  # there is no usage yet, so this walks
+
+    walks = []
+    real_walk = os.walk
+
+    def walk(directory):
+        walks.append(directory)
+        return real_walk(directory)
+
+    monkeypatch.setattr(os, 'walk', walk)
+    cache = AssetCache(str(tmp_path), max_bytes=1000)
+    cache.put('bb02', 'https://visuals.example.com/b')
+    assert cache.evict() == 0
+    assert walks == []
+
+    cache.add_usage(2000)  # eg a download
+    cache.evict()
+    assert walks == [str(tmp_path)]
+
+
+def test_cache_is_next_to_the_doctrees_by_default(project):
+    project.write('index', 'Index\n=====\n')
+    app = project.build(visuals_cache_max_bytes=1024 ** 2)
+    cache = app.assets_statemachine.cache
+    assert cache.directory == path.join(app.doctreedir, 'visuals', 'cache')
+    assert path.exists(path.join(cache.directory, 'usage'))
+
+
+def test_downloads_and_oembed_responses_are_not_in_the_cache_dir(project):
+    project.write('index', 'Index\n=====\n')
+    app = project.build(visuals_cache_max_bytes=1024 ** 2, visuals_oembed={'endpoint': 'http://127.0.0.1:9/oembed'})
+    sm = app.assets_statemachine
+    assert sm.oembed.directory == path.join(app.doctreedir, 'visuals', 'oembed')
+    assert not sm.oembed.directory.startswith(sm.cache.directory + os.sep)
+
+    # Without a cache, downloads get their own dir, not the parent of content/ and placeholders/.
+    app = project.build(builder='latex', visuals_cache_max_bytes=0)
+    assert app.assets_statemachine.downloader.store.directory == path.join(app.doctreedir, 'visuals', 'downloads')
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+    test_client
+    ~~~~~~~~~~~
+
+    Tests for the pooled, batching client of the visuals web service.
+
+    :copyright: Copyright 2015 by the contributors, see AUTHORS.
+    :license: BSD, see LICENSE for details.
+"""
+
+import threading
+import time
+from http import client as http_client
+
+import pytest
+
+from standins import StandInVisualsServer
+from visuals.asset import AssetLocation
+from visuals.asset.statemachine import AssetState
+from visuals.client import VisualsClient, VisualsClientError, asset_key
+
+
+class Asset(object):
+
+    def __init__(self, number):
+        self.id = 'asset {0}'.format(number)
+        self.location = AssetLocation('index', number)
+        self.type = 'photo'
+        self.options = {}
+        self.is_ref = False
+        self.content_hash = 'md5:{0:04}'.format(number)
+        self.state = AssetState()
+
+
+def make_assets(count):
+    return [Asset(number) for number in range(count)]
+
+
+def test_paginated_responses_are_collected():
+    assets = make_assets(7)
+    with StandInVisualsServer(page_size=3) as server:
+        client = VisualsClient(server.uri, batch_size=10)
+        requested = client.request(assets)
+        checked = client.check_availability(assets)
+    assert sorted(requested) == sorted(checked) == sorted(asset_key(asset) for asset in assets)
+    assert set(result['status'] for result in checked.values()) == {'done'}
+    assert server.requests == 3 + 3  # three pages for each of the two calls
+
+
+def test_connections_are_kept_alive():
+    assets = make_assets(5)
+    with StandInVisualsServer() as server:
+        client = VisualsClient(server.uri, pool_size=1, batch_size=2)
+        client.request(assets)
+        client.check_availability(assets)
+        client.check_availability(assets)
+        client.close()
+    assert server.requests == 9
+    assert server.connections == 1
+
+
+class BrokenVisualsServer(StandInVisualsServer):
+    """Answers generate requests with response (status, headers, body) after waiting delay seconds."""
+
+    def __init__(self, response=None, delay=0, resets=0):
+        super().__init__()
+        self.response = response
+        self.delay = delay
+        self.resets = resets
+        """Close this many connections without a response first."""
+        self.handled = threading.Event()
+
+    def handle(self, method, path, body, headers):
+        try:
+            if self.resets:
+                self.resets -= 1
+                return None, {}, None
+            time.sleep(self.delay)
+            if self.response is not None:
+                return self.response
+            return super().handle(method, path, body, headers)
+        finally:
+            self.handled.set()
+
+
+@pytest.mark.parametrize('response', [
+    (200, {}, b'<html>Service Unavailable</html>'),
+    (200, {}, b'\xff\xfe'),
+    (200, {}, ['not', 'an', 'object']),
+    (500, {}, {'error': 'boom'}),
+])
+def test_bad_responses_raise_client_errors(response):
+    with BrokenVisualsServer(response) as server:
+        client = VisualsClient(server.uri)
+        with pytest.raises(VisualsClientError):
+            client.request(make_assets(1))
+
+
+def test_timeouts_are_not_retried():
+    with BrokenVisualsServer(delay=0.5) as server:
+        client = VisualsClient(server.uri, timeout=0.1)
+        with pytest.raises(VisualsClientError):
+            client.request(make_assets(1))
+        server.handled.wait(2)
+        # generating is not idempotent: a request that timed out may have been handled
+        assert server.requests == 1
+
+
+def test_reset_connections_are_retried():
+    assets = make_assets(2)
+    with BrokenVisualsServer(resets=1) as server:
+        client = VisualsClient(server.uri)
+        results = client.request(assets)
+    assert sorted(results) == sorted(asset_key(asset) for asset in assets)
+    assert server.requests == 2
+
+
+def test_broken_pipes_are_retried():
+    assets = make_assets(2)
+    broken = []
+
+    class StaleConnection(http_client.HTTPConnection):
+        def request(self, *args, **kwargs):
+            if not broken:
+                broken.append(self)
+                raise BrokenPipeError(32, 'Broken pipe')
+            return super().request(*args, **kwargs)
+
+    with StandInVisualsServer() as server:
+        client = VisualsClient(server.uri)
+        client.pool.connection_class = StaleConnection
+        results = client.request(assets)
+    assert sorted(results) == sorted(asset_key(asset) for asset in assets)
+    assert server.requests == 1
+
+
+def test_endless_pagination_raises_a_client_error():
+    with BrokenVisualsServer((200, {}, {'assets': [], 'next': 'the same cursor'})) as server:
+        client = VisualsClient(server.uri)
+        with pytest.raises(VisualsClientError):
+            client.check_availability(make_assets(1))
+    assert server.requests == 2
+
+    class NewCursorServer(StandInVisualsServer):
+        def handle(self, method, path, body, headers):
+            return 200, {}, {'assets': [], 'next': (body['cursor'] or 0) + 1}
+
+    with NewCursorServer() as server:
+        client = VisualsClient(server.uri)
+        client.max_pages = 5
+        with pytest.raises(VisualsClientError):
+            client.check_availability(make_assets(1))
+    assert server.requests == 5
+
+
+def test_backend_only_keeps_the_uri_of_done_assets(monkeypatch):
+    from visuals.asset.backends.visuals import VisualsBackend
+    from visuals.asset.statemachine import AssetsStateMachine
+
+    assets = make_assets(2)
+    with StandInVisualsServer() as server:
+        monkeypatch.setattr(VisualsBackend, 'config', {'uri': server.uri})
+        monkeypatch.setattr(AssetsStateMachine, 'backends_config', {})
+        backend = VisualsBackend(AssetsStateMachine())
+        backend.request_generation(assets)
+        backend.check_availability(assets)
+        assert all(asset.state.available and asset.state.uri for asset in assets)
+
+        # The first asset is being generated again: its old uri must not be used.
+        server.assets[asset_key(assets[0])].update(status='generating', uri=None)
+        backend.check_availability(assets)
+    assert not assets[0].state.available and assets[0].state.uri is None
+    assert assets[1].state.available and assets[1].state.uri
+
+
+def test_backend_records_client_errors(monkeypatch):
+    from visuals.asset.backends.visuals import VisualsBackend
+
+    assets = make_assets(2)
+    with BrokenVisualsServer((200, {}, b'not json')) as server:
+        monkeypatch.setattr(VisualsBackend, 'config', {'uri': server.uri})
+        backend = VisualsBackend(None)
+        backend.request_generation(assets)
+    assert all('not JSON' in asset.state.error for asset in assets)
+    assert not any(asset.state.requested for asset in assets)
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+    test_directives
+    ~~~~~~~~~~~~~~~
+
+    Tests for the visual directive.
+
+    :copyright: Copyright 2015 by the contributors, see AUTHORS.
+    :license: BSD, see LICENSE for details.
+"""
+
+import os
+import time
+
+import pytest
+from docutils import nodes
+from docutils.statemachine import StringList
+from sphinx.errors import ConfigError
+
+from visuals.rst.nodes import visual
+from visuals.utils.rst import list_directives_in_block
+
+
+def test_visual_with_a_legend(project):
+    project.write('index', '''
+        Legends
+        =======
+
+        .. visual:: with a legend
+           :caption: The caption
+
+           .. legend::
+
+              The *legend*
+
+           The content
+           of the visual
+        ''')
+    app = project.build()
+
+    doctree = app.env.get_doctree('index')
+    (visual_node,) = list(doctree.findall(visual))
+    (legend,) = list(visual_node.findall(nodes.legend))
+    assert legend.astext() == 'The legend'
+    assert visual_node['is_figure']
+    # The legend is not part of the visual's content
+    assert app.visuals_content_store.get(visual_node['content_hash']) == ['The content', 'of the visual']
+
+
+def test_visual_content_without_a_legend(project):
+    project.write('index', '''
+        No legend
+        =========
+
+        .. visual:: no legend
+           :caption: do bob
+
+           wonderful world
+
+           .. bogus_directive:: stupid
+        ''')
+    app = project.build()
+
+    doctree = app.env.get_doctree('index')
+    (visual_node,) = list(doctree.findall(visual))
+    assert not list(visual_node.findall(nodes.legend))
+    assert app.visuals_content_store.get(visual_node['content_hash']) == [
+        'wonderful world', '', '.. bogus_directive:: stupid']
+
+
+def test_content_of_edited_definitions_is_removed(project):
+    source = '''
+        Edits
+        =====
+
+        .. visual:: edited
+
+           {0}
+        '''
+    store_files = []
+    for number, body in enumerate(['first body', 'second body', 'third body']):
+        project.write('index', source.format(body))
+        # Make sure Sphinx sees the edit, even within its mtime resolution
+        mtime = time.time() + 10 * number
+        os.utime(os.path.join(project.srcdir, 'index.rst'), (mtime, mtime))
+        app = project.build()
+        store = app.visuals_content_store
+        store_files = [os.path.join(dirpath, filename)
+                       for dirpath, dirnames, filenames in os.walk(store.directory) for filename in filenames]
+
+    (visual_node,) = list(app.env.get_doctree('index').findall(visual))
+    assert store_files == [store.filename(visual_node['content_hash'])]
+    assert store.get(visual_node['content_hash']) == ['third body']
+
+
+def test_list_directives_in_block_keeps_its_signature():
+    block = StringList(['text', '.. legend::', '   the legend', '.. note:: a note'], 'index.rst')
+    block = block[1:]  # a block that starts at line 1 of its source, like a directive's content
+    found = list_directives_in_block(1, block)
+    assert [(offset, lineno, name) for offset, lineno, name, match in found] == [(0, 1, 'legend'), (2, 3, 'note')]
+    assert [name for offset, lineno, name, match in list_directives_in_block(1, block, ['note'], limit=1)] == ['note']
+
+
+@pytest.mark.parametrize('algorithm', ['md55', 'shake_128'])
+def test_unusable_fingerprint_algorithm_is_a_config_error(project, algorithm):
+    project.write('index', '''
+        Index
+        =====
+
+        .. visual:: a definition
+
+           content
+        ''')
+    with pytest.raises(ConfigError, match='visuals_fingerprint_algorithm'):
+        project.build(visuals_fingerprint_algorithm=algorithm)
+    assert project.build(visuals_fingerprint_algorithm='sha256').env.assets
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+    test_download
+    ~~~~~~~~~~~~~
+
+    Tests for downloading available assets, and using the downloads in builders that need local images.
+
+    :copyright: Copyright 2015 by the contributors, see AUTHORS.
+    :license: BSD, see LICENSE for details.
+"""
+
+import io
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from os import path
+
+import pytest
+
+from visuals.asset.backends import AssetBackend
+from visuals.asset.cache import AssetCache
+from visuals.asset.download import AssetDownloader
+from visuals.asset.placeholders import make_png
+
+
+class FileServer(HTTPServer):
+    """Serves files = {path: (etag, bytes)}, with Range and If-Range support, and records the requests."""
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), FileHandler)
+        self.files = {}
+        self.requests = []
+        self.uri = 'http://127.0.0.1:{0}'.format(self.server_port)
+
+
+class FileHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        self.server.requests.append((self.path, self.headers.get('Range'), self.headers.get('If-Range')))
+        etag, data = self.server.files[self.path]
+        start = 0
+        range_header = self.headers.get('Range')
+        if range_header and self.headers.get('If-Range', etag) == etag:
+            start = int(range_header.split('=')[1].rstrip('-'))
+        self.send_response(206 if start else 200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(data) - start))
+        self.end_headers()
+        self.wfile.write(data[start:])
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = FileServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def downloader_for(directory, chunk_size=4):
+    return AssetDownloader(AssetCache(str(directory)), chunk_size=chunk_size)
+
+
+def test_resume_sends_the_rest_of_the_same_file(server, tmp_path):
+    server.files['/a'] = ('"v1"', b'0123456789')
+    filename = str(tmp_path / 'a.data')
+    with open(filename + '.part', 'wb') as part:
+        part.write(b'0123')
+    with open(filename + '.part.validator', 'wb') as validator:
+        validator.write(b'"v1"')
+
+    downloader_for(tmp_path).download(server.uri + '/a', filename)
+
+    assert server.requests == [('/a', 'bytes=4-', '"v1"')]
+    with open(filename, 'rb') as f:
+        assert f.read() == b'0123456789'
+    assert not path.exists(filename + '.part.validator')
+
+
+def test_resume_starts_over_if_the_file_changed(server, tmp_path):
+    server.files['/a'] = ('"v2"', b'abcdefghij')
+    filename = str(tmp_path / 'a.data')
+    with open(filename + '.part', 'wb') as part:
+        part.write(b'0123')
+    with open(filename + '.part.validator', 'wb') as validator:
+        validator.write(b'"v1"')
+
+    downloader_for(tmp_path).download(server.uri + '/a', filename)
+
+    with open(filename, 'rb') as f:
+        assert f.read() == b'abcdefghij'
+
+
+def test_part_without_a_validator_is_not_resumed(server, tmp_path):
+    server.files['/a'] = ('"v1"', b'abcdefghij')
+    filename = str(tmp_path / 'a.data')
+    with open(filename + '.part', 'wb') as part:
+        part.write(b'0123')
+
+    downloader_for(tmp_path).download(server.uri + '/a', filename)
+
+    assert server.requests == [('/a', None, None)]
+    with open(filename, 'rb') as f:
+        assert f.read() == b'abcdefghij'
+
+
+class ServedBackend(AssetBackend):
+    """Has every asset available at uri + '/<asset id>.png'."""
+    name = 'served'
+    priority = 10
+    uri = None
+
+    def request_generation(self, assets):
+        self.statemachine.mark_requested(assets)
+
+    def check_availability(self, assets):
+        for asset in assets:
+            asset.state.uri = '{0}/{1}.png'.format(self.uri, asset.id)
+        self.statemachine.mark_available(assets)
+
+
+def test_latex_uses_the_downloaded_images(server, project):
+    server.files['/drawing.png'] = ('"v1"', make_png(20, 10))
+    ServedBackend.uri = server.uri
+    project.write('index', '''
+        Downloads
+        =========
+
+        .. visual:: drawing
+
+           the drawing
+        ''')
+    app = project.build(builder='latex', visuals_asset_backends={'served': {'enabled': True}})
+
+    with io.open(path.join(app.outdir, 'projectnamenotset.tex'), encoding='utf-8') as f:
+        tex = f.read()
+    (name,) = app.builder.visuals_downloader.used
+    assert name.startswith('visuals-') and name.endswith('.png')
+    assert path.splitext(name)[0] in tex
+    assert path.exists(path.join(app.outdir, name))
+    assert 'visuals-placeholder' not in tex
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+    test_oembed
+    ~~~~~~~~~~~
+
+    Tests for resolving oEmbed payloads: the TTL of cached responses, revalidation,
+    and sharing one request between concurrent lookups of a uri.
+
+    :copyright: Copyright 2015 by the contributors, see AUTHORS.
+    :license: BSD, see LICENSE for details.
+"""
+
+import threading
+import time
+
+from standins import StandInOEmbedProvider
+from visuals.asset.oembed import OEmbedResolver
+
+URI = 'https://visuals.example.com/assets/1'
+
+
+class Clock(object):
+
+    def __init__(self, now=1000):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def make_resolver(provider, directory, clock=None, **kwargs):
+    return OEmbedResolver(provider.uri + '/oembed', str(directory), clock=clock or Clock(), **kwargs)
+
+
+def test_cached_response_is_used_until_its_ttl_passes(tmp_path):
+    clock = Clock()
+    with StandInOEmbedProvider(max_age=60) as provider:
+        payload = make_resolver(provider, tmp_path, clock).resolve(URI)
+        assert URI in payload['html']
+
+        # Another build within max-age seconds does not ask the provider.
+        clock.now += 59
+        assert make_resolver(provider, tmp_path, clock).resolve(URI) == payload
+        assert provider.lookups == {URI: 1}
+
+        clock.now += 2
+        assert make_resolver(provider, tmp_path, clock).resolve(URI) == payload
+        assert provider.lookups == {URI: 2}
+
+
+def test_ttl_comes_from_max_age_then_cache_age_then_the_default(tmp_path):
+    resolver = OEmbedResolver('https://visuals.example.com/oembed', str(tmp_path), default_ttl=10)
+    assert resolver._ttl({}, {}) == 10
+    assert resolver._ttl({}, {'cache_age': 30}) == 30
+    assert resolver._ttl({'Cache-Control': 'public, max-age=60'}, {'cache_age': 30}) == 60
+    # Bad payloads get the default
+    assert resolver._ttl({}, {'cache_age': 'abc'}) == 10
+    assert resolver._ttl({}, {'cache_age': [1]}) == 10
+    assert resolver._ttl({}, ['not', 'an', 'object']) == 10
+
+
+class ListOEmbedProvider(StandInOEmbedProvider):
+    """Answers with a JSON list instead of an object."""
+
+    def handle(self, method, path, body, headers):
+        status, response_headers, payload = super().handle(method, path, body, headers)
+        return status, {}, [payload]
+
+
+def test_payload_that_is_not_an_object_is_not_used(tmp_path):
+    with ListOEmbedProvider() as provider:
+        assert make_resolver(provider, tmp_path).resolve(URI) is None
+
+
+def test_payload_is_used_if_the_cache_cannot_be_written(tmp_path):
+    not_a_directory = tmp_path / 'file'
+    not_a_directory.write_bytes(b'')
+    with StandInOEmbedProvider() as provider:
+        payload = make_resolver(provider, not_a_directory).resolve(URI)
+    assert URI in payload['html']
+
+
+def test_expired_response_is_revalidated(tmp_path):
+    clock = Clock()
+    with StandInOEmbedProvider(max_age=60) as provider:
+        payload = make_resolver(provider, tmp_path, clock).resolve(URI)
+
+        # Unchanged: the provider answers 304, and the cached payload is fresh for another max-age.
+        clock.now += 61
+        assert make_resolver(provider, tmp_path, clock).resolve(URI) == payload
+        assert provider.not_modified == 1
+        clock.now += 59
+        make_resolver(provider, tmp_path, clock).resolve(URI)
+        assert provider.lookups == {URI: 2}
+
+        # Changed: the new payload replaces the cached one.
+        provider.version = 2
+        provider.max_age = 120
+        clock.now += 2
+        changed = make_resolver(provider, tmp_path, clock).resolve(URI)
+        assert provider.lookups == {URI: 3}
+        assert provider.not_modified == 1
+        assert changed['title'] == 'version 2'
+        clock.now += 119
+        make_resolver(provider, tmp_path, clock).resolve(URI)
+        assert provider.lookups == {URI: 3}
+
+
+def test_stale_payload_is_used_if_the_provider_is_unreachable(tmp_path):
+    clock = Clock()
+    with StandInOEmbedProvider(max_age=60) as provider:
+        payload = make_resolver(provider, tmp_path, clock).resolve(URI)
+    clock.now += 61
+    assert make_resolver(provider, tmp_path, clock, timeout=1).resolve(URI) == payload
+
+
+class SlowOEmbedProvider(StandInOEmbedProvider):
+    """Takes delay seconds to answer, so that lookups overlap."""
+
+    def __init__(self, delay):
+        super().__init__()
+        self.delay = delay
+
+    def handle(self, method, path, body, headers):
+        time.sleep(self.delay)
+        return super().handle(method, path, body, headers)
+
+
+def test_concurrent_lookups_of_a_uri_share_one_request(tmp_path):
+    with SlowOEmbedProvider(delay=0.2) as provider:
+        resolver = make_resolver(provider, tmp_path)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(resolver.resolve(URI))) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    assert provider.lookups == {URI: 1}
+    assert len(results) == 8
+    assert all(result is not None and result == results[0] for result in results)
+
+
+def test_resolve_all_looks_up_each_uri_once(tmp_path):
+    uris = ['https://visuals.example.com/assets/{0}'.format(number) for number in range(5)]
+    with StandInOEmbedProvider() as provider:
+        resolver = make_resolver(provider, tmp_path, max_workers=3)
+        payloads = resolver.resolve_all(uris * 3)
+        resolver.resolve_all(uris)
+    assert sorted(payloads) == sorted(uris)
+    assert provider.lookups == dict((uri, 1) for uri in uris)
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+    test_parallel_read
+    ~~~~~~~~~~~~~~~~~~
+
+    A parallel read (sphinx-build -j N) must collect the same assets as a serial read.
+
+    :copyright: Copyright 2015 by the contributors, see AUTHORS.
+    :license: BSD, see LICENSE for details.
+"""
+
+from os import path
+
+from visuals.asset import AssetsDict
+
+
+def snapshot_assets(assets):
+    """
+    :param visuals.asset.AssetsDict assets:
+    :return dict: a plain, comparable copy of assets and its indexes
+    """
+    return {
+        'assets': dict((asset_id, (asset.type, tuple(asset.location) if asset.location else None,
+                                   dict((docname, [dict(options) for options in options_list])
+                                        for docname, options_list in asset.instances.items())))
+                       for asset_id, asset in assets.items()),
+        'doc_index': dict((docname, sorted(asset_ids)) for docname, asset_ids in assets.doc_index.items()),
+        'ref_docs': dict((asset_id, sorted(docnames)) for asset_id, docnames in assets.ref_docs.items()),
+        'instance_info': dict((docname, dict(info)) for docname, info in assets.instance_info.items()),
+    }
+
+
+def write_docs(project, count=8):
+    docs = ['doc{0}'.format(number) for number in range(count)]
+    project.write('index', 'Index\n=====\n\n.. toctree::\n\n' + ''.join('   {0}\n'.format(doc) for doc in docs))
+    for number, doc in enumerate(docs):
+        neighbour = docs[(number + 1) % count]
+        project.write(doc, '''
+            {doc}
+            ====
+
+            .. visual:: {doc} definition
+               :width: {width}px
+
+               content of {doc}
+
+            .. visual:: {doc} definition
+
+            .. visual:: {neighbour} definition
+               :type: photo
+
+            .. visual:: shared definition
+
+               defined in {doc}
+
+            .. visual:: undefined reference
+            '''.format(doc=doc, neighbour=neighbour, width=100 + number))
+
+
+def test_parallel_read_matches_serial_read(project):
+    write_docs(project)
+
+    serial = project.build(freshenv=True, builddir=path.join(project.builddir, 'serial'))
+    parallel = project.build(parallel=2, freshenv=True, builddir=path.join(project.builddir, 'parallel'))
+
+    assert serial.parallel == 1 and parallel.parallel == 2
+    assert len(serial.env.assets) == 10
+    assert snapshot_assets(parallel.env.assets) == snapshot_assets(serial.env.assets)
+
+
+docs_assets = {
+    'a': [('shared', 'photo', False), ('b only', 'photo', True), ('twice', 'photo', False)],
+    'b': [('b only', 'video', False), ('shared', 'photo', True)],
+    'c': [('shared', 'video', False), ('twice', 'video', False), ('twice', 'rich', False)],
+    'd': [('c and d', 'rich', False), ('shared', None, True)],
+}
+"""{docname: [(asset_id, type, is_ref)]}"""
+
+
+def read(assets, docnames):
+    """Add the assets of docnames (see docs_assets) to assets, like reading them would."""
+    for docname in docnames:
+        for asset_id, asset_type, is_ref in docs_assets[docname]:
+            assets.add_asset(docname, asset_id, {'doc': docname}, asset_type, is_ref)
+    return assets
+
+
+def pickled_assets():
+    """The assets at the start of a build: 'z' is not read again, and it defines 'shared'."""
+    assets = AssetsDict()
+    assets.add_asset('z', 'shared', {}, 'rich')
+    assets.add_asset('z', 'c and d', {}, 'photo', is_ref=True)
+    assets.pop_outdated_docs(['z'])
+    return assets
+
+
+def test_merge_order_does_not_matter():
+    expected = snapshot_assets(read(pickled_assets(), ['a', 'b', 'c', 'd']))
+    chunks = [['a', 'b'], ['c'], ['d']]
+    for merge_order in ([0, 1, 2], [2, 1, 0], [1, 2, 0]):
+        # each worker starts from a copy of the main process's assets, and reads its chunk
+        workers = [read(pickled_assets(), chunk) for chunk in chunks]
+        assets = pickled_assets()
+        for index in merge_order:
+            assets.merge_other(chunks[index], workers[index])
+        assert snapshot_assets(assets) == expected, merge_order
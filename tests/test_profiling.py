@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+"""
+    test_profiling
+    ~~~~~~~~~~~~~~
+
+    Tests for the opt-in profiling of the extension's build phases.
+
+    :copyright: Copyright 2015 by the contributors, see AUTHORS.
+    :license: BSD, see LICENSE for details.
+"""
+
+import pstats
+from os import path
+
+
+def test_read_profile_covers_the_visual_directive(project):
+    project.write('index', '''
+        Index
+        =====
+
+        .. visual:: a definition
+
+           content
+        ''')
+    app = project.build(visuals_profile=['read'], visuals_profile_tools=['cprofile'])
+
+    stats = pstats.Stats(path.join(app.outdir, 'visuals-profile-read.prof'))
+    profiled = set((path.basename(filename), function) for filename, line, function in stats.stats)
+    assert ('directives.py', 'run') in profiled
+    assert ('fingerprint.py', 'fingerprint') in profiled
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""
+    test_scheduler
+    ~~~~~~~~~~~~~~
+
+    Pending assets are requested and polled once per build, also when their docs did not change.
+
+    :copyright: Copyright 2015 by the contributors, see AUTHORS.
+    :license: BSD, see LICENSE for details.
+"""
+
+import io
+import os
+from os import path
+
+from visuals.asset import AssetLocation
+from visuals.asset.backends import AssetBackend
+
+
+class EventuallyBackend(AssetBackend):
+    """Accepts every request, but only has the assets once ready is set."""
+    name = 'eventually'
+    priority = 10
+    ready = False
+    checked = []
+
+    def request_generation(self, assets):
+        self.statemachine.mark_requested(assets)
+
+    def check_availability(self, assets):
+        self.checked.append(sorted(asset.location.docname for asset in assets))
+        if self.ready:
+            for asset in assets:
+                asset.state.uri = 'https://visuals.example.com/{0}'.format(asset.id)
+            self.statemachine.mark_available(assets)
+
+
+def read_html(app, docname):
+    with io.open(path.join(app.outdir, docname + '.html'), encoding='utf-8') as f:
+        return f.read()
+
+
+def test_pending_assets_of_unchanged_docs_are_polled(project):
+    project.write('index', '''
+        Index
+        =====
+
+        .. toctree::
+
+           other
+
+        .. visual:: the visual
+
+           content of the visual
+        ''')
+    project.write('other', '''
+        Other
+        =====
+
+        .. visual:: the visual
+        ''')
+    backends = {'eventually': {'enabled': True}}
+    definition = ('the visual', AssetLocation('index', 0))
+    EventuallyBackend.ready = False
+    del EventuallyBackend.checked[:]
+
+    app = project.build(visuals_asset_backends=backends)
+    state = app.env.assets_state[definition]
+    assert state.requested and state.placeholder and not state.uri
+    assert 'visuals-placeholder' in read_html(app, 'other')
+    assert definition in set(app.env.assets_state.iter_pending())
+
+    # Nothing changed, but the asset is still pending: it is polled again, and the docs that use it are written.
+    EventuallyBackend.ready = True
+    app = project.build(visuals_asset_backends=backends)
+    assert EventuallyBackend.checked[-1] == ['index', 'other']
+    state = app.env.assets_state[definition]
+    assert state.available and not state.placeholder
+    assert state.uri == 'https://visuals.example.com/the visual'
+    assert 'visuals-placeholder' not in read_html(app, 'other')
+    assert app.env.assets_state.pending == {}
+
+    # Nothing is pending any more, so the backend is left alone.
+    checks = len(EventuallyBackend.checked)
+    project.build(visuals_asset_backends=backends)
+    assert len(EventuallyBackend.checked) == checks
+
+
+class FailingBackend(AssetBackend):
+    """Accepts every request, but fails to make the assets."""
+    name = 'failing'
+    priority = 10
+    checked = []
+
+    def request_generation(self, assets):
+        self.statemachine.mark_requested(assets)
+
+    def check_availability(self, assets):
+        self.checked.append(len(assets))
+        for asset in assets:
+            asset.state.error = 'failed'
+
+
+def test_failed_assets_are_not_polled_again(project):
+    project.write('index', '''
+        Index
+        =====
+
+        .. visual:: the visual
+
+           content of the visual
+        ''')
+    backends = {'failing': {'enabled': True}}
+    del FailingBackend.checked[:]
+
+    app = project.build(visuals_asset_backends=backends)
+    assert FailingBackend.checked == [1]
+    assert app.env.assets_state.pending == {}
+    project.build(visuals_asset_backends=backends)
+    assert FailingBackend.checked == [1]
+
+
+class LoggingBackend(AssetBackend):
+    """Writes the pid and docnames of each call to log, so calls made in worker processes are seen too."""
+    name = 'logging'
+    priority = 10
+    log = None
+
+    def write_log(self, method, assets):
+        with io.open(self.log, 'a', encoding='utf-8') as f:
+            f.write(u'{0} {1} {2}\n'.format(os.getpid(), method, len(assets)))
+
+    def request_generation(self, assets):
+        self.write_log('request', assets)
+        self.statemachine.mark_requested(assets)
+
+    def check_availability(self, assets):
+        self.write_log('check', assets)
+
+
+def test_parallel_processing_talks_to_the_backends_once(project, tmp_path):
+    docs = ['doc{0}'.format(number) for number in range(6)]
+    project.write('index', 'Index\n=====\n\n.. toctree::\n\n' + ''.join('   {0}\n'.format(doc) for doc in docs))
+    project.write('defs', '''
+        Definitions
+        ===========
+
+        .. visual:: shared
+
+           the shared content
+        ''')
+    for doc in docs:
+        project.write(doc, '''
+            {0}
+            ====
+
+            .. visual:: {0} visual
+
+               content of {0}
+
+            .. visual:: shared
+            '''.format(doc))
+    LoggingBackend.log = str(tmp_path / 'backend.log')
+    backends = {'logging': {'enabled': True}}
+
+    project.build(parallel=2, visuals_asset_backends=backends)
+    with io.open(LoggingBackend.log, encoding='utf-8') as f:
+        calls = [line.split() for line in f]
+    # One batch of requests for all definitions, one check of everything else: all in the main process.
+    assert calls == [[str(os.getpid()), 'request', '7'], [str(os.getpid()), 'check', '7'],
+                     [str(os.getpid()), 'check', '6']]
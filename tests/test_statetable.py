@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+    test_statetable
+    ~~~~~~~~~~~~~~~
+
+    Tests for the columnar asset state store.
+
+    :copyright: Copyright 2015 by the contributors, see AUTHORS.
+    :license: BSD, see LICENSE for details.
+"""
+
+import pickle
+
+import pytest
+
+from visuals.asset import AssetLocation, AssetsMetadataDict
+from visuals.asset.statemachine import AssetState
+from visuals.asset.statetable import AssetStateRow, AssetStateTable, numpy_available
+
+pytestmark = pytest.mark.skipif(not numpy_available, reason='requires numpy')
+
+
+def make_states(factory, docs=40, per_doc=100):
+    assets_state = AssetsMetadataDict()
+    for doc in range(docs):
+        for number in range(per_doc):
+            state = assets_state.defs[('visual {0}-{1}'.format(doc, number), AssetLocation('doc{0}'.format(doc), 0))] \
+                = factory()
+            state.requested = number % 2 == 0
+            state.uri = 'https://example.com/{0}/{1}'.format(doc, number) if number % 10 == 0 else None
+    return assets_state
+
+
+def test_rows_pickle_compactly():
+    table = AssetStateTable()
+    rows = make_states(table.new_row)
+    objects = make_states(AssetState)
+
+    rows_pickle = pickle.dumps(rows, pickle.HIGHEST_PROTOCOL)
+    assert len(rows_pickle) < len(pickle.dumps(objects, pickle.HIGHEST_PROTOCOL)) / 2
+
+    loaded = pickle.loads(rows_pickle)
+    tables = set(id(state.table) for state in loaded.defs.values())
+    assert len(tables) == 1
+    assert set(loaded.defs) == set(rows.defs)
+    assert loaded.defs.doc_keys('doc3') == rows.defs.doc_keys('doc3')
+    for key, state in rows.defs.items():
+        assert (loaded.defs[key].requested, loaded.defs[key].uri) == (state.requested, state.uri)
+
+
+def test_merge_moves_rows_into_this_table():
+    table = AssetStateTable()
+    assets_state = AssetsMetadataDict()
+    # as sent back by a parallel worker: rows of the worker's copy of the table
+    other = pickle.loads(pickle.dumps(make_states(AssetStateTable().new_row, docs=2, per_doc=3)))
+
+    assets_state.merge_other(['doc0', 'doc1'], other, adopt=table.adopt)
+
+    assert len(assets_state.defs) == 6
+    for key, state in assets_state.defs.items():
+        assert isinstance(state, AssetStateRow) and state.table is table
+        assert (state.requested, state.uri) == (other.defs[key].requested, other.defs[key].uri)
+    assert table.size == 6
+
+
+def test_parallel_processing_keeps_one_table(project):
+    docs = ['doc{0}'.format(number) for number in range(4)]
+    project.write('index', 'Index\n=====\n\n.. toctree::\n\n' + ''.join('   {0}\n'.format(doc) for doc in docs))
+    for doc in docs:
+        project.write(doc, '''
+            {0}
+            ====
+
+            .. visual:: {0} definition
+
+               content of {0}
+
+            .. visual:: {0} definition
+            '''.format(doc))
+    app = project.build(parallel=2, visuals_state_store='table')
+
+    table = app.env.assets_state_table
+    states = list(app.env.assets_state.defs.values()) + list(app.env.assets_state.refs.values())
+    assert len(states) == 8
+    assert all(state.table is table for state in states)
+    assert table.count('requested', False) + table.count('requested') == 8  # live rows
+
+
+def test_switching_the_store_discards_the_old_state(project):
+    project.write('index', '''
+        Index
+        =====
+
+        .. visual:: a definition
+
+           content
+
+        .. visual:: a definition
+        ''')
+    app = project.build(visuals_state_store='table')
+    assert all(isinstance(state, AssetStateRow) for state in app.env.assets_state.defs.values())
+
+    app = project.build(visuals_state_store='objects')
+    assert not hasattr(app.env, 'assets_state_table')
+    states = list(app.env.assets_state.defs.values()) + list(app.env.assets_state.refs.values())
+    assert len(states) == 2
+    assert all(isinstance(state, AssetState) for state in states)
+
+    app = project.build(visuals_state_store='table')
+    table = app.env.assets_state_table
+    assert all(state.table is table for state in app.env.assets_state.defs.values())
@@ -13,7 +13,8 @@ from __future__ import absolute_import
 
 from collections import namedtuple
 
-from utils import DeepChainMapWithFallback
+from visuals.asset.statetable import pack_states, unpack_states
+from visuals.utils import DeepChainMapWithFallback
 
 AssetTuple = namedtuple('AssetTuple',
                         ['type',      # The asset type (generally, an oembed type)
@@ -26,6 +27,11 @@ Identifies the location of a particular instance of an asset in a given doc.
 instance is normally 0, unless it is not the first instance of the asset in the doc.
 For cases where doc has multiple copies of the same asset.
 """
+InstanceInfo = namedtuple('InstanceInfo', ['type', 'content_hash', 'backend'])
+"""
+What the visual node of an asset instance carries besides its options (see AssetsDict.instance_info).
+"""
+NO_INFO = InstanceInfo(None, None, None)
 
 
 class AssetsDict(dict):
@@ -47,6 +53,13 @@ class AssetsDict(dict):
     An asset definition has its location in AssetTuple.location, not just in instances.
     Assets can have references without definitions, suggesting that the asset is defined externally.
 
+    AssetsDict.doc_index maps each docname to the asset_ids used in it, so that purging, merging,
+    or listing the assets of one doc only touches the assets in that doc.
+    AssetsDict.ref_docs maps each asset_id to the docs that reference it, so that a definition
+    whose type changed only sends the docs that reference it back to processing (see pop_outdated_docs).
+    AssetsDict.instance_info keeps what generation needs besides the options, so that assets of docs
+    that were not read in this build can be requested and polled without their doctree.
+
     example access:
         assets['some id'].type
         assets['some id'].location.docname
@@ -57,11 +70,60 @@ class AssetsDict(dict):
     """
     # TODO: Does assets even need options? Perhaps instead of an instance index, it could be an id of sorts.
 
-    def add_asset(self, docname, asset_id, options, asset_type, is_ref=False):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.doc_index = {}
+        """
+        Reverse index of the assets used in each doc: {docname: set(asset_id)}
+        This includes definitions and references. Keep it in sync with add_asset and purge_doc.
+        """
+        self.ref_docs = {}
+        """
+        Reverse index of the docs that reference each asset: {asset_id: set(docname)}
+        Keep it in sync with add_asset and purge_doc.
+        """
+        for asset_id, (asset_type, location, instances) in self.items():
+            for docname, options_list in instances.items():
+                self.doc_index.setdefault(docname, set()).add(asset_id)
+                if any(AssetLocation(docname, index) != location for index in range(len(options_list))):
+                    self.ref_docs.setdefault(asset_id, set()).add(docname)
+
+        self.instance_info = {}
+        """
+        {docname: {(asset_id, instance): InstanceInfo(type, content_hash, backend)}} from the visual nodes.
+        Keep it in sync with add_asset and purge_doc.
+        """
+
+        self.known_types = dict((asset_id, asset.type) for asset_id, asset in self.items() if asset.type is not None)
+        """The type of each definition as of the last call to pop_outdated_docs: {asset_id: type}"""
+
+        self.outdated_docs = set()
+        """docnames that were added or purged since the last call to pop_outdated_docs"""
+        self.changed_definitions = set()
+        """asset_ids whose definition was added or purged since the last call to pop_outdated_docs"""
+
+    def add_asset(self, docname, asset_id, options, asset_type, is_ref=False, content_hash=None, backend=None):
+        """
+        :param str docname: The doc that has this instance of the asset
+        :param str asset_id: The asset id (the visual's name)
+        :param AssetOptionsDict options: The options that are relevant for generation
+        :param str asset_type: The type of the visual node
+        :param bool is_ref: Whether this instance is a reference instead of the definition
+        :param str content_hash: The fingerprint of the definition's content (see visuals.asset.fingerprint)
+        :param str backend: The backend requested with the visual's :backend: option
+        """
+        self.doc_index.setdefault(docname, set()).add(asset_id)
+        self.outdated_docs.add(docname)
+        instance = len(self[asset_id].instances.get(docname, ())) if asset_id in self else 0
+        self.instance_info.setdefault(docname, {})[(asset_id, instance)] = \
+            InstanceInfo(asset_type, content_hash, backend)
+        if is_ref:
+            self.ref_docs.setdefault(asset_id, set()).add(docname)
+        else:
+            self.changed_definitions.add(asset_id)
+
         if asset_id in self:
-            instances = self[asset_id].instances[docname]
-            instance = len(instances)
-            instances.append(options)
+            self[asset_id].instances.setdefault(docname, []).append(options)
             if not is_ref and self[asset_id].location is None:
                 location = AssetLocation(docname, instance)
                 # noinspection PyProtectedMember
@@ -83,31 +145,122 @@ class AssetsDict(dict):
         """
         :param list docname: Exclude all assets related to this docname
         """
-        for asset_id, (asset_type, (definition_docname, definition_index), instances) in list(self.items()):
-            if docname in instances:
-                del instances[docname]
-            if definition_docname == docname:
-                if not instances:
-                    del self[asset_id]
-                else:  # the doc that defined this was purged, but something is still using it.
-                    # noinspection PyProtectedMember
-                    self[asset_id] = self[asset_id]._replace(type=None, location=None)
+        self.outdated_docs.add(docname)
+        self.instance_info.pop(docname, None)
+        for asset_id in self.doc_index.pop(docname, ()):
+            ref_docs = self.ref_docs.get(asset_id)
+            if ref_docs is not None:
+                ref_docs.discard(docname)
+                if not ref_docs:
+                    del self.ref_docs[asset_id]
+            asset_type, location, instances = self[asset_id]
+            instances.pop(docname, None)
+            if location is not None and location.docname == docname:
+                self.changed_definitions.add(asset_id)
+            if not instances:
+                del self[asset_id]
+            elif location is not None and location.docname == docname:
+                # the doc that defined this was purged, but something is still using it.
+                # noinspection PyProtectedMember
+                self[asset_id] = self[asset_id]._replace(type=None, location=None)
 
     def merge_other(self, docnames, other):
         """
         For use during the env-merge-info sphinx event
 
+        This splices the instance lists of each of docnames from other into this dict, instead of
+        replaying every instance through add_asset, so it only costs as much as the assets in docnames.
+        The docs were purged from this dict before other read them, so they have no instances here yet.
+        The result does not depend on the order in which the others are merged.
+
         :param list docnames: Only include asset instances in these docnames
         :param AssetsDict other: the AssetsDict that should merge into this one
         :return:
         """
-        for asset_id, (asset_type, location, instances) in list(other.items()):
-            if location and asset_id in self and self[asset_id].location:
-                assert self[asset_id].location == location
-                # The definition location can only be defined once.
-            for doc in instances & docnames:
-                for options in instances[doc]:
-                    self.add_asset(doc, asset_id, options, asset_type)
+        for docname in docnames:
+            asset_ids = other.doc_index.get(docname)
+            if not asset_ids:
+                continue
+            self.outdated_docs.add(docname)
+            self.doc_index.setdefault(docname, set()).update(asset_ids)
+            self.instance_info[docname] = dict(other.instance_info.get(docname, {}))
+            for asset_id in asset_ids:
+                asset_type, location, instances = other[asset_id]
+                options_list = list(instances[docname])
+                defined_here = location is not None and location.docname == docname
+                # other's add_asset calls already tracked these
+                if asset_id in other.changed_definitions:
+                    self.changed_definitions.add(asset_id)
+                if docname in other.ref_docs.get(asset_id, ()):
+                    self.ref_docs.setdefault(asset_id, set()).add(docname)
+
+                existing = self.get(asset_id)
+                if existing is None:
+                    if defined_here:
+                        self[asset_id] = AssetTuple(asset_type, location, {docname: options_list})
+                    else:
+                        self[asset_id] = AssetTuple(None, None, {docname: options_list})
+                    continue
+                existing.instances[docname] = options_list
+                # The definition location can only be defined once. A serial read keeps the first one
+                # it reads, and it reads in docname order, but workers are merged in the order they finish.
+                # So a location in a doc that was read in this build (outdated) gives way to an earlier doc.
+                if defined_here and (existing.location is None or (
+                        existing.location.docname in self.outdated_docs and docname < existing.location.docname)):
+                    # noinspection PyProtectedMember
+                    self[asset_id] = existing._replace(type=asset_type, location=location)
+
+    def pop_outdated_docs(self, all_docs):
+        """
+        Get the docs that need to be processed again, and reset the tracking for the next build.
+
+        A doc is outdated if it was read (or purged) during this build, or if it references an
+        asset whose definition changed type during this build (so the references' type needs fixing).
+        A definition that was read again with the same type does not affect its references.
+
+        :param all_docs: All docnames that are still in the project (eg env.all_docs)
+        :return list: sorted list of outdated docnames that are in all_docs
+        """
+        docnames = set(self.outdated_docs)
+        for asset_id in self.changed_definitions:
+            asset_type = self[asset_id].type if asset_id in self else None
+            if asset_type != self.known_types.get(asset_id):
+                docnames.update(self.ref_docs.get(asset_id, ()))
+            if asset_type is None:
+                self.known_types.pop(asset_id, None)
+            else:
+                self.known_types[asset_id] = asset_type
+        self.outdated_docs = set()
+        self.changed_definitions = set()
+        return sorted(docname for docname in docnames if docname in all_docs)
+
+    def iter_asset_ids(self, docnames=None):
+        """
+        Iterate over the asset_ids used in docnames (or all asset_ids if docnames is None).
+        With docnames, this only looks at the assets in those docs, not every asset in the project.
+
+        :param list docnames: Only include assets with instances in these docnames
+        """
+        if docnames is None:
+            return iter(list(self.keys()))
+        asset_ids = set()
+        for docname in docnames:
+            asset_ids.update(self.doc_index.get(docname, ()))
+        return iter(sorted(asset_ids))
+
+    def get_referencing_docs(self, asset_id):
+        """
+        :param str asset_id: The asset_id to look up
+        :return set: docnames with at least one reference to asset_id
+        """
+        return self.ref_docs.get(asset_id, set())
+
+    def get_asset_ids(self, docname):
+        """
+        :param str docname: The docname to look up
+        :return set: asset_ids with at least one instance (definition or reference) in docname
+        """
+        return self.doc_index.get(docname, set())
 
     def iter_instances(self, docnames=None):
         """
@@ -121,7 +274,8 @@ class AssetsDict(dict):
         :param list docnames: Only include asset instances in these docnames
         :return list: list of all asset instances (definitions & references)
         """
-        for asset_id, (asset_type, location, instances) in list(self.items()):
+        for asset_id in self.iter_asset_ids(docnames):
+            asset_type, location, instances = self[asset_id]
             for docname in list(instances.keys()):
                 if docnames is not None and docname not in docnames:
                     continue
@@ -133,7 +287,8 @@ class AssetsDict(dict):
         :param list docnames: Only include asset instances in these docnames
         :return list: list of all asset definitions
         """
-        for asset_id, (asset_type, location, instances) in list(self.items()):
+        for asset_id in self.iter_asset_ids(docnames):
+            location = self[asset_id].location
             if location is None or docnames is not None and location.docname not in docnames:
                 continue
             yield (asset_id, location)
@@ -143,13 +298,14 @@ class AssetsDict(dict):
         :param list docnames: Only include asset instances in these docnames
         :return list: list of all asset references
         """
-        for asset_id, (asset_type, location, instances) in list(self.items()):
+        for asset_id in self.iter_asset_ids(docnames):
+            asset_type, location, instances = self[asset_id]
             for docname in list(instances.keys()):
                 if docnames is not None and docname not in docnames:
                     continue
                 for index in range(len(instances[docname])):
                     instance_location = AssetLocation(docname, index)
-                    if instance_location is not location:
+                    if instance_location != location:
                         yield (asset_id, AssetLocation(docname, index))
 
     def list_instances(self, docnames=None):
@@ -170,14 +326,159 @@ class AssetsDict(dict):
     def get_options(self, asset_id, location):
         return self[asset_id].instances[location.docname][location.instance]
 
+    def get_info(self, asset_id, location):
+        """
+        :param str asset_id: The asset id
+        :param AssetLocation location: The location of the instance
+        :return InstanceInfo: (type, content_hash, backend) of the instance (all None if it is unknown)
+        """
+        return self.instance_info.get(location.docname, {}).get((asset_id, location.instance), NO_INFO)
+
+    def content_hashes(self):
+        """
+        :return set: the fingerprints of the content of all definitions (see ContentStore.collect_garbage)
+        """
+        return set(info.content_hash for infos in self.instance_info.values() for info in infos.values()
+                   if info.content_hash)
+
+
+class DocPartitionedDict(dict):
+    """
+    A dict keyed by (asset_id, AssetLocation) that also keeps its keys partitioned by docname.
+
+    Parts of the DocPartitionedDict:
+        {(asset_id, AssetLocation(docname, instance)): value}
+        DocPartitionedDict.docs = {docname: set((asset_id, AssetLocation))}
+
+    This makes it cheap to find, pop, or copy all entries for one doc.
+    All of the dict methods that add or remove keys keep the docs partition up to date.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__()
+        self.docs = {}
+        self.update(*args, **kwargs)
+
+    def __reduce__(self):
+        # pickle restores dict items with __setitem__ before __dict__, so rebuild docs on load instead.
+        # The entries are pickled per doc: the docname once, and the values packed (see pack_states),
+        # instead of an (asset_id, AssetLocation(docname, instance)) key and a value per entry.
+        docs = []
+        for docname, keys in self.docs.items():
+            keys = list(keys)
+            docs.append((docname, [asset_id for asset_id, location in keys],
+                         [location.instance for asset_id, location in keys],
+                         pack_states([self[key] for key in keys])))
+        return _unpickle_doc_partitioned_dict, (self.__class__, docs)
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.docs.setdefault(key[1].docname, set()).add(key)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._discard(key)
+
+    def _discard(self, key):
+        docname = key[1].docname
+        keys = self.docs.get(docname)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.docs[docname]
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *args):
+        if key in self:
+            self._discard(key)
+        return super().pop(key, *args)
+
+    def popitem(self):
+        key, value = super().popitem()
+        self._discard(key)
+        return key, value
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def clear(self):
+        super().clear()
+        self.docs.clear()
+
+    def copy(self):
+        return self.__class__(self)
+
+    def doc_keys(self, docname):
+        """
+        :param str docname: The docname to look up
+        :return set: keys of the entries in docname
+        """
+        return self.docs.get(docname, set())
+
+    def doc_items(self, docname):
+        """
+        :param str docname: The docname to look up
+        :return dict: {key: value} for all entries in docname
+        """
+        return {key: self[key] for key in self.docs.get(docname, ())}
+
+
+def _unpickle_doc_partitioned_dict(cls, docs):
+    """
+    :param type cls: DocPartitionedDict (or a subclass)
+    :param list docs: from DocPartitionedDict.__reduce__
+    """
+    partitioned = cls()
+    for docname, asset_ids, instances, packed in docs:
+        for asset_id, instance, value in zip(asset_ids, instances, unpack_states(packed)):
+            partitioned[(asset_id, AssetLocation(docname, instance))] = value
+    return partitioned
+
 
 class AssetsMetadataDict(DeepChainMapWithFallback):
     """
     The AssetsMetadataDict is a combination of a definition dict and a references dict.
+
+    defs, refs and fallback are DocPartitionedDicts, so per-doc operations (purge_doc,
+    merge_other, doc_items) only touch the entries of the docs involved.
+
+    pending indexes the entries that a backend may still make available, so they can be
+    polled again in later builds without looking at every entry (see set_pending).
     """
 
     def __init__(self):
-        super().__init__(defs={}, refs={})
+        super().__init__(defs=DocPartitionedDict(), refs=DocPartitionedDict())
+        self.fallback = DocPartitionedDict()
+        self.pending = {}
+        """{docname: set((asset_id, AssetLocation))} of the entries that are still pending"""
+
+    def set_pending(self, asset, pending):
+        """
+        :param tuple asset: the (asset_id, AssetLocation) key of an entry
+        :param bool pending: Whether the entry is pending (requested, but not available and not failed)
+        """
+        docname = asset[1].docname
+        if pending:
+            self.pending.setdefault(docname, set()).add(asset)
+            return
+        keys = self.pending.get(docname)
+        if keys is not None:
+            keys.discard(asset)
+            if not keys:
+                del self.pending[docname]
+
+    def iter_pending(self):
+        """
+        :return: iterator over the (asset_id, AssetLocation) keys of the pending entries
+        """
+        for keys in self.pending.values():
+            for asset in keys:
+                yield asset
 
     def purge_doc(self, docname
                   # , purge_in_fallback=False
@@ -188,9 +489,13 @@ class AssetsMetadataDict(DeepChainMapWithFallback):
         defs and refs. If purge_in_fallback, then exclude them from the fallback as well.
         :param list docname: Exclude all assets related to this docname
         """
-        for asset in self:  # does not iterate through fallback
-            if asset[1].docname == docname:
+        self.pending.pop(docname, None)
+        for mapping in self.maps:  # does not iterate through fallback
+            for asset in list(mapping.doc_keys(docname)):
+                state = self[asset]
                 del self[asset]
+                if hasattr(state, 'release'):  # eg an AssetStateRow
+                    state.release()
                 # TODO: Make this more robust, caching asset state entries for later use.
                 #       The following was one attempt, but it did not take into account a reorganized or deleted doc
                 #       If reorganized: instance numbers might change.
@@ -202,7 +507,7 @@ class AssetsMetadataDict(DeepChainMapWithFallback):
                 # else:
                 #     self.fallback[asset] = self.pop(asset)
 
-    def merge_other(self, docnames, other):
+    def merge_other(self, docnames, other, adopt=None):
         """
         For use during the env-merge-info sphinx event
 
@@ -212,17 +517,52 @@ class AssetsMetadataDict(DeepChainMapWithFallback):
 
         :param list docnames: Only include asset instances in these docnames
         :param AssetsMetadataDict other: the AssetsMetadataDict that should merge into this one
+        :param adopt: optional function that returns the state to keep for a state from other
+                      (eg AssetStateTable.adopt, so rows of another process's table move into this one)
+        """
+        for docname in docnames:
+            for mapping, other_mapping in ((self.defs, other.defs), (self.refs, other.refs)):
+                for asset, value in other_mapping.doc_items(docname).items():
+                    self._merge_value(mapping, asset, value, adopt)
+            if other.fallback:
+                for asset, value in other.fallback.doc_items(docname).items():
+                    self[asset] = adopt(value) if adopt is not None else value
+
+    @staticmethod
+    def _merge_value(mapping, asset, value, adopt=None):
+        # Keep the existing state object (eg a row in this process's AssetStateTable) if it can copy values.
+        existing = mapping.get(asset)
+        if existing is not None and existing is not value and hasattr(existing, 'copy_from'):
+            existing.copy_from(value)
+        else:
+            mapping[asset] = adopt(value) if adopt is not None else value
+
+    def subset(self, docnames):
+        """
+        Copy the entries for docnames into a new AssetsMetadataDict.
+        This is what a parallel worker sends back to be merged with merge_other.
+
+        :param list docnames: Only include entries in these docnames
+        :return AssetsMetadataDict:
+        """
+        other = self.__class__()
+        for docname in docnames:
+            other.defs.update(self.defs.doc_items(docname))
+            other.refs.update(self.refs.doc_items(docname))
+            other.fallback.update(self.fallback.doc_items(docname))
+        return other
+
+    def doc_items(self, docname):
+        """
+        All of the state for one doc, including anything left in the fallback.
+
+        :param str docname: The docname to look up
+        :return dict: {(asset_id, AssetLocation): value} for all entries in docname
         """
-        for asset in other.defs:
-            if asset[1].docname in docnames:
-                self.defs[asset] = other.defs[asset]
-        for asset in other.refs:
-            if asset[1].docname in docnames:
-                self.refs[asset] = other.refs[asset]
-        if other.fallback:
-            for asset in other.fallback:
-                if asset[1].docname in docnames:
-                    self[asset] = other[asset]
+        items = self.fallback.doc_items(docname)
+        for mapping in reversed(self.maps):
+            items.update(mapping.doc_items(docname))
+        return items
 
     def update_or_init_from_assets(self, assets, default_value=None):
         """
@@ -243,13 +583,16 @@ class AssetsMetadataDict(DeepChainMapWithFallback):
 
         # Don't overwrite any pre-existing state
         for asset in assets.iter_definitions():
-            self.defs.setdefault(asset, self.fallback.pop(asset, default()))
+            if asset not in self.defs:
+                self.defs[asset] = self.fallback.pop(asset) if asset in self.fallback else default()
         for asset in assets.iter_references():
-            self.refs.setdefault(asset, self.fallback.pop(asset, default()))
+            if asset not in self.refs:
+                self.refs[asset] = self.fallback.pop(asset) if asset in self.fallback else default()
         if self.fallback:
             # There shouldn't be anything else in fallback at this point unless merging...
             # This logic might be pointless... TODO: test whether this does anything
             fallback = self.fallback
-            self.fallback = {}
-            for asset in fallback:
-                self.setdefault(asset, fallback.pop(asset))
+            self.fallback = DocPartitionedDict()
+            while fallback:
+                asset, value = fallback.popitem()
+                self.setdefault(asset, value)
@@ -11,6 +11,9 @@
     :license: BSD, see LICENSE for details.
 """
 
+import asyncio
+from fnmatch import fnmatchcase
+
 
 class AssetBackend(object):
     """
@@ -29,6 +32,14 @@ class AssetBackend(object):
     """Numerical priority of this backend, 0 through 999 (override)."""
     enabled_by_default = False
     """Whether or not the class will be enabled by default, without per project config"""
+    provides_placeholders = False
+    """Whether the backend provides placeholders for assets that no other backend made available."""
+    concurrency = 1
+    """Maximum number of batches that may be in-flight at once for this backend (override or configure)."""
+    batch_size = 100
+    """Maximum number of assets passed to one request_generation or check_availability call."""
+    use_oembed = False
+    """Whether the uris this backend provides should be resolved with oEmbed (see visuals_oembed)."""
 
     def __init__(self, statemachine):
         """
@@ -53,12 +64,62 @@ class AssetBackend(object):
 
     @classmethod
     def apply_config(cls, config):
+        """
+        :param dict config: dictionary of config options for this backend.
+                            This is part of the Sphinx config, so it is only read, never modified:
+                            Sphinx compares it with the pickled config to decide whether to re-read every doc.
+        """
+        config = dict(config)
         if 'priority' in config:
             cls.priority = config.pop('priority')
-        cls.config.update(config)
+        if 'concurrency' in config:
+            cls.concurrency = max(1, int(config.pop('concurrency')))
+        if 'batch_size' in config:
+            cls.batch_size = max(1, int(config.pop('batch_size')))
+        if 'use_oembed' in config:
+            cls.use_oembed = bool(config.pop('use_oembed'))
+        # A new dict, so a subclass without its own config doesn't update AssetBackend.config
+        cls.config = dict(cls.config, **config)
+
+    def accepts(self, asset):
+        """
+        Whether this backend should handle the asset (see visuals.asset.routing.BackendRouter).
+
+        By default this uses these (optional) keys of the backend config:
+            types: a list of asset types (eg ['photo']) that this backend handles
+            ids: a list of fnmatch patterns for the asset ids that this backend handles
+        Without those keys, the backend accepts every asset.
+
+        :param visuals.asset.visual_asset_bridge.VisualAsset asset:
+        :return bool:
+        """
+        types = self.config.get('types')
+        if types is not None and asset.type not in types:
+            return False
+        ids = self.config.get('ids')
+        if ids is not None and not any(fnmatchcase(asset.id, pattern) for pattern in ids):
+            return False
+        return True
 
     def request_generation(self, assets):
         raise NotImplementedError('must be implemented in subclasses')
 
     def check_availability(self, assets):
         raise NotImplementedError('must be implemented in subclasses')
+
+    # The async interface is what the AssetsStateMachine uses.
+    # By default, it adapts the sync methods above by running them in a worker thread,
+    # so sync-only backends keep working. Backends that can do real async I/O should
+    # override these instead of the sync methods. Either way, AssetsStateMachine
+    # limits the number of concurrent calls per backend to self.concurrency.
+
+    async def request_generation_async(self, assets):
+        await self._run_sync(self.request_generation, assets)
+
+    async def check_availability_async(self, assets):
+        await self._run_sync(self.check_availability, assets)
+
+    @staticmethod
+    async def _run_sync(method, assets):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, method, assets)
@@ -55,11 +55,7 @@ class DummyBackend(AssetBackend):
     name = 'dummy'
     priority = 50
     enabled_by_default = False
-
-    @classmethod
-    def is_enabled(cls, config):
-        cls.apply_config(config)
-        return True
+    use_oembed = True
 
     def __init__(self, statemachine):
         super().__init__(statemachine)
@@ -82,5 +78,6 @@ class DummyBackend(AssetBackend):
         for asset in list(assets):
             remote_asset = self.assets[self._random_asset_key()]
             if remote_asset['status'] == 'done':
-                self.statemachine.mark_available(asset)
+                asset.state.uri = remote_asset['uri']
+                self.statemachine.mark_available([asset])
 
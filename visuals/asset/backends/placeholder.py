@@ -14,6 +14,7 @@ from visuals.asset.backends import AssetBackend
 class PlaceholderBackend(AssetBackend):
     name = 'placeholder'
     priority = 999  # Try other backends first. This backend is 'available' for all.
+    provides_placeholders = True
     enabled_by_default = True
 
     def request_generation(self, assets):
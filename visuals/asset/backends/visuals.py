@@ -10,68 +10,84 @@
 """
 
 from visuals.asset.backends import AssetBackend
-from visuals.asset.visual_asset_bridge import VisualAsset
-from visuals.client import VisualsClient
-from visuals.rst import visual
+from visuals.client import VisualsClient, VisualsClientError, asset_key
 
 
-def process_visuals(app, doctree):
+class VisualsBackend(AssetBackend):
     """
-    This should send the request to generate the images storing status/URI if known
-    (builder will use placeholder if not done)
+    Backend for the visuals web service.
 
-    This expects env.assets to be a complete list that will not change.
+    It is only enabled if the web service uri is configured:
+        visuals_asset_backends = {'visuals': {'uri': 'https://visuals.example.com/api'}}
 
-    :param sphinx.application.Sphinx app: Sphinx Application
-    :param nodes.document doctree: The doctree of a particular docname in the project
-    :return:
+    Other config: pool_size (persistent connections), timeout (seconds),
+    and the generic concurrency and batch_size (see AssetBackend).
     """
-    env = app.builder.env
-    """:type env: sphinx.environment.BuildEnvironment"""
-    assets = env.assets
-    """:type assets: AssetsDict"""
-
-    for node in doctree.traverse(visual):
-        asset = VisualAsset(node)
-
-        if node.is_ref():
-            response = client.request_asset(asset.id, asset.location, asset.type, asset.options)
-        else:
-            response = client.request_asset(asset.id, asset.location, asset.type, asset.options,
-                                            content_hash=asset.content_hash)
-            # response = client.request_asset(asset.asset_id, asset.location, asset.node_type, asset.options,
-            #                                 content=asset.content)
-
-        if response.state == response.codes.ok:
-            asset.state.requested = True
-        elif response.state == response.codes.not_found:
-            pass
-        elif response.state == response.codes.not_found:
-            pass
-        elif response.state == response.codes.not_found:
-            pass
-        else:
-            asset.state.error = response.error
-
-        if response.uri:
-            asset.state.available = True
-
-
-class VisualsBackend(AssetBackend):
     name = 'visuals'
     priority = 500
     enabled_by_default = True
     config = {}
 
+    @classmethod
+    def is_enabled(cls, config):
+        if not config.get('uri') and not cls.config.get('uri'):
+            return False
+        return super().is_enabled(config)
+
     def __init__(self, statemachine):
         super().__init__(statemachine)
-        self.client = VisualsClient()
+        self.client = VisualsClient(self.config['uri'],
+                                    pool_size=self.config.get('pool_size', self.concurrency),
+                                    batch_size=self.batch_size,
+                                    timeout=self.config.get('timeout', 30))
 
     def request_generation(self, assets):
-        response = self.client.request(assets)
-        self.statemachine.mark_requested(assets)
+        try:
+            results = self.client.request(assets)
+        except VisualsClientError as err:
+            self.record_error(assets, err)
+            return
+        self.statemachine.mark_requested(self.apply_results(assets, results))
 
     def check_availability(self, assets):
-        response = self.client.check_availability(assets)
-        self.statemachine.mark_available(assets)
-
+        try:
+            results = self.client.check_availability(assets)
+        except VisualsClientError as err:
+            self.record_error(assets, err)
+            return
+        accepted = self.apply_results(assets, results)
+        # apply_results only keeps the uri of assets that are done now (eg not if they are being regenerated)
+        self.statemachine.mark_available([asset for asset in accepted if asset.state.uri])
+        self.statemachine.mark_not_available([asset for asset in accepted if not asset.state.uri])
+
+    @staticmethod
+    def apply_results(assets, results):
+        """
+        Copy the uri and error from the web service results into the asset states.
+        Only assets that are done in these results keep a uri: a uri from an earlier result is stale
+        once the asset is, eg, being generated again.
+
+        :param list assets: list of VisualAsset
+        :param dict results: {asset_key: result} from VisualsClient
+        :return list: the assets that the web service knows about and that have not failed.
+        """
+        accepted = []
+        for asset in assets:
+            result = results.get(asset_key(asset))
+            if result is None:
+                continue
+            if result.get('status') == 'failed':
+                asset.state.error = result.get('error') or 'failed'
+                continue
+            if result.get('status') == 'done' and result.get('uri'):
+                asset.state.uri = result['uri']
+                asset.state.checksum = result.get('checksum')
+            else:
+                asset.state.uri = asset.state.checksum = None
+            accepted.append(asset)
+        return accepted
+
+    @staticmethod
+    def record_error(assets, err):
+        for asset in assets:
+            asset.state.error = str(err)
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""
+    visuals.asset.cache
+    ~~~~~~~~~~~~~~~~~~~
+
+    A persistent, content-addressed cache for resolved assets, with a size budget.
+
+    :copyright: Copyright 2015 by the contributors, see AUTHORS.
+    :license: BSD, see LICENSE for details.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+from os import path
+
+from visuals.instrumentation import recorder
+
+
+def write_atomic(filename, data):
+    """
+    Write data to filename via a temp file + rename, so readers never see a partial file.
+
+    :param str filename: the final filename
+    :param bytes data: the contents
+    """
+    dirname = path.dirname(filename)
+    if not path.isdir(dirname):
+        os.makedirs(dirname, exist_ok=True)
+    fd, tmp_filename = tempfile.mkstemp(dir=dirname, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        if path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        raise
+
+
+class AssetCache(object):
+    """
+    An on-disk cache of resolved URIs (and the downloads of AssetDownloader).
+
+    Entries are keyed by the content of the asset and the backend that generates it, not its location
+    (see make_key), so the same definition anywhere in the project (or in checkouts that share
+    visuals_cache_dir) shares one entry.
+
+    Layout in directory:
+        usage                 # the size of the cache, as far as this cache knows (see evict)
+        <key[:2]>/<key>.json  # {'uri': ...}
+        <key[:2]>/<key>.data  # downloaded bytes (see AssetDownloader, which has its own keys)
+
+    There is no index file. The mtime of the .json (or .data) file is the last time the entry was used,
+    which keeps the cache safe to share between parallel workers and concurrent builds.
+    evict() removes the least recently used entries until the cache fits in max_bytes.
+    """
+
+    def __init__(self, directory, max_bytes=1024 ** 3):
+        """
+        :param str directory: Where to store the cache
+        :param int max_bytes: Size budget for the cache, enforced by evict()
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.added = 0
+        """bytes added to the cache by this process since the last evict()"""
+        self._known = {}
+        """{key: entry} that this process already read or wrote (avoids rewriting unchanged entries)"""
+
+    @staticmethod
+    def make_key(asset, backend):
+        """
+        The cache key covers everything that affects the generated asset: the backend that generates it
+        (its name and the uri of its service), the definition content (or, for references, the asset id),
+        the type, and the AssetOptionsDict.
+
+        :param visuals.asset.visual_asset_bridge.VisualAsset asset:
+        :param visuals.asset.backends.AssetBackend backend: The backend that asset is routed to
+        :return str: hex digest
+        """
+        if asset.is_ref:
+            source = {'id': asset.id}
+        else:
+            source = {'content_hash': asset.content_hash}
+        source['type'] = asset.type
+        source['options'] = asset.options
+        source['backend'] = backend.name
+        source['service'] = backend.config.get('uri')
+        serialized = json.dumps(source, sort_keys=True, default=str)
+        return hashlib.sha1(serialized.encode('utf-8')).hexdigest()
+
+    def _filename(self, key, extension):
+        return path.join(self.directory, key[:2], key + extension)
+
+    def get(self, key):
+        """
+        :param str key: see make_key
+        :return dict: {'uri': ...} or None if this is not cached
+        """
+        filename = self._filename(key, '.json')
+        try:
+            with open(filename, 'rb') as f:
+                entry = json.loads(f.read().decode('utf-8'))
+            os.utime(filename)  # mark as recently used
+        except (OSError, ValueError):
+            self.misses += 1
+            recorder.count('cache.misses')
+            return None
+        self.hits += 1
+        recorder.count('cache.hits')
+        self._known[key] = entry
+        return entry
+
+    def put(self, key, uri):
+        """
+        :param str key: see make_key
+        :param str uri: The resolved uri of the asset
+        """
+        entry = {'uri': uri}
+        if self._known.get(key) == entry:
+            return
+        self._known[key] = entry
+        data = json.dumps(entry, sort_keys=True).encode('utf-8')
+        write_atomic(self._filename(key, '.json'), data)
+        self.add_usage(len(data))
+
+    def data_filename(self, key):
+        """
+        :param str key: a hex digest (see AssetDownloader.key_for)
+        :return str: where the downloaded bytes for this key are (or should be) stored
+        """
+        return self._filename(key, '.data')
+
+    def add_usage(self, size):
+        """
+        :param int size: bytes that were added to the cache (eg by a download)
+        """
+        self.added += size
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache is no larger than max_bytes.
+
+        Walking the whole cache is slow for big caches, so it only happens when the size from the last
+        walk, plus what was added since, is over max_bytes. The walk counts every file, including
+        unfinished downloads (.part) and their validators.
+
+        :return int: The number of entries removed
+        """
+        usage_filename = path.join(self.directory, 'usage')
+        usage = self.read_usage(usage_filename)
+        if usage is not None and usage + self.added <= self.max_bytes:
+            if self.added:
+                write_atomic(usage_filename, str(usage + self.added).encode('ascii'))
+                self.added = 0
+            return 0
+
+        entries = {}
+        """{key: [mtime of the .json file, latest mtime of any file, size, [filenames]]}"""
+        total = 0
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if dirpath == self.directory and filename == 'usage':
+                    continue
+                full_filename = path.join(dirpath, filename)
+                try:
+                    stat = os.stat(full_filename)
+                except OSError:  # removed by a concurrent build
+                    continue
+                # <key>.json, <key>.data, <key>.data.part, ... belong together. Temp files are on their own.
+                key = filename.split('.', 1)[0] or full_filename
+                entry = entries.setdefault(key, [None, 0, 0, []])
+                if filename.endswith('.json'):
+                    entry[0] = stat.st_mtime
+                entry[1] = max(entry[1], stat.st_mtime)
+                entry[2] += stat.st_size
+                entry[3].append(full_filename)
+                total += stat.st_size
+
+        def last_used(item):
+            json_mtime, latest_mtime, size, filenames = item[1]
+            return latest_mtime if json_mtime is None else json_mtime
+
+        removed = 0
+        for key, (json_mtime, latest_mtime, size, filenames) in sorted(entries.items(), key=last_used):
+            if total <= self.max_bytes:
+                break
+            for filename in filenames:
+                try:
+                    os.remove(filename)
+                except OSError:
+                    pass
+            self._known.pop(key, None)
+            total -= size
+            removed += 1
+        write_atomic(usage_filename, str(total).encode('ascii'))
+        self.added = 0
+        return removed
+
+    @staticmethod
+    def read_usage(usage_filename):
+        try:
+            with open(usage_filename, 'rb') as f:
+                return int(f.read().decode('ascii'))
+        except (OSError, ValueError):
+            return None
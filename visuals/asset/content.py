@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+    visuals.asset.content
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    A content-addressed side store for the bodies of visual definitions.
+
+    :copyright: Copyright 2015 by the contributors, see AUTHORS.
+    :license: BSD, see LICENSE for details.
+"""
+
+import os
+from os import path
+
+from visuals.asset.cache import write_atomic
+
+
+class ContentStore(object):
+    """
+    Keeps the content block of each visual definition on disk, keyed by its fingerprint
+    (see visuals.asset.fingerprint), so that the visual node only has to carry the fingerprint.
+
+    Without this, every definition's StringList (with per-line source info) is pickled in its
+    doctree, and loaded again every time that doctree is. Definitions with the same fingerprint
+    share one file, and a body is only written if it is not stored yet.
+
+    The lines are stored without their source info: nothing after parsing needs it.
+
+    Bodies are not removed when a definition is edited or deleted. collect_garbage does that,
+    once per build, if docs were purged (see may_have_garbage).
+    """
+
+    def __init__(self, directory):
+        """
+        :param str directory: Where to store the content (eg <doctreedir>/visuals/content)
+        """
+        self.directory = directory
+        self._known = set()
+        """content hashes stored (or found) by this process, to skip the existence check"""
+        self.may_have_garbage = False
+        """Set when definitions may have been removed (eg docs were purged), so collect_garbage has work to do"""
+
+    def filename(self, content_hash):
+        """
+        :param str content_hash: eg md5:0123...
+        :return str: where the content of content_hash is stored
+        """
+        algorithm, digest = content_hash.split(':', 1)
+        return path.join(self.directory, algorithm, digest[:2], digest + '.txt')
+
+    def put(self, content_hash, lines):
+        """
+        :param str content_hash: The fingerprint of lines
+        :param lines: The content block (eg a docutils.statemachine.StringList)
+        """
+        if content_hash in self._known:
+            return
+        filename = self.filename(content_hash)
+        if not path.exists(filename):
+            write_atomic(filename, '\n'.join(lines).encode('utf-8'))
+        self._known.add(content_hash)
+
+    def get(self, content_hash):
+        """
+        :param str content_hash: The fingerprint of the content
+        :return list: The lines of the content, or None if it is not stored
+        """
+        try:
+            with open(self.filename(content_hash), 'rb') as f:
+                return f.read().decode('utf-8').split('\n')
+        except OSError:
+            return None
+
+    def __contains__(self, content_hash):
+        return content_hash in self._known or path.exists(self.filename(content_hash))
+
+    def collect_garbage(self, live_hashes):
+        """
+        Remove the content of definitions that no longer exist.
+
+        :param set live_hashes: the content hashes that are still used (see AssetsDict.content_hashes)
+        :return int: The number of bodies removed
+        """
+        removed = 0
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            algorithm = path.basename(path.dirname(dirpath))
+            for filename in filenames:
+                digest, ext = path.splitext(filename)
+                content_hash = '{0}:{1}'.format(algorithm, digest)
+                if ext != '.txt' or content_hash in live_hashes:
+                    continue
+                try:
+                    os.remove(path.join(dirpath, filename))
+                except OSError:
+                    continue
+                self._known.discard(content_hash)
+                removed += 1
+        self.may_have_garbage = False
+        return removed
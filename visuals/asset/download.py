@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+"""
+    visuals.asset.download
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    Concurrent, streaming, resumable downloads of available assets.
+
+    :copyright: Copyright 2015 by the contributors, see AUTHORS.
+    :license: BSD, see LICENSE for details.
+"""
+
+import hashlib
+import os
+import posixpath
+import re
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from os import path
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlsplit
+from urllib.request import Request, urlopen
+
+from visuals.asset.cache import write_atomic
+
+
+class DownloadError(Exception):
+    """Raised when an asset can't be downloaded, or its checksum does not match."""
+
+
+class AssetDownloader(object):
+    """
+    Downloads available assets to local files with a bounded pool of threads.
+
+    Each download streams to <filename>.part in chunk_size pieces (never the whole asset in memory),
+    hashing as it goes. The ETag (or Last-Modified) of the response is kept in <filename>.part.validator,
+    so an interrupted download can be resumed with an HTTP Range + If-Range request: if the remote
+    file changed in the meantime, the server sends all of it again instead of the rest of another file.
+    If the backend provided a checksum (asset.state.checksum, eg 'sha256:<hex>'), it is verified
+    before the .part file is renamed into place, and only then is the asset marked downloaded.
+
+    Downloads only happen in the main Sphinx process (see AvailabilityScheduler), and assets that share
+    a file are downloaded once, so no two downloads write to the same .part file.
+
+    Builders that need local image files use the downloads instead of the remote uris:
+    use() names the download in the builder's image dir, and copy_to() copies the used ones there.
+    """
+
+    def __init__(self, store, max_workers=4, chunk_size=64 * 1024, timeout=30):
+        """
+        :param visuals.asset.cache.AssetCache store: Provides data_filename for the local files
+        :param int max_workers: Maximum number of concurrent downloads
+        :param int chunk_size: Bytes read (and written) at a time
+        :param int timeout: Socket timeout in seconds
+        """
+        self.store = store
+        self.max_workers = max_workers
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self.used = {}
+        """{image name: downloaded filename} of the downloads used in this build (see use)"""
+
+    @staticmethod
+    def key_for(asset):
+        """
+        Downloads are keyed by what gets downloaded: the uri, and the checksum the backend expects.
+
+        :param visuals.asset.visual_asset_bridge.VisualAsset asset:
+        :return str: hex digest
+        """
+        source = '{0}\n{1}'.format(asset.state.uri, asset.state.checksum or '')
+        return hashlib.sha1(source.encode('utf-8')).hexdigest()
+
+    def filename_for(self, asset):
+        """
+        :param visuals.asset.visual_asset_bridge.VisualAsset asset:
+        :return str: Where the asset gets downloaded to
+        """
+        return self.store.data_filename(self.key_for(asset))
+
+    def image_name_for(self, asset):
+        """
+        :param visuals.asset.visual_asset_bridge.VisualAsset asset:
+        :return str: the name of the download in the builder's image dir (with the extension of the uri)
+        """
+        extension = posixpath.splitext(urlsplit(asset.state.uri).path)[1]
+        if not re.match(r'^\.[A-Za-z0-9]{1,5}$', extension):
+            extension = ''
+        return 'visuals-{0}{1}'.format(self.key_for(asset), extension)
+
+    def use(self, asset):
+        """
+        :param visuals.asset.visual_asset_bridge.VisualAsset asset: an asset that is downloaded
+        :return str: the image name, to be found in the output image dir after copy_to(),
+                     or None if the download is gone (eg evicted from the cache)
+        """
+        filename = self.filename_for(asset)
+        try:
+            os.utime(filename)  # mark as recently used (see AssetCache.evict)
+        except OSError:
+            return None
+        name = self.image_name_for(asset)
+        self.used[name] = filename
+        return name
+
+    def copy_to(self, outdir):
+        """
+        Copy the used downloads to outdir, skipping the ones that are already up to date.
+
+        :param str outdir: The builder's image output dir
+        :return list: the filenames that were copied
+        """
+        copied = []
+        for name, source in sorted(self.used.items()):
+            target = path.join(outdir, name)
+            if path.exists(target) and path.getsize(target) == path.getsize(source) \
+                    and path.getmtime(target) >= path.getmtime(source):
+                continue
+            if not path.isdir(outdir):
+                os.makedirs(outdir, exist_ok=True)
+            shutil.copyfile(source, target)
+            copied.append(target)
+        return copied
+
+    @staticmethod
+    def needs_download(asset):
+        return asset.state.available and asset.state.uri and not asset.state.placeholder
+
+    def download_all(self, assets):
+        """
+        Download every asset that is available but is not downloaded yet (or whose file went missing).
+
+        :param list assets: list of VisualAsset
+        :return list: The assets that were downloaded
+        """
+        todo = {}
+        for asset in assets:
+            if not self.needs_download(asset):
+                continue
+            filename = self.filename_for(asset)
+            if asset.state.downloaded and path.exists(filename):
+                continue
+            asset.state.downloaded = False
+            # assets with the same content share a file, so only download it once.
+            todo.setdefault(filename, []).append(asset)
+        if not todo:
+            return []
+
+        downloaded = []
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [(executor.submit(self.download, same_assets[0].state.uri, filename,
+                                        same_assets[0].state.checksum), same_assets)
+                       for filename, same_assets in sorted(todo.items())]
+            for future, same_assets in futures:
+                error = future.exception()
+                if error is None:
+                    self.store.add_usage(path.getsize(filename))
+                with self._lock:
+                    for asset in same_assets:
+                        if error is None:
+                            asset.state.downloaded = True
+                            downloaded.append(asset)
+                        else:
+                            asset.state.error = str(error)
+        return downloaded
+
+    def download(self, uri, filename, checksum=None):
+        """
+        Stream uri to filename, resuming filename.part if it exists and its validator was kept.
+
+        :param str uri: Where to download from
+        :param str filename: Where to save it
+        :param str checksum: Expected '<algorithm>:<hex digest>' (optional)
+        """
+        algorithm, expected = checksum.split(':', 1) if checksum else ('sha256', None)
+        digest = hashlib.new(algorithm)
+        part_filename = filename + '.part'
+        validator_filename = part_filename + '.validator'
+        dirname = path.dirname(filename)
+        if not path.isdir(dirname):
+            os.makedirs(dirname, exist_ok=True)
+
+        offset = 0
+        validator = self.read_validator(validator_filename) if path.exists(part_filename) else None
+        if validator is not None:
+            # Rehash what we have, so the checksum covers the whole file after resuming.
+            with open(part_filename, 'rb') as part:
+                for chunk in iter(lambda: part.read(self.chunk_size), b''):
+                    digest.update(chunk)
+                    offset += len(chunk)
+
+        request = Request(uri)
+        if offset:
+            request.add_header('Range', 'bytes={0}-'.format(offset))
+            # Only send the rest if it is still the same file. Otherwise, the server sends all of it.
+            request.add_header('If-Range', validator)
+        try:
+            response = urlopen(request, timeout=self.timeout)
+        except HTTPError as err:
+            if err.code == 416 and offset:  # The .part file is already complete
+                response = None
+            else:
+                raise DownloadError('Could not download {0}: {1}'.format(uri, err))
+        except URLError as err:
+            raise DownloadError('Could not download {0}: {1}'.format(uri, err))
+
+        if response is not None:
+            with response:
+                if offset and response.status != 206:  # The file changed, or the server ignored Range: start over
+                    offset = 0
+                    digest = hashlib.new(algorithm)
+                if not offset:
+                    self.write_validator(validator_filename, response.headers)
+                with open(part_filename, 'ab' if offset else 'wb') as part:
+                    for chunk in iter(lambda: response.read(self.chunk_size), b''):
+                        digest.update(chunk)
+                        part.write(chunk)
+
+        if path.exists(validator_filename):
+            os.remove(validator_filename)
+        if expected is not None and digest.hexdigest() != expected:
+            os.remove(part_filename)
+            raise DownloadError('Checksum mismatch for {0}: expected {1}, got {2}'.format(
+                uri, expected, digest.hexdigest()))
+        os.replace(part_filename, filename)
+
+    @staticmethod
+    def read_validator(validator_filename):
+        """
+        :param str validator_filename: <filename>.part.validator
+        :return str: the ETag or Last-Modified of the .part file's response, or None if it is unknown
+        """
+        try:
+            with open(validator_filename, 'rb') as f:
+                return f.read().decode('utf-8').strip() or None
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def write_validator(validator_filename, headers):
+        """
+        Keep what If-Range needs to resume this response: a strong ETag, or else Last-Modified.
+
+        :param str validator_filename: <filename>.part.validator
+        :param headers: the response headers
+        """
+        etag = headers.get('ETag')
+        validator = etag if etag and not etag.startswith('W/') else headers.get('Last-Modified')
+        if validator:
+            write_atomic(validator_filename, validator.encode('utf-8'))
+        elif path.exists(validator_filename):
+            os.remove(validator_filename)
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+    visuals.asset.fingerprint
+    ~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Canonical content fingerprints for visual definitions.
+
+    :copyright: Copyright 2015 by the contributors, see AUTHORS.
+    :license: BSD, see LICENSE for details.
+"""
+
+import hashlib
+import json
+
+DEFAULT_ALGORITHM = 'md5'
+"""
+md5 is fast and available everywhere. The fingerprint needs to be consistent across
+Python, PHP, JavaScript, Java, and ... so only use an algorithm the visuals service supports.
+Any name that hashlib.new() accepts (eg sha1, blake2b) can be configured instead.
+"""
+
+
+def is_supported(algorithm):
+    """
+    :param str algorithm: a hashlib algorithm name (eg the visuals_fingerprint_algorithm config)
+    :return bool: Whether fingerprint can use algorithm (variable length digests, such as shake_128, can't)
+    """
+    if algorithm not in hashlib.algorithms_available:
+        return False
+    try:
+        hashlib.new(algorithm, b'').hexdigest()
+    except (TypeError, ValueError):
+        return False
+    return True
+
+
+def normalize_content(lines):
+    """
+    Normalize a content block so that insignificant differences don't change the fingerprint:
+    line endings, trailing whitespace, and leading or trailing blank lines.
+
+    :param lines: The lines of the content block (eg a docutils.statemachine.StringList)
+    :return str: The normalized content
+    """
+    normalized = [line.replace('\r', '').rstrip() for line in lines]
+    start = 0
+    end = len(normalized)
+    while start < end and not normalized[start]:
+        start += 1
+    while end > start and not normalized[end - 1]:
+        end -= 1
+    return '\n'.join(normalized[start:end])
+
+
+def canonical_bytes(lines, options=None, asset_type=None):
+    """
+    The canonical byte string that gets hashed for a definition.
+
+    :param lines: The lines of the content block
+    :param dict options: The options that affect generation (an AssetOptionsDict)
+    :param str asset_type: The asset type (eg photo)
+    :return bytes:
+    """
+    header = json.dumps({'type': asset_type, 'options': options or {}},
+                        sort_keys=True, separators=(',', ':'), default=str)
+    return (header + '\n' + normalize_content(lines)).encode('utf-8')
+
+
+def fingerprint(lines, options=None, asset_type=None, algorithm=DEFAULT_ALGORITHM):
+    """
+    :param lines: The lines of the content block
+    :param dict options: The options that affect generation (an AssetOptionsDict)
+    :param str asset_type: The asset type (eg photo)
+    :param str algorithm: The hashlib algorithm to use
+    :return str: hex digest prefixed with the algorithm (eg md5:0123...) so digests from
+                 different algorithms can never be confused with each other.
+    """
+    digest = hashlib.new(algorithm, canonical_bytes(lines, options, asset_type)).hexdigest()
+    return '{0}:{1}'.format(algorithm, digest)
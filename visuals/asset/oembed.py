@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+    visuals.asset.oembed
+    ~~~~~~~~~~~~~~~~~~~~
+
+    oEmbed resolution with an on-disk response cache (TTL + conditional revalidation).
+
+    :copyright: Copyright 2015 by the contributors, see AUTHORS.
+    :license: BSD, see LICENSE for details.
+"""
+
+import hashlib
+import json
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from os import path
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+
+from visuals.asset.cache import write_atomic
+
+max_age_pattern = re.compile(r'max-age=(\d+)')
+
+
+class OEmbedResolver(object):
+    """
+    Resolves asset uris into oEmbed payloads (see oembed.com) from one oEmbed provider endpoint.
+
+    Each uri is looked up at most once per build, no matter how many docs use it:
+    results are memoized in memory, and concurrent lookups of one uri share a single request.
+
+    Responses are cached on disk with a TTL taken from (in order) the Cache-Control max-age
+    header, the payload's cache_age, or default_ttl. Once the TTL has passed, the cached
+    response is revalidated with If-None-Match / If-Modified-Since, so an unchanged payload
+    costs a 304 instead of a full response. If the provider can't be reached, a stale
+    cached payload is used rather than nothing.
+    """
+
+    def __init__(self, endpoint, directory, default_ttl=24 * 60 * 60, timeout=30, max_workers=4, clock=time.time):
+        """
+        :param str endpoint: The oEmbed provider endpoint (eg https://example.com/oembed)
+        :param str directory: Where to cache the responses
+        :param int default_ttl: Seconds a response stays fresh if the provider doesn't say
+        :param int timeout: Socket timeout in seconds
+        :param int max_workers: Maximum number of concurrent lookups in resolve_all
+        :param clock: function that returns the current time in seconds
+        """
+        self.endpoint = endpoint
+        self.directory = directory
+        self.default_ttl = default_ttl
+        self.timeout = timeout
+        self.max_workers = max_workers
+        self.clock = clock
+        self.resolved = {}
+        """{uri: payload or None} resolved in this process"""
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def _filename(self, uri):
+        key = hashlib.sha1(uri.encode('utf-8')).hexdigest()
+        return path.join(self.directory, key[:2], key + '.json')
+
+    def resolve_all(self, uris):
+        """
+        :param list uris: The uris to resolve (duplicates are only resolved once)
+        :return dict: {uri: payload or None}
+        """
+        todo = sorted(set(uri for uri in uris if uri not in self.resolved))
+        if todo:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                list(executor.map(self.resolve, todo))
+        return dict((uri, self.resolved.get(uri)) for uri in uris)
+
+    def cached(self, uri):
+        """
+        Like resolve, but never makes a request: a stale cached payload is returned as is.
+
+        :param str uri: The uri of the asset
+        :return dict: The oEmbed payload, or None if it has not been resolved.
+        """
+        if uri in self.resolved:
+            return self.resolved[uri]
+        entry = self._read(self._filename(uri))
+        return entry['payload'] if entry is not None else None
+
+    def resolve(self, uri):
+        """
+        :param str uri: The uri of the asset
+        :return dict: The oEmbed payload, or None if it could not be resolved.
+        """
+        with self._lock:
+            if uri in self.resolved:
+                return self.resolved[uri]
+            event = self._in_flight.get(uri)
+            owner = event is None
+            if owner:
+                event = self._in_flight[uri] = threading.Event()
+        if not owner:
+            event.wait()
+            return self.resolved.get(uri)
+
+        payload = None
+        try:
+            payload = self._resolve(uri)
+        finally:
+            with self._lock:
+                self.resolved[uri] = payload
+                del self._in_flight[uri]
+            event.set()
+        return payload
+
+    def _resolve(self, uri):
+        filename = self._filename(uri)
+        entry = self._read(filename)
+        now = self.clock()
+        if entry is not None and now < entry['fetched_at'] + entry['ttl']:
+            return entry['payload']
+
+        request = Request(self.endpoint + '?' + urlencode({'url': uri, 'format': 'json'}))
+        if entry is not None:
+            if entry.get('etag'):
+                request.add_header('If-None-Match', entry['etag'])
+            if entry.get('last_modified'):
+                request.add_header('If-Modified-Since', entry['last_modified'])
+
+        try:
+            with urlopen(request, timeout=self.timeout) as response:
+                payload = json.loads(response.read().decode('utf-8'))
+                headers = response.headers
+            if not isinstance(payload, dict):
+                raise ValueError('an oEmbed payload is a JSON object')
+        except HTTPError as err:
+            if err.code == 304 and entry is not None:
+                entry['fetched_at'] = now
+                entry['ttl'] = self._ttl(err.headers, entry['payload'])
+                self._write(filename, entry)
+                return entry['payload']
+            return entry['payload'] if entry is not None else None
+        except (URLError, OSError, ValueError):
+            return entry['payload'] if entry is not None else None
+
+        self._write(filename, {
+            'payload': payload,
+            'fetched_at': now,
+            'ttl': self._ttl(headers, payload),
+            'etag': headers.get('ETag'),
+            'last_modified': headers.get('Last-Modified'),
+        })
+        return payload
+
+    def _ttl(self, headers, payload):
+        match = max_age_pattern.search(headers.get('Cache-Control') or '') if headers is not None else None
+        if match:
+            return int(match.group(1))
+        if isinstance(payload, dict) and payload.get('cache_age') is not None:
+            try:
+                return int(payload['cache_age'])
+            except (TypeError, ValueError):
+                pass  # eg "cache_age": "abc"
+        return self.default_ttl
+
+    @staticmethod
+    def _read(filename):
+        try:
+            with open(filename, 'rb') as f:
+                return json.loads(f.read().decode('utf-8'))
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def _write(filename, entry):
+        # The cache is an optimization: if it can't be written (eg a read-only or full disk), carry on without it.
+        try:
+            write_atomic(filename, json.dumps(entry, sort_keys=True).encode('utf-8'))
+        except OSError:
+            pass
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+    visuals.asset.placeholders
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Generated, size-aware placeholder images.
+
+    :copyright: Copyright 2015 by the contributors, see AUTHORS.
+    :license: BSD, see LICENSE for details.
+"""
+
+import os
+import re
+import shutil
+import struct
+import zlib
+from os import path
+
+from visuals.asset.cache import write_atomic
+
+DEFAULT_SIZE = (320, 240)
+"""(width, height) in pixels of a placeholder for a visual without a usable width or height"""
+
+MAX_SIDE = 4096
+"""Placeholders are never larger than this (in pixels) on either side"""
+
+pixel_length_pattern = re.compile(r'^\s*(\d+(?:\.\d*)?)\s*(px)?\s*$')
+
+
+def pixel_length(value):
+    """
+    :param str value: A docutils length (eg '200', '200px', '3em', '50%')
+    :return int: The length in pixels, or None if it is not in pixels.
+    """
+    match = pixel_length_pattern.match(str(value)) if value is not None else None
+    return int(float(match.group(1))) if match else None
+
+
+def placeholder_size(width=None, height=None, scale=None, default=DEFAULT_SIZE):
+    """
+    The intrinsic size of the asset's placeholder, so that the layout does not shift
+    when the real asset replaces it. A missing width or height keeps the default aspect ratio.
+
+    :param width: the image's width option
+    :param height: the image's height option
+    :param scale: the image's scale option (a percentage)
+    :param tuple default: (width, height) to use if neither width nor height are in pixels
+    :return tuple: (width, height) in pixels
+    """
+    width, height = pixel_length(width), pixel_length(height)
+    if width is None and height is None:
+        width, height = default
+    elif width is None:
+        width = height * default[0] // default[1]
+    elif height is None:
+        height = width * default[1] // default[0]
+    if scale:
+        width, height = width * int(scale) // 100, height * int(scale) // 100
+    return (min(max(width, 1), MAX_SIDE), min(max(height, 1), MAX_SIDE))
+
+
+def make_png(width, height, rgba=(255, 255, 255, 0)):
+    """
+    A PNG of one solid color (transparent white by default, like FFFFFF-0.png).
+    Rows are compressed one at a time, so large placeholders don't need a full raw image in memory.
+
+    :param int width:
+    :param int height:
+    :param tuple rgba: the color
+    :return bytes:
+    """
+    def chunk(kind, data):
+        return (struct.pack('>I', len(data)) + kind + data +
+                struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+
+    header = struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)  # 8 bit RGBA
+    row = b'\x00' + bytes(rgba) * width  # filter type 0 + pixels
+    compressor = zlib.compressobj(9)
+    data = b''.join(compressor.compress(row) for _ in range(height)) + compressor.flush()
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) + chunk(b'IDAT', data) + chunk(b'IEND', b'')
+
+
+class PlaceholderImages(object):
+    """
+    Placeholder PNGs, generated once per size and kept in directory between builds.
+
+    Visuals with the same size share one file (see filename_for). Only the sizes that were
+    used get copied to the output dir, and only when they are missing or stale there.
+    """
+
+    def __init__(self, directory):
+        """
+        :param str directory: Where the generated placeholders are kept
+        """
+        self.directory = directory
+        self.used = set()
+        """{(width, height)} used in this build"""
+
+    @staticmethod
+    def filename_for(size):
+        """
+        :param tuple size: (width, height)
+        :return str: the placeholder's filename (without a directory)
+        """
+        return 'visuals-placeholder-{0}x{1}.png'.format(*size)
+
+    def use(self, size):
+        """
+        :param tuple size: (width, height)
+        :return str: the placeholder's filename, to be found in the output image dir after copy_to()
+        """
+        self.used.add(size)
+        return self.filename_for(size)
+
+    def generate(self, size):
+        """
+        :param tuple size: (width, height)
+        :return str: the path of the generated placeholder (generated only if it does not exist yet)
+        """
+        filename = path.join(self.directory, self.filename_for(size))
+        if not path.exists(filename):
+            write_atomic(filename, make_png(*size))
+        return filename
+
+    def copy_to(self, outdir):
+        """
+        Copy the used placeholders to outdir, skipping the ones that are already up to date.
+
+        :param str outdir: The builder's image output dir
+        :return list: the filenames that were copied
+        """
+        copied = []
+        for size in sorted(self.used):
+            source = self.generate(size)
+            target = path.join(outdir, self.filename_for(size))
+            if path.exists(target) and path.getsize(target) == path.getsize(source) \
+                    and path.getmtime(target) >= path.getmtime(source):
+                continue
+            if not path.isdir(outdir):
+                os.makedirs(outdir, exist_ok=True)
+            shutil.copyfile(source, target)
+            copied.append(target)
+        return copied
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+    visuals.asset.routing
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    Per-asset backend selection.
+
+    :copyright: Copyright 2015 by the contributors, see AUTHORS.
+    :license: BSD, see LICENSE for details.
+"""
+
+from sphinx.util import logging
+
+logger = logging.getLogger(__name__)
+
+class BackendRouter(object):
+    """
+    Assigns each asset to exactly one backend, so each backend only sees its own assets.
+
+    The backend for an asset is the first match of:
+      1. the backend named by the visual's :backend: option (if it is enabled)
+      2. the first backend (in priority order) that accepts() the asset, based on its config
+         (see AssetBackend.accepts)
+    Backends that provides_placeholders are never routed to; they are in placeholder_backends.
+    A :backend: that is not enabled, or that provides placeholders, is warned about and then ignored.
+
+    Assignments are cached per asset instance until forget_docs().
+    """
+
+    def __init__(self, backends):
+        """
+        :param list backends: enabled AssetBackend instances in priority order
+        """
+        self.backends = backends
+        self.by_name = dict((backend.name, backend) for backend in backends)
+        self.placeholder_backends = [backend for backend in backends if backend.provides_placeholders]
+        self.routes = {}
+        """{docname: {(asset_id, instance): AssetBackend or None}}"""
+
+    def route(self, asset):
+        """
+        :param visuals.asset.visual_asset_bridge.VisualAsset asset:
+        :return visuals.asset.backends.AssetBackend: or None if no backend can handle the asset
+        """
+        doc_routes = self.routes.setdefault(asset.location.docname, {})
+        key = (asset.id, asset.location.instance)
+        if key not in doc_routes:
+            doc_routes[key] = self._select(asset)
+        return doc_routes[key]
+
+    def _select(self, asset):
+        if asset.backend:
+            backend = self.by_name.get(asset.backend)
+            if backend is not None and not backend.provides_placeholders:
+                return backend
+            reason = 'provides placeholders' if backend is not None else 'is not enabled'
+            logger.warning('visual %r: backend %r %s; using the default backends instead',
+                           asset.id, asset.backend, reason, location=asset.location.docname)
+        for backend in self.backends:
+            if not backend.provides_placeholders and backend.accepts(asset):
+                return backend
+        return None
+
+    def group(self, assets):
+        """
+        :param list assets: list of VisualAsset
+        :return list: [(backend, [assets routed to backend]), ...] in backend priority order
+        """
+        groups = dict((backend, []) for backend in self.backends)
+        for asset in assets:
+            backend = self.route(asset)
+            if backend is not None:
+                groups[backend].append(asset)
+        return [(backend, groups[backend]) for backend in self.backends if groups[backend]]
+
+    def forget_docs(self, docnames):
+        """
+        :param list docnames: Drop the cached routes of assets in these docnames
+        """
+        for docname in docnames:
+            self.routes.pop(docname, None)
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+    visuals.asset.scheduler
+    ~~~~~~~~~~~~~~~~~~~~~~~
+
+    Build-level scheduling of asset generation requests and availability polling.
+
+    :copyright: Copyright 2015 by the contributors, see AUTHORS.
+    :license: BSD, see LICENSE for details.
+"""
+
+import time
+
+
+class AvailabilityScheduler(object):
+    """
+    Collects the assets that need the backends, then talks to the backends once for all of them.
+
+    The assets are those of every processed doc, plus the assets that were still pending after the
+    previous build (see is_pending and AssetsMetadataDict.pending), so assets of docs that did not change
+    are polled again too.
+
+    Instead of requesting and polling per doc (and again per doc while writing), run() does:
+      1. one batched generation request for all pending definitions (which also checks availability),
+         and one batched availability check of everything else that is pending
+      2. up to attempts - 1 more batched availability polls, with exponential backoff between them
+         (by default there are none: waiting for assets is opt-in, see visuals_availability_polling)
+      3. placeholders for anything that is still unavailable
+      4. downloads (if enabled) of everything that is available
+
+    Only assets that a backend is routed to get polled, so a build without backends never waits.
+    After run(), asset state is final for this build, so the write phase needs no network calls.
+    """
+
+    default_config = {
+        'attempts': 1,          # total number of availability checks (the first is part of the request)
+        'initial_delay': 0.5,   # seconds to wait before the second check
+        'factor': 2.0,          # multiply the delay by this after each check
+        'max_delay': 8.0,       # never wait longer than this between checks
+    }
+
+    def __init__(self, statemachine, config=None, sleep=time.sleep):
+        """
+        :param visuals.asset.statemachine.AssetsStateMachine statemachine:
+        :param dict config: overrides for default_config (eg the visuals_availability_polling config value)
+        :param sleep: function used to wait between polls
+        """
+        self.statemachine = statemachine
+        self.config = dict(self.default_config)
+        self.config.update(config or {})
+        self.sleep = sleep
+        self.pending = {}
+        """{(asset_id, AssetLocation): VisualAsset} collected since the last run()"""
+
+    def collect(self, assets):
+        """
+        :param list assets: list of VisualAsset to request and/or poll during the next run()
+        """
+        for asset in assets:
+            self.pending[(asset.id, asset.location)] = asset
+
+    @staticmethod
+    def needs_polling(state):
+        """
+        :param visuals.asset.statemachine.AssetState state:
+        :return bool: Whether the asset is not (really) available yet, and did not fail
+        """
+        return not state.error and (not state.available or state.placeholder)
+
+    def is_pending(self, asset):
+        """
+        :param visuals.asset.visual_asset_bridge.VisualAsset asset: an asset after run()
+        :return bool: Whether a backend may still make the asset available (so it is polled in the next build)
+        """
+        return self.needs_polling(asset.state) and self.statemachine.router.route(asset) is not None
+
+    @staticmethod
+    def snapshot(state):
+        return state.available, state.placeholder, state.downloaded, state.uri
+
+    def run(self):
+        """
+        Request and poll everything that was collected, in as few backend calls as possible.
+        :return list: the assets whose state changed (their docs have to be written again)
+        """
+        sm = self.statemachine
+        assets = [self.pending[key] for key in sorted(self.pending)]
+        self.pending = {}
+        if not assets:
+            return assets
+        before = [self.snapshot(asset.state) for asset in assets]
+
+        definitions = [asset for asset in assets if not asset.is_ref and not asset.state.requested]
+        sm.request_asset_generation(definitions)
+        requested = set(definitions)
+        routed = [asset for asset in assets if sm.router.route(asset) is not None]
+        sm.ensure_available([asset for asset in routed
+                             if asset not in requested and self.needs_polling(asset.state)])
+
+        delay = self.config['initial_delay']
+        for attempt in range(1, self.config['attempts']):
+            not_available = [asset for asset in routed if self.needs_polling(asset.state)]
+            if not not_available:
+                break
+            self.sleep(delay)
+            delay = min(delay * self.config['factor'], self.config['max_delay'])
+            sm.ensure_available(not_available)
+
+        sm.mark_for_placeholder_on_unavailable(assets)
+        sm.request_placeholders(assets)
+        sm.retrieve_oembed_or_download(assets)
+        return [asset for asset, state in zip(assets, before) if self.snapshot(asset.state) != state]
@@ -8,7 +8,16 @@
     :copyright: Copyright 2015 by the contributors, see AUTHORS.
     :license: BSD, see LICENSE for details.
 """
+import asyncio
+
+# The backends register themselves as subclasses of AssetBackend when they are imported.
+import visuals.asset.backends.dummy  # noqa: F401
+import visuals.asset.backends.placeholder  # noqa: F401
+import visuals.asset.backends.visuals  # noqa: F401
 from visuals.asset.backends import AssetBackend
+from visuals.asset.routing import BackendRouter
+from visuals.asset.statetable import AssetStateTable
+from visuals.instrumentation import recorder
 
 
 class AssetState(object):
@@ -26,6 +35,38 @@ class AssetState(object):
         self.downloaded = False
         self.placeholder = False
         self.error = None
+        self.uri = None
+        self.checksum = None
+
+    def copy_from(self, other):
+        """
+        :param other: an AssetState (or AssetStateRow) to copy the values from
+        """
+        self.requested = other.requested
+        self.available = other.available
+        self.downloaded = other.downloaded
+        self.placeholder = other.placeholder
+        self.error = other.error
+        self.uri = other.uri
+        self.checksum = other.checksum
+
+
+def set_flag(assets, name, value):
+    """
+    Set one state flag on many assets. If all of their states are rows of one AssetStateTable,
+    this is a single vectorized assignment instead of a loop.
+
+    :param assets: iterable of VisualAsset
+    :param str name: requested, available, downloaded, or placeholder
+    :param bool value:
+    """
+    assets = list(assets)
+    table, rows = AssetStateTable.rows_of(assets)
+    if table is not None:
+        table.set_flag(rows, name, value)
+        return
+    for asset in assets:
+        setattr(asset.state, name, value)
 
 
 class AssetsStateMachine(object):
@@ -43,7 +84,6 @@ class AssetsStateMachine(object):
 
         backends = [
             (backend.priority, backend)
-            # TODO: Make sure that the subclasses are already imported
             for backend in AssetBackend.__subclasses__()  # Only supports one level of subclasses
             if backend.is_enabled(self.backends_config.get(backend.name, {}))
             ]
@@ -53,35 +93,153 @@ class AssetsStateMachine(object):
         for priority, backend in backends:
             self.backends.append(backend(self))
 
+        self.router = BackendRouter(self.backends)
+        """Assigns each asset to one of self.backends"""
+
+        self.cache = None
+        """:type self.cache: visuals.asset.cache.AssetCache (injected by the consumer, if enabled)"""
+
+        self.downloader = None
+        """:type self.downloader: visuals.asset.download.AssetDownloader (injected by the consumer, if enabled)"""
+
+        self.oembed = None
+        """:type self.oembed: visuals.asset.oembed.OEmbedResolver (injected by the consumer, if enabled)"""
+
     def request_asset_generation(self, asset_defs):
+        asyncio.run(self.request_asset_generation_async(list(asset_defs)))
+
+    async def request_asset_generation_async(self, asset_defs):
+        self.restore_from_cache(asset_defs)
         # This should make requests (GET w/ content hash & PUT w/ content)
-        for backend in self.backends:
-            not_requested = [asset for asset in list(asset_defs) if not asset.state.requested]
-            # Each backend should mark each asset as requested, if it can handle the asset.
-            # The next backend will request any of the remainder.
-            # TODO: more robust backend selection per asset (by type or through config)
-            backend.request_generation(not_requested)
-            backend.check_availability(asset_defs)
+        # Each asset goes to one backend (see BackendRouter), so each backend only gets its own assets,
+        # and the backends run concurrently.
+        await asyncio.gather(*[self.request_and_check(backend, assets)
+                               for backend, assets in self.router.group(asset_defs)])
+        self.store_in_cache(asset_defs)
+
+    async def request_and_check(self, backend, assets):
+        """
+        Request generation of the assets that were not requested yet, then check all of them.
+        """
+        not_requested = [asset for asset in assets if not asset.state.requested]
+        await self.dispatch(backend, backend.request_generation_async, not_requested)
+        await self.dispatch(backend, backend.check_availability_async, assets)
+
+    def request_placeholders(self, assets):
+        """
+        Have the placeholder backends (see AssetBackend.provides_placeholders) handle
+        the assets that need a placeholder. Placeholder backends don't make network calls.
+        """
+        asyncio.run(self.request_placeholders_async([asset for asset in assets if asset.state.placeholder]))
+
+    async def request_placeholders_async(self, assets):
+        async def request_and_check(backend):
+            await self.dispatch(backend, backend.request_generation_async, assets)
+            await self.dispatch(backend, backend.check_availability_async, assets)
+
+        await asyncio.gather(*[request_and_check(backend) for backend in self.router.placeholder_backends])
 
     def ensure_available(self, assets):
-        for backend in self.backends:
-            not_available = []
-            for asset in list(assets):
-                """:type asset: visuals.asset.visual_asset_bridge.VisualAsset"""
-                """:type asset.state: AssetState"""
-                if not asset.state.available or (asset.state.available and asset.state.placeholder):
-                    not_available.append(asset)
-            backend.check_availability(not_available)
+        asyncio.run(self.ensure_available_async(list(assets)))
 
-    def retrieve_oembed_or_download(self, assets):
+    async def ensure_available_async(self, assets):
+        not_available = []
         for asset in assets:
-            asset.node
-            # TODO:2 oembed or download
-            pass
+            """:type asset: visuals.asset.visual_asset_bridge.VisualAsset"""
+            """:type asset.state: AssetState"""
+            if not asset.state.available or (asset.state.available and asset.state.placeholder):
+                not_available.append(asset)
+        # A placeholder is 'available' (see PlaceholderBackend). To see whether the routed backend
+        # has the real asset by now, check it as unavailable, and drop the placeholder if it is available.
+        placeholders = [asset for asset in not_available if asset.state.placeholder]
+        self.mark_not_available(placeholders)
+        await asyncio.gather(*[self.dispatch(backend, backend.check_availability_async, backend_assets)
+                               for backend, backend_assets in self.router.group(not_available)])
+        self.placeholder_not_needed([asset for asset in placeholders if asset.state.available])
+        self.store_in_cache(assets)
+
+    def restore_from_cache(self, assets):
+        """
+        Mark assets that were resolved in a previous build (possibly in another checkout)
+        as requested and available, so the backends don't need to handle them again.
+        """
+        if self.cache is None:
+            return
+        for asset in assets:
+            if asset.state.available and not asset.state.placeholder:
+                continue
+            backend = self.router.route(asset)
+            if backend is None:
+                continue
+            entry = self.cache.get(self.cache.make_key(asset, backend))
+            if entry is None or not entry.get('uri'):
+                continue
+            asset.state.uri = entry['uri']
+            asset.state.requested = asset.state.available = True
+            asset.state.placeholder = False
+
+    def store_in_cache(self, assets):
+        if self.cache is None:
+            return
+        for asset in assets:
+            backend = self.router.route(asset)
+            if backend is not None and asset.state.available and asset.state.uri and not asset.state.placeholder:
+                self.cache.put(self.cache.make_key(asset, backend), asset.state.uri)
+
+    @staticmethod
+    async def dispatch(backend, method, assets):
+        """
+        Split assets into batches of backend.batch_size, and pass them to method
+        with at most backend.concurrency batches in-flight at once.
+
+        :param AssetBackend backend: The backend that method belongs to
+        :param method: An async method of backend that takes a list of assets
+        :param list assets: The assets to process
+        """
+        if not assets:
+            return
+        semaphore = asyncio.Semaphore(backend.concurrency)
+        timer_name = 'backend.{0}.{1}'.format(backend.name, method.__name__) if recorder.enabled else None
+
+        async def run_batch(batch):
+            async with semaphore:
+                with recorder.timer(timer_name):
+                    await method(batch)
+                recorder.count(timer_name and timer_name + '.assets', len(batch))
+
+        batches = [assets[start:start + backend.batch_size]
+                   for start in range(0, len(assets), backend.batch_size)]
+        await asyncio.gather(*[run_batch(batch) for batch in batches])
+
+    def uses_oembed(self, asset):
+        """
+        :param visuals.asset.visual_asset_bridge.VisualAsset asset:
+        :return bool: Whether the asset's uri should be resolved with oEmbed
+        """
+        if self.oembed is None or not asset.state.available or not asset.state.uri or asset.state.placeholder:
+            return False
+        backend = self.router.route(asset)
+        return backend is not None and backend.use_oembed
+
+    def retrieve_oembed_or_download(self, assets):
+        """
+        Resolve oEmbed payloads (each uri once, see OEmbedResolver) and download assets (if enabled).
+        This runs before writing, so that get_oembed does not need the network.
+        """
+        assets = list(assets)
+        if self.oembed is not None:
+            self.oembed.resolve_all([asset.state.uri for asset in assets if self.uses_oembed(asset)])
+        if self.downloader is not None:
+            self.downloader.download_all(assets)
 
     def get_oembed(self, asset):
-        # TODO:2 oembed
-        pass
+        """
+        :param visuals.asset.visual_asset_bridge.VisualAsset asset:
+        :return dict: The oEmbed payload resolved by retrieve_oembed_or_download, or None
+        """
+        if not self.uses_oembed(asset):
+            return None
+        return self.oembed.cached(asset.state.uri)
 
     def mark_for_placeholder_on_unavailable(self, assets):
         needs_placeholder = [asset for asset in list(assets) if not asset.state.available]
@@ -89,43 +247,35 @@ class AssetsStateMachine(object):
 
     @staticmethod
     def placeholder_needed(assets):
-        for asset in list(assets):
-            asset.state.placeholder = True
+        set_flag(assets, 'placeholder', True)
 
     @staticmethod
     def placeholder_not_needed(assets):
-        for asset in list(assets):
-            asset.state.placeholder = False
+        set_flag(assets, 'placeholder', False)
 
     @staticmethod
     def mark_requested(assets):
-        for asset in list(assets):
-            asset.state.requested = True
+        set_flag(assets, 'requested', True)
 
     @staticmethod
     def mark_not_requested(assets):
-        for asset in list(assets):
-            asset.state.requested = False
+        set_flag(assets, 'requested', False)
 
     @staticmethod
     def mark_available(assets):
-        for asset in list(assets):
-            asset.state.available = True
+        set_flag(assets, 'available', True)
 
     @staticmethod
     def mark_not_available(assets):
-        for asset in list(assets):
-            asset.state.available = False
+        set_flag(assets, 'available', False)
 
     @staticmethod
     def mark_downloaded(assets):
-        for asset in list(assets):
-            asset.state.downloaded = True
+        set_flag(assets, 'downloaded', True)
 
     @staticmethod
     def mark_not_downloaded(assets):
-        for asset in list(assets):
-            asset.state.downloaded = False
+        set_flag(assets, 'downloaded', False)
 
     @staticmethod
     def clear_errors(assets):
@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+"""
+    visuals.asset.statetable
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    An optional columnar (NumPy) store for asset state.
+
+    :copyright: Copyright 2015 by the contributors, see AUTHORS.
+    :license: BSD, see LICENSE for details.
+"""
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+numpy_available = numpy is not None
+
+FLAG_COLUMNS = {'requested': 0, 'available': 1, 'downloaded': 2, 'placeholder': 3}
+"""The boolean AssetState attributes, and their row in AssetStateTable.flags"""
+
+
+class AssetStateRow(object):
+    """
+    A handle to one row of an AssetStateTable.
+
+    This has the same attributes as AssetState, so it can be used anywhere an AssetState is.
+    """
+    __slots__ = ('table', 'row')
+
+    def __init__(self, table, row):
+        self.table = table
+        self.row = row
+
+    def __reduce__(self):
+        return self.__class__, (self.table, self.row)
+
+    def _get_flag(name):
+        column = FLAG_COLUMNS[name]
+
+        def get_flag(self):
+            return bool(self.table.flags[column, self.row])
+
+        def set_flag(self, value):
+            self.table.flags[column, self.row] = value
+
+        return property(get_flag, set_flag)
+
+    requested = _get_flag('requested')
+    available = _get_flag('available')
+    downloaded = _get_flag('downloaded')
+    placeholder = _get_flag('placeholder')
+    del _get_flag
+
+    @property
+    def error(self):
+        return self.table.errors.get(self.row)
+
+    @error.setter
+    def error(self, value):
+        if value is None:
+            self.table.errors.pop(self.row, None)
+        else:
+            self.table.errors[self.row] = value
+
+    @property
+    def uri(self):
+        return self.table.uris.get(self.row)
+
+    @uri.setter
+    def uri(self, value):
+        if value is None:
+            self.table.uris.pop(self.row, None)
+        else:
+            self.table.uris[self.row] = value
+
+    @property
+    def checksum(self):
+        return self.table.checksums.get(self.row)
+
+    @checksum.setter
+    def checksum(self, value):
+        if value is None:
+            self.table.checksums.pop(self.row, None)
+        else:
+            self.table.checksums[self.row] = value
+
+    def copy_from(self, other):
+        """
+        :param other: an AssetState or AssetStateRow to copy the values from
+        """
+        for name in FLAG_COLUMNS:
+            setattr(self, name, getattr(other, name))
+        self.error = other.error
+        self.uri = other.uri
+        self.checksum = other.checksum
+
+    def release(self):
+        self.table.release(self.row)
+
+
+class AssetStateTable(object):
+    """
+    Columnar storage for the state of many assets.
+
+    Flags are rows of a NumPy boolean array, indexed by the asset's row number, so bulk
+    transitions (set_flag) and queries (count, rows_where) are vectorized.
+    Errors, uris and checksums are rare, so they are kept in sparse {row: value} dicts.
+    When pickled, the flags are bit-packed, which is far smaller than one AssetState object per asset.
+
+    Use new_row as the state factory: it returns an AssetStateRow.
+    """
+
+    flag_columns = FLAG_COLUMNS
+
+    def __init__(self, capacity=1024):
+        if not numpy_available:
+            raise ImportError('AssetStateTable requires numpy')
+        self.flags = numpy.zeros((len(self.flag_columns), capacity), dtype=bool)
+        self.live = numpy.zeros(capacity, dtype=bool)
+        self.errors = {}
+        self.uris = {}
+        self.checksums = {}
+        self.free = []
+        self.size = 0
+
+    def __getstate__(self):
+        return {
+            'flags': numpy.packbits(self.flags[:, :self.size], axis=1),
+            'live': numpy.packbits(self.live[:self.size]),
+            'errors': self.errors,
+            'uris': self.uris,
+            'checksums': self.checksums,
+            'free': self.free,
+            'size': self.size,
+        }
+
+    def __setstate__(self, state):
+        self.size = state['size']
+        capacity = max(self.size, 1024)
+        self.flags = numpy.zeros((len(self.flag_columns), capacity), dtype=bool)
+        self.flags[:, :self.size] = numpy.unpackbits(state['flags'], axis=1, count=self.size)
+        self.live = numpy.zeros(capacity, dtype=bool)
+        self.live[:self.size] = numpy.unpackbits(state['live'], count=self.size)
+        self.errors = state['errors']
+        self.uris = state['uris']
+        self.checksums = state['checksums']
+        self.free = state['free']
+
+    def new_row(self):
+        """
+        :return AssetStateRow: a handle to a new row with all flags off.
+        """
+        if self.free:
+            row = self.free.pop()
+        else:
+            if self.size == self.live.shape[0]:
+                self._grow()
+            row = self.size
+            self.size += 1
+        self.flags[:, row] = False
+        self.live[row] = True
+        return AssetStateRow(self, row)
+
+    def _grow(self):
+        capacity = self.live.shape[0] * 2
+        flags = numpy.zeros((len(self.flag_columns), capacity), dtype=bool)
+        flags[:, :self.size] = self.flags[:, :self.size]
+        live = numpy.zeros(capacity, dtype=bool)
+        live[:self.size] = self.live[:self.size]
+        self.flags, self.live = flags, live
+
+    def release(self, row):
+        if self.live[row]:
+            self.live[row] = False
+            self.errors.pop(row, None)
+            self.uris.pop(row, None)
+            self.checksums.pop(row, None)
+            self.free.append(row)
+
+    def set_flag(self, rows, name, value):
+        """
+        :param list rows: row numbers
+        :param str name: requested, available, downloaded, or placeholder
+        :param bool value:
+        """
+        self.flags[self.flag_columns[name], numpy.asarray(rows, dtype=numpy.intp)] = value
+
+    def rows_where(self, name, value=True):
+        """
+        :return numpy.ndarray: row numbers of the live rows where flag name is value
+        """
+        column = self.flags[self.flag_columns[name], :self.size]
+        return numpy.flatnonzero((column == value) & self.live[:self.size])
+
+    def count(self, name, value=True):
+        """
+        :return int: number of live rows where flag name is value (eg count('placeholder'))
+        """
+        return len(self.rows_where(name, value))
+
+    def adopt(self, state):
+        """
+        Get a state that lives in this table, with the values of state.
+        Use this when merging state from another process (eg a parallel worker), whose rows are in its own table.
+
+        :param state: an AssetState, or an AssetStateRow of any table
+        :return AssetStateRow: state itself if it is a row of this table, else a new row with its values
+        """
+        if isinstance(state, AssetStateRow) and state.table is self:
+            return state
+        row = self.new_row()
+        row.copy_from(state)
+        return row
+
+    @staticmethod
+    def rows_of(assets):
+        """
+        If every asset's state is a row in the same table, return (table, rows). Else (None, None).
+
+        :param list assets: list of VisualAsset
+        """
+        table = None
+        rows = []
+        for asset in assets:
+            state = asset.state
+            if not isinstance(state, AssetStateRow) or (table is not None and state.table is not table):
+                return None, None
+            table = state.table
+            rows.append(state.row)
+        return table, rows
+
+
+def pack_states(states):
+    """
+    A compact, picklable form of a list of states (see unpack_states).
+
+    Rows of one AssetStateTable become the table plus their row numbers as int32 bytes,
+    instead of one pickled (AssetStateRow, (table, row)) reduce tuple per row.
+
+    :param list states: AssetStates, AssetStateRows, or anything else that can be pickled
+    :return tuple:
+    """
+    table = None
+    rows = []
+    for state in states:
+        if not isinstance(state, AssetStateRow) or (table is not None and state.table is not table):
+            return 'values', list(states)
+        table = state.table
+        rows.append(state.row)
+    if table is None:
+        return 'values', list(states)
+    return 'rows', table, numpy.asarray(rows, dtype=numpy.int32).tobytes()
+
+
+def unpack_states(packed):
+    """
+    :param tuple packed: from pack_states
+    :return list: the states
+    """
+    if packed[0] == 'rows':
+        table, rows = packed[1:]
+        return [AssetStateRow(table, int(row)) for row in numpy.frombuffer(rows, dtype=numpy.int32)]
+    return packed[1]
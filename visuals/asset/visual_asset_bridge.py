@@ -8,8 +8,6 @@
     :copyright: Copyright 2015 by the contributors, see AUTHORS.
     :license: BSD, see LICENSE for details.
 """
-import hashlib
-
 from visuals.asset import AssetLocation
 from visuals.asset.statemachine import AssetState
 
@@ -32,14 +30,14 @@ class AssetOptionsDict(dict):
         # Figure directive:
         'figwidth', 'figclass',
         # Visual directive
-        'caption', 'type'
+        'caption', 'type', 'backend'
     ]
     # NOTE: This is specific to how it's used in visuals.
     #       Make it more general if needed.
 
     def __init__(self, options):
         assert isinstance(options, dict)
-        filtered = set(options.keys()) - set(self.filtered_keys)
+        filtered = set(options.keys()) & set(self.filtered_keys)
         options_filtered = options.copy()
         for filtered_key in filtered:
             del options_filtered[filtered_key]
@@ -55,21 +53,105 @@ class VisualAsset(object):
 
     This is not meant to be persisted, but is an in-memory
     representation to help with node processing.
+
+    Use VisualAsset.for_node(node) instead of VisualAsset(node):
+    it hands out one shared VisualAsset per asset instance for the whole build.
+    For docs whose doctree is not at hand, VisualAsset.for_location builds one from the assets dict
+    (its node is None until for_node gets the node).
     """
+    __slots__ = ('node', 'is_ref', 'content_hash', 'id', 'type', 'options', 'backend', 'location', 'state')
+
     # Variables that should be common across instances
     assets = None
     """:type assets: visuals.asset.AssetsDict"""
     assets_state = None
     """:type assets_state: visuals.asset.AssetsMetadataDict"""
+    registry = {}
+    """The per-build flyweight registry: {docname: {(asset_id, instance): VisualAsset}}"""
+    state_factory = AssetState
+    """Creates new state entries: AssetState, or AssetStateTable.new_row for the columnar store."""
+    content_store = None
+    """:type content_store: visuals.asset.content.ContentStore (where the content of definitions is kept)"""
 
     @classmethod
     def class_init(cls, assets, assets_state):
         cls.assets = assets
         cls.assets_state = assets_state
+        cls.registry = {}
+
+    @classmethod
+    def for_node(cls, node):
+        """
+        Get the VisualAsset for node, reusing the one from an earlier phase if possible.
+
+        Doctrees get unpickled (or deep copied) between phases, so the node changes each time,
+        but the asset instance it represents (asset_id, AssetLocation) does not.
+
+        :param visual node: The visual node.
+        :return VisualAsset:
+        """
+        if 'instance' in node:
+            asset = cls.registry.get(node['docname'], {}).get((node['visualid'], node['instance']))
+            if asset is not None:
+                asset.node = node
+                asset.type = node['type']  # reference types can be fixed after the asset was created
+                return asset
+        asset = cls(node)
+        cls.registry.setdefault(asset.location.docname, {})[(asset.id, asset.location.instance)] = asset
+        return asset
+
+    @classmethod
+    def for_location(cls, asset_id, location):
+        """
+        Get the VisualAsset for an asset instance that is already in the assets dict, without its node.
+        This is how assets of docs that were not read or processed in this build get polled.
+
+        :param str asset_id: The asset id
+        :param AssetLocation location: The location of the instance
+        :return VisualAsset:
+        """
+        asset = cls.registry.get(location.docname, {}).get((asset_id, location.instance))
+        if asset is not None:
+            return asset
+        if not cls.class_is_inited():
+            raise Exception('Class was not inited with cls.class_init(...), init it first')
+
+        asset = cls.__new__(cls)
+        asset.node = None
+        asset.id = asset_id
+        asset.location = location
+        asset_type, asset.content_hash, asset.backend = cls.assets.get_info(asset_id, location)
+        asset.is_ref = not asset.content_hash  # like visual.is_ref()
+        # reference types get fixed to the definition's type (see fix_types_on_visual_references)
+        asset.type = cls.assets.get_type(asset_id) or asset_type
+        asset.options = cls.assets.get_options(asset_id, location)
+        asset._init_state()
+        cls.registry.setdefault(location.docname, {})[(asset_id, location.instance)] = asset
+        return asset
+
+    @classmethod
+    def forget_docs(cls, docnames):
+        """
+        Drop the registered VisualAssets of docnames.
+        Use this whenever the assets or assets_state entries of those docs are purged or replaced.
+
+        :param list docnames: The docnames to forget
+        """
+        for docname in docnames:
+            cls.registry.pop(docname, None)
+
+    @property
+    def content(self):
+        """
+        :return list: The lines of the definition's content (loaded from content_store), or None
+        """
+        if self.is_ref or self.content_store is None:
+            return None
+        return self.content_store.get(self.content_hash)
 
     @classmethod
     def class_is_inited(cls):
-        return bool(cls.assets and cls.assets_state)
+        return cls.assets is not None and cls.assets_state is not None
 
     def __init__(self, node):
         """
@@ -83,30 +165,33 @@ class VisualAsset(object):
 
         self.is_ref = node.is_ref()
 
-        if not self.is_ref:
-            self.content = node['content_block']
-            # content_hash needs to be consistent across Python, PHP, JavaScript, Java, and ...
-            self.content_hash = hashlib.md5(self.content)
-
         self.id = node['visualid']
         self.type = node['type']
         docname = node['docname']
-        self.options = AssetOptionsDict(node.options)
+        # Visual.run stores the options that are relevant for generation on the node.
+        self.options = node.get('options') or AssetOptionsDict({})
+        self.backend = node.get('backend')
+
+        # The fingerprint is computed once (in Visual.run); the content is in content_store.
+        self.content_hash = node.get('content_hash') or None
         # once initialized with add_asset (below), this can also be retrieved with:
         # assets.get_options(self.id, self.location)
 
         if 'instance' not in node:  # Then the node has not been registered in assets.
 
-            self.assets.add_asset(docname, self.id, self.options, self.type, self.is_ref)
+            self.assets.add_asset(docname, self.id, self.options, self.type, self.is_ref,
+                                  content_hash=self.content_hash, backend=self.backend)
 
             # Make the instance number accessible when parsing the tree
-            node['instance'] = len(self.assets.get_instances(self.id, docname))
+            node['instance'] = len(self.assets.get_instances(self.id, docname)) - 1
             # Note: every time a doc is purged, all instances in that doc are purged.
             # So, instance numbers should be consistent across runs, based on source order.
             # Since each doc is processed at once, this ordering should be ok in parallel.
 
         self.location = AssetLocation(docname, node['instance'])
+        self._init_state()
 
+    def _init_state(self):
         # Since assets was just barely populated, assets_state will only be populated if it was
         # pickled with a previous run. Getting now probably won't work, so set it if needed.
         asset_state_key = (self.id, self.location)
@@ -116,6 +201,6 @@ class VisualAsset(object):
 
         if self.state is None:
             if self.is_ref:
-                self.state = self.assets_state.refs.setdefault(asset_state_key, AssetState())
+                self.state = self.assets_state.refs.setdefault(asset_state_key, self.state_factory())
             else:
-                self.state = self.assets_state.defs.setdefault(asset_state_key, AssetState())
\ No newline at end of file
+                self.state = self.assets_state.defs.setdefault(asset_state_key, self.state_factory())
\ No newline at end of file
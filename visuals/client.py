@@ -1,26 +1,224 @@
 # -*- coding: utf-8 -*-
 """
-    sphinx.util
-    ~~~~~~~~~~~
+    visuals.client
+    ~~~~~~~~~~~~~~
 
-    Utility functions for Sphinx.
+    Client for the visuals web service.
 
-    :copyright: Copyright 2007-2015 by the Sphinx team, see AUTHORS.
+    :copyright: Copyright 2015 by the contributors, see AUTHORS.
     :license: BSD, see LICENSE for details.
 """
 
+import json
+import threading
+from http import client as http_client
+from urllib.parse import urlsplit
+
+retried_errors = (ConnectionRefusedError, ConnectionResetError, BrokenPipeError, http_client.RemoteDisconnected)
+"""Errors after which the server cannot have handled a request (eg a pooled connection went stale)"""
+
+
+class VisualsClientError(Exception):
+    """Raised when the visuals web service can't be reached or returns an error."""
+
+
+def asset_key(asset):
+    """
+    A string that identifies one asset instance in requests to, and responses from, the web service.
+
+    :param visuals.asset.visual_asset_bridge.VisualAsset asset:
+    :return str:
+    """
+    return '{0}#{1}:{2}'.format(asset.location.docname, asset.location.instance, asset.id)
+
+
+def asset_payload(asset):
+    """
+    The JSON-serializable description of an asset that gets sent to the web service.
+
+    :param visuals.asset.visual_asset_bridge.VisualAsset asset:
+    :return dict:
+    """
+    payload = {
+        'key': asset_key(asset),
+        'id': asset.id,
+        'type': asset.type,
+        'options': dict(asset.options),
+    }
+    if not asset.is_ref:
+        payload['content_hash'] = asset.content_hash
+    return payload
+
+
+class ConnectionPool(object):
+    """
+    A small pool of persistent (keep-alive) HTTP/1.1 connections to one host.
+
+    Connections are reused until the server closes them, so a build only pays for
+    one TCP (+TLS) handshake per pooled connection instead of one per request.
+    """
+
+    def __init__(self, base_uri, size=4, timeout=30):
+        """
+        :param str base_uri: eg https://visuals.example.com/api
+        :param int size: Maximum number of idle connections kept open
+        :param int timeout: Socket timeout in seconds
+        """
+        parts = urlsplit(base_uri)
+        if parts.scheme == 'https':
+            self.connection_class = http_client.HTTPSConnection
+        elif parts.scheme == 'http':
+            self.connection_class = http_client.HTTPConnection
+        else:
+            raise VisualsClientError('Unsupported uri scheme for visuals client: {0!r}'.format(base_uri))
+        self.host = parts.netloc
+        self.path = parts.path.rstrip('/')
+        self.size = size
+        self.timeout = timeout
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _acquire(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return self.connection_class(self.host, timeout=self.timeout)
+
+    def _release(self, connection):
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append(connection)
+                return
+        connection.close()
+
+    def request(self, method, path, body=None):
+        """
+        Send a JSON request and return the decoded JSON response.
+
+        A request is retried once, on a new connection, only if the connection was refused, reset or
+        broken (eg the server closed a pooled connection while it was idle): then the server did not handle it.
+        Other failures, such as timeouts, are not retried, because POST /assets/generate is not idempotent.
+
+        :param str method: HTTP method
+        :param str path: path relative to the base_uri
+        :param body: JSON-serializable request body
+        :return: decoded JSON response
+        """
+        data = json.dumps(body).encode('utf-8') if body is not None else None
+        headers = {'Content-Type': 'application/json', 'Accept': 'application/json'}
+
+        for attempt in (1, 2):
+            connection = self._acquire()
+            try:
+                connection.request(method, self.path + path, body=data, headers=headers)
+                response = connection.getresponse()
+                payload = response.read()  # read it all so the connection can be reused
+            except retried_errors as err:
+                connection.close()
+                if attempt == 2:
+                    raise VisualsClientError('{0} {1} failed: {2}'.format(method, path, err))
+                continue
+            except (http_client.HTTPException, OSError) as err:
+                connection.close()
+                raise VisualsClientError('{0} {1} failed: {2}'.format(method, path, err))
+
+            if response.will_close:
+                connection.close()
+            else:
+                self._release(connection)
+
+            if response.status >= 400:
+                raise VisualsClientError('{0} {1} returned {2} {3}'.format(
+                    method, path, response.status, response.reason))
+            if not payload:
+                return None
+            try:
+                return json.loads(payload.decode('utf-8'))
+            except ValueError as err:  # incl. UnicodeDecodeError
+                raise VisualsClientError('{0} {1} returned a response that is not JSON: {2}'.format(
+                    method, path, err))
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
+
 
 class VisualsClient(object):
     """
-    Client for the visuals API. A dummy for now.
+    Client for the visuals API.
+
+    The API has bulk endpoints that take many assets per request:
+        POST <base_uri>/assets/generate  {"assets": [asset_payload, ...]}
+        POST <base_uri>/assets/status    {"keys": [asset_key, ...], "cursor": null}
+
+    Both respond with:
+        {"assets": [{"key": ..., "status": ..., "uri": ..., "error": ...}, ...], "next": cursor}
+
+    Assets are sent in chunks of batch_size. If the service paginates a response,
+    "next" is a cursor that gets sent back (with the same chunk) to get the next page.
+    A cursor that comes back twice, or more than max_pages pages for one chunk, is a VisualsClientError.
     """
-    def __init__(self):
-        pass
+
+    max_pages = 1000
+    """Maximum number of pages of one response"""
+
+    def __init__(self, base_uri, pool_size=4, batch_size=100, timeout=30):
+        """
+        :param str base_uri: eg https://visuals.example.com/api
+        :param int pool_size: Maximum number of persistent connections kept open
+        :param int batch_size: Maximum number of assets sent in one request
+        :param int timeout: Socket timeout in seconds
+        """
+        self.pool = ConnectionPool(base_uri, size=pool_size, timeout=timeout)
+        self.batch_size = batch_size
+
+    def request(self, assets):
+        """
+        Request generation of the given assets.
+
+        :param list assets: list of VisualAsset
+        :return dict: {asset_key: result} where result is a dict with status, uri, and error
+        """
+        return self._bulk('/assets/generate', 'assets', [asset_payload(asset) for asset in assets])
+
+    def check_availability(self, assets):
+        """
+        Get the current status of the given assets.
+
+        :param list assets: list of VisualAsset
+        :return dict: {asset_key: result} where result is a dict with status, uri, and error
+        """
+        return self._bulk('/assets/status', 'keys', [asset_key(asset) for asset in assets])
+
+    def _bulk(self, path, field, items):
+        results = {}
+        for start in range(0, len(items), self.batch_size):
+            chunk = items[start:start + self.batch_size]
+            cursor = None
+            seen = set()
+            while True:
+                response = self.pool.request('POST', path, {field: chunk, 'cursor': cursor})
+                if not isinstance(response, dict):
+                    raise VisualsClientError('POST {0} returned an unexpected response: {1!r}'.format(path, response))
+                for result in response.get('assets', []):
+                    if isinstance(result, dict) and 'key' in result:
+                        results[result['key']] = result
+                cursor = response.get('next')
+                if cursor is None:
+                    break
+                seen_key = json.dumps(cursor, sort_keys=True)
+                if seen_key in seen or len(seen) + 1 >= self.max_pages:
+                    raise VisualsClientError('POST {0} does not stop paginating (cursor {1!r})'.format(path, cursor))
+                seen.add(seen_key)
+        return results
+
+    def close(self):
+        self.pool.close()
 
     def geturi(self, visual_node):
         docname = visual_node['docname']
         visualid = visual_node['visualid']
 
         return 'http://placehold.it/500x100?text=' + docname + '.' + '+'.join(visualid.split())
-
-
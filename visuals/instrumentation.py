@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+    visuals.instrumentation
+    ~~~~~~~~~~~~~~~~~~~~~~~
+
+    Opt-in timers and counters for the extension (see the visuals_instrumentation config value).
+
+    :copyright: Copyright 2015 by the contributors, see AUTHORS.
+    :license: BSD, see LICENSE for details.
+"""
+
+import functools
+import time
+
+
+class Timer(object):
+    __slots__ = ('instrumentation', 'name', 'start')
+
+    def __init__(self, instrumentation, name):
+        self.instrumentation = instrumentation
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.instrumentation.add_time(self.name, time.perf_counter() - self.start)
+
+
+class NullTimer(object):
+    """Used instead of a Timer when instrumentation is off."""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+null_timer = NullTimer()
+
+
+class Instrumentation(object):
+    """
+    Wall time and call counts per timer name, plus plain counters.
+
+    When it is not enabled, timer() returns a shared no-op context manager and count() returns
+    immediately, so instrumented code only pays for one attribute check.
+
+    Timer names:
+        event.<handler>                   the event_* handlers in visuals.sphinx_ext
+        backend.<name>.<method>           each batch passed to an AssetBackend method
+        doctree.unpickle, doctree.re_pickle  in event_env_updated
+    Counters:
+        backend.<name>.<method>.assets    number of assets passed to an AssetBackend method
+        cache.hits, cache.misses          AssetCache lookups
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.timers = {}
+        """{name: [calls, seconds]}"""
+        self.counters = {}
+        """{name: count}"""
+
+    def reset(self, enabled):
+        self.enabled = enabled
+        self.timers = {}
+        self.counters = {}
+
+    def timer(self, name):
+        """
+        :param str name: the timer to add the time spent in the with block to
+        :return: a context manager
+        """
+        return Timer(self, name) if self.enabled else null_timer
+
+    def add_time(self, name, seconds, calls=1):
+        timer = self.timers.get(name)
+        if timer is None:
+            timer = self.timers[name] = [0, 0.0]
+        timer[0] += calls
+        timer[1] += seconds
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def snapshot(self):
+        """
+        :return dict: the timers and counters, to be merged into the main process (see merge)
+        """
+        return {'timers': dict((name, list(timer)) for name, timer in self.timers.items()),
+                'counters': dict(self.counters)}
+
+    def merge(self, snapshot):
+        """
+        :param dict snapshot: from snapshot() in a worker process
+        """
+        for name, (calls, seconds) in snapshot['timers'].items():
+            self.add_time(name, seconds, calls)
+        for name, n in snapshot['counters'].items():
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def report(self, **extra):
+        """
+        :return dict: a JSON-serializable report
+        """
+        report = {
+            'timers': dict((name, {'calls': calls, 'seconds': seconds})
+                           for name, (calls, seconds) in sorted(self.timers.items())),
+            'counters': dict(sorted(self.counters.items())),
+        }
+        report.update(extra)
+        return report
+
+
+recorder = Instrumentation()
+"""The Instrumentation used by the extension (reset in event_builder_inited)"""
+
+
+def instrumented(function):
+    """
+    Decorator that records the calls of function in recorder, as event.<function name>.
+    """
+    name = 'event.' + function.__name__[len('event_'):] if function.__name__.startswith('event_') \
+        else 'event.' + function.__name__
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if not recorder.enabled:
+            return function(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            recorder.add_time(name, time.perf_counter() - start)
+
+    return wrapper
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+    visuals.profiling
+    ~~~~~~~~~~~~~~~~~
+
+    Opt-in CPU (cProfile) and memory (tracemalloc) profiling of the extension's build phases
+    (see the visuals_profile config value).
+
+    :copyright: Copyright 2015 by the contributors, see AUTHORS.
+    :license: BSD, see LICENSE for details.
+"""
+
+import cProfile
+import functools
+import tracemalloc
+from os import path
+
+from visuals.asset.cache import write_atomic
+
+PHASES = ('builder-inited', 'read', 'extra-processing', 'resolved', 'finished')
+"""Phases that can be listed in visuals_profile (see the @profiled handlers in visuals.sphinx_ext, and Visual.run)"""
+
+TOOLS = ('cprofile', 'tracemalloc')
+
+
+class PhaseProfiler(object):
+    """
+    Profiles the handlers of the configured phases (and, for 'read', the visual directive),
+    and writes the results to outdir:
+        visuals-profile-<phase>.prof         cProfile stats (open with pstats or snakeviz)
+        visuals-profile-<phase>-memory.txt   the top allocations made during the phase (tracemalloc)
+
+    cProfile only runs inside the extension's handlers for a phase, so the stats cover the
+    extension, not the rest of Sphinx. tracemalloc runs from the first profiled phase until
+    write(); each phase reports what was allocated (and is still alive) between its first
+    handler and the first handler of the next phase, which is how AssetsDict and
+    AssetsMetadataDict growth shows up.
+
+    Handlers that run in parallel worker processes are not profiled.
+    """
+
+    def __init__(self):
+        self.phases = ()
+        self.tools = ()
+        self.top = 25
+        self.profiles = {}
+        """{phase: cProfile.Profile}"""
+        self.memory = {}
+        """{phase: list of tracemalloc.StatisticDiff}"""
+        self.current_phase = None
+        self._start_snapshot = None
+        self._started_tracemalloc = False
+        self._active = False
+
+    def reset(self, phases, tools=TOOLS, top=25):
+        """
+        :param list phases: phases to profile (see PHASES)
+        :param list tools: 'cprofile' and/or 'tracemalloc'
+        :param int top: number of allocation sites in the memory summaries
+        """
+        self.stop()
+        unknown = set(phases) - set(PHASES) or set(tools) - set(TOOLS)
+        if unknown:
+            raise ValueError('Unknown visuals_profile phase or tool: {0}'.format(', '.join(sorted(unknown))))
+        self.phases = tuple(phases)
+        self.tools = tuple(tools)
+        self.top = top
+        self.profiles = {}
+        self.memory = {}
+
+    def wrap(self, phase, function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if phase not in self.phases or self._active:
+                return function(*args, **kwargs)
+            self._enter_phase(phase)
+            profile = self.profiles.get(phase)
+            self._active = True
+            if profile is not None:
+                profile.enable()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                if profile is not None:
+                    profile.disable()
+                self._active = False
+
+        return wrapper
+
+    def _enter_phase(self, phase):
+        if phase == self.current_phase:
+            return
+        self._finish_phase()
+        self.current_phase = phase
+        if 'cprofile' in self.tools and phase not in self.profiles:
+            self.profiles[phase] = cProfile.Profile()
+        if 'tracemalloc' in self.tools:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._started_tracemalloc = True
+            self._start_snapshot = tracemalloc.take_snapshot()
+
+    def _finish_phase(self):
+        if self.current_phase is not None and self._start_snapshot is not None and tracemalloc.is_tracing():
+            snapshot = tracemalloc.take_snapshot()
+            statistics = snapshot.compare_to(self._start_snapshot, 'lineno')
+            self.memory.setdefault(self.current_phase, []).extend(statistics[:self.top])
+        self.current_phase = None
+        self._start_snapshot = None
+
+    def stop(self):
+        self._finish_phase()
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+            self._started_tracemalloc = False
+
+    def write(self, outdir):
+        """
+        Stop profiling, and write the results to outdir.
+
+        :param str outdir: The builder's output dir
+        :return list: The files that were written
+        """
+        self.stop()
+        written = []
+        for phase, profile in sorted(self.profiles.items()):
+            filename = path.join(outdir, 'visuals-profile-{0}.prof'.format(phase))
+            profile.dump_stats(filename)
+            written.append(filename)
+        for phase, statistics in sorted(self.memory.items()):
+            statistics = sorted(statistics, key=lambda statistic: abs(statistic.size_diff), reverse=True)
+            lines = ['Top {0} allocations during {1} (size and count of blocks still alive at its end)'.format(
+                self.top, phase), '']
+            lines.extend(str(statistic) for statistic in statistics[:self.top])
+            filename = path.join(outdir, 'visuals-profile-{0}-memory.txt'.format(phase))
+            write_atomic(filename, ('\n'.join(lines) + '\n').encode('utf-8'))
+            written.append(filename)
+        return written
+
+
+profiler = PhaseProfiler()
+"""The PhaseProfiler used by the extension (reset in event_builder_inited)"""
+
+
+def profiled(phase):
+    """
+    Decorator that profiles function as part of phase, if that phase is in visuals_profile.
+    """
+    def decorator(function):
+        return profiler.wrap(phase, function)
+    return decorator
@@ -9,21 +9,106 @@
     :license: BSD, see LICENSE for details.
 """
 from visuals.rst.nodes import visual
+from visuals.utils.rst import findall
+
+
+def walk_visuals(doctree):
+    """
+    Walk doctree once (in document order, like traverse), yielding each visual node with its path.
+
+    :param docutils.nodes.document doctree: The doctree of a particular docname in the project
+    :return: iterator of (path, visual node), where path is a tuple of child indexes from doctree
+    """
+    stack = [((), doctree)]
+    while stack:
+        path, node = stack.pop()
+        if isinstance(node, visual):
+            yield path, node
+        children = getattr(node, 'children', ())
+        for position in range(len(children) - 1, -1, -1):
+            stack.append((path + (position,), children[position]))
+
+
+def index_visuals(doctree, register=None):
+    """
+    Record where the visual nodes are in doctree['visuals_index'] (pickled with the doctree),
+    so that later phases can use visuals_in() instead of walking the whole tree again.
+    The visual nodes must have their instance number, so register them first (or pass register).
+
+    :param docutils.nodes.document doctree: The doctree of a particular docname in the project
+    :param register: optional function to call on each visual node before it is indexed
+    :return list: the visual nodes in doctree
+    """
+    index = []
+    visual_nodes = []
+    for path, node in walk_visuals(doctree):
+        if register is not None:
+            register(node)
+        index.append((path, node['visualid'], node.get('instance')))
+        visual_nodes.append(node)
+    doctree['visuals_index'] = index
+    return visual_nodes
+
+
+def visuals_in(doctree):
+    """
+    The visual nodes in doctree, found with doctree['visuals_index'] (see index_visuals).
+
+    Each indexed path must still lead to the same visual (same visualid and instance).
+    If a transform restructured the tree (or there is no index), this falls back to walking the tree.
+
+    :param docutils.nodes.document doctree: The doctree of a particular docname in the project
+    :return list: the visual nodes in doctree, in document order
+    """
+    index = doctree.get('visuals_index')
+    if index is not None:
+        visual_nodes = []
+        for path, visualid, instance in index:
+            node = doctree
+            for position in path:
+                children = node.children
+                if position >= len(children):
+                    node = None
+                    break
+                node = children[position]
+            if not isinstance(node, visual) or node['visualid'] != visualid or node.get('instance') != instance:
+                break
+            visual_nodes.append(node)
+        else:
+            return visual_nodes
+    return list(findall(doctree, visual))
 
 
 def fix_types_on_visual_references(doctree, assets):
     """
     If a visual node is a reference, then node['type'] might be incorrect.
     This makes the definition's type take precedence (if defined)
+
+    This only needs to run on docs that were read, or that reference a definition whose
+    type changed (see AssetsDict.pop_outdated_docs).
     :param docutils.nodes.document doctree: The doctree of a particular docname in the project
     :param assets.AssetsDict assets: The list of all assets in the project
     """
-    for node in doctree.traverse(visual):
+    for node in visuals_in(doctree):
         node_type = assets.get_type(node['visualid'])
         if node_type is None:
             # Then this asset_id doesn't have any definitions.
             # So, leave the defined type as is.
             continue
-        elif node.is_ref():
+        elif node.is_ref() and node['type'] != node_type:
             # All references should match the type on the definition.
             node['type'] = node_type
+            node.mark_dirty()
+
+
+def clear_dirty_visuals(doctree):
+    """
+    :param docutils.nodes.document doctree: The doctree of a particular docname in the project
+    :return bool: True if any visual node was dirty (so the doctree needs to be re-pickled)
+    """
+    dirty = False
+    for node in visuals_in(doctree):
+        if node.dirty:
+            node.dirty = False
+            dirty = True
+    return dirty
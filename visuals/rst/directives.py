@@ -17,10 +17,16 @@ from docutils.parsers.rst.directives.images import Figure, Image
 from docutils.statemachine import StringList
 from sphinx.util.nodes import set_source_info
 
+from visuals.asset.fingerprint import fingerprint
+from visuals.asset.visual_asset_bridge import AssetOptionsDict
+from visuals.profiling import profiled
 from visuals.utils.sphinx import sphinx_emit
-from visuals.utils.rst import set_type_info, make_caption_for_directive, make_dummy_directive, list_directives_in_block
+from visuals.utils.rst import set_type_info, make_caption_for_directive, make_dummy_directive, DirectiveScanner
 from visuals.rst.nodes import visual
 
+legend_scanner = DirectiveScanner(['legend'])
+"""Finds the legend in a visual's content"""
+
 
 class Visual(Figure):
     """
@@ -54,8 +60,10 @@ class Visual(Figure):
     option_spec = Figure.option_spec.copy()
     option_spec['caption'] = directives.unchanged
     option_spec['type'] = type
+    option_spec['backend'] = directives.unchanged
     # option_spec['option'] = directives.describe_option_type
 
+    @profiled('read')  # most of the read phase is spent here, not in the event handlers
     def run(self):
         visual_node = visual(is_figure=False)
         set_source_info(self, visual_node)
@@ -64,13 +72,23 @@ class Visual(Figure):
         visual_node['docname'], visual_node['visualid'] = self.get_visual_id_info()
         self.options['name'] = visual_node['visualid']
         self.add_name(visual_node)
+        # Name of the asset backend that should handle this visual (see BackendRouter)
+        visual_node['backend'] = self.options.pop('backend', None)
+        # Figure/Image modify self.options, so keep a copy of the generation-relevant options now.
+        visual_node['options'] = AssetOptionsDict(self.options)
 
         self.emit('visual-node-inited', self, visual_node)
 
         caption = self.get_caption()
-        legend, visual_node['content_block'] = self.get_legend_and_visual_content()
+        legend, content_block = self.get_legend_and_visual_content()
         if caption is not None or legend is not None:
             visual_node['is_figure'] = True
+        if content_block:
+            # Hash each definition once. Later phases reuse node['content_hash'].
+            # The content itself goes to the content store, so it is not pickled with the doctree.
+            visual_node['content_hash'] = fingerprint(content_block, visual_node['options'], visual_node['type'],
+                                                      algorithm=self.app.config.visuals_fingerprint_algorithm)
+            self.app.visuals_content_store.put(visual_node['content_hash'], content_block)
 
         self.emit('visual-caption-and-legend-extracted', self, visual_node, caption, legend)
 
@@ -80,9 +98,6 @@ class Visual(Figure):
             # Replacing image node is not a good option, but we could manipulate uri.
             # for image_node in visual_node.traverse(condition=nodes.image):
             #     image_node['uri'] = something
-
-            # By default, assume it doesn't need a placeholder. Later processing can change this.
-            visual_node['placeholder'] = False
         elif visual_node['type'] == 'video':
             raise NotImplementedError('Visuals does not support videos yet')
         else:
@@ -126,21 +141,18 @@ class Visual(Figure):
         to support any directive, even if it is not available locally.
         That bit of rst might just get parsed in an external service
         """
-        content_offset = self.content_offset  # This is 0-based
-        """:type content_offset: int"""
         content_block = self.content
         """:type content_block: docutils.statemachine.StringList"""
         state = self.state
         """:type state: docutils.parsers.rst.states.Body"""
 
-        # we only use the first legend, don't overwrite. (limit=1)
-        directives_list = list_directives_in_block(content_offset, content_block, type_limit=['legend'],
-                                                             limit=1)
+        # we only use the first legend, don't overwrite.
+        found = legend_scanner.split(content_block)
 
-        if not directives_list:  # then there is no legend
+        if found is None:  # then there is no legend
             return None, content_block
 
-        (offset_in_block, directive_offset, directive_name, match) = directives_list[0]
+        offset_in_block, end, directive_name, match, visual_content = found
 
         legend_directive \
             = make_dummy_directive(directive_name, optional_arguments=0, final_argument_whitespace=False)
@@ -149,21 +161,12 @@ class Visual(Figure):
             = content_block.get_indented(start=offset_in_block, first_indent=match.end())
 
         arguments, options, legend_content, legend_content_offset \
-            = state.parse_directive_block(block, directive_offset, legend_directive, option_presets={})
+            = state.parse_directive_block(block, content_block.offset(offset_in_block), legend_directive,
+                                          option_presets={})
 
         legend = nodes.legend(legend_content)
         state.nested_parse(legend_content, legend_content_offset, legend)
 
-        last_offset = legend_content.offset(-1) - content_offset + 1
-        if blank_finish:
-            last_offset += 1
-
-        visual_content = content_block[:]
-        """copy of content_block that will have legend removed"""
-        visual_content.disconnect()  # disconnect from content_block
-        del visual_content[offset_in_block:last_offset]
-        # legend_block = content_block[offset_in_block:last_offset]
-
         return legend, visual_content
 
     def get_temp_image_uri(self):
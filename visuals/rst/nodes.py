@@ -13,13 +13,21 @@ from __future__ import absolute_import
 
 from docutils import nodes
 
-from visuals.asset.visual_asset_bridge import VisualAsset
-
 
 # noinspection PyPep8Naming
 class visual(nodes.General, nodes.Element):
     """ A Visual Node """
 
+    dirty = False
+    """True if the node changed since its doctree was pickled (see mark_dirty)"""
+
+    def mark_dirty(self):
+        """
+        Call this after changing the node outside of the read phase (eg in doctree-extra-processing),
+        so that its doctree gets re-pickled.
+        """
+        self.dirty = True
+
     def is_ref(self):
         """
         A reference to a visual is a visual without any content.
@@ -27,9 +35,10 @@ class visual(nodes.General, nodes.Element):
 
         If the visual has content, then it is a visual definition.
         The visual should be generated, somehow, from whatever is in the content.
+        Only the fingerprint of the content is kept on the node (see visuals.asset.content.ContentStore).
         :return bool:
         """
-        return not self['content_block']
+        return not self.get('content_hash')
 
 
 def visit_visual(self, node):
@@ -57,12 +66,13 @@ def visit_visual(self, node):
     :param nodes.NodeVisitor self:
     :param visual node:
     """
-    # TODO:2 insert oEmbed or downloaded asset or placeholder
-    sm = node.assets_statemachine
-    """:type sm: AssetsStateMachine"""
-
-    asset = VisualAsset(node)
-    oembed = sm.get_oembed(asset)
+    # Everything needed here was put on the node in doctree-resolved (in the main process),
+    # so this only reads the node: it is safe in parallel write workers.
+    # Downloaded assets are already on the image nodes (see use_downloaded_image in sphinx_ext).
+    oembed_html = node.get('oembed_html')
+    if oembed_html and self.builder.format == 'html':
+        self.body.append(oembed_html)
+        raise nodes.SkipNode
 
 
 def depart_visual(self, node):
@@ -15,25 +15,66 @@
 
 from __future__ import absolute_import
 
+import json
+import posixpath
 from os import path
 
 from docutils import nodes
 # from docutils.transforms import Transform
-from sphinx.util import copy_static_entry
-from sphinx.util.osutil import ensuredir
+from sphinx.errors import ConfigError
+from sphinx.util import logging
+from sphinx.util.osutil import relative_uri
+from sphinx.util.parallel import ParallelTasks, parallel_available, make_chunks
 
-from visuals import package_dir
 from visuals.asset import AssetsDict, AssetsMetadataDict
+from visuals.asset.cache import AssetCache, write_atomic
+from visuals.asset.content import ContentStore
+from visuals.asset.download import AssetDownloader
+from visuals.asset.fingerprint import is_supported as is_supported_fingerprint_algorithm
+from visuals.asset.oembed import OEmbedResolver
+from visuals.asset.placeholders import PlaceholderImages, placeholder_size
+from visuals.asset.scheduler import AvailabilityScheduler
 from visuals.asset.statemachine import AssetsStateMachine, AssetState
+from visuals.asset.statetable import AssetStateTable, numpy_available
 from visuals.asset.visual_asset_bridge import VisualAsset
-from visuals.rst import fix_types_on_visual_references
+from visuals.instrumentation import instrumented, recorder
+from visuals.profiling import profiled, profiler
+from visuals.rst import fix_types_on_visual_references, clear_dirty_visuals, index_visuals, visuals_in
 from visuals.rst.directives import Visual
 from visuals.rst.nodes import visual, visit_visual, depart_visual
-from visuals.utils.sphinx import sphinx_emit, pickle_doctree
+from visuals.utils.rst import findall
+from visuals.utils.sphinx import sphinx_emit, DoctreePickler, update_doctree_caches
 
 __version__ = '0.1'
 
+ENV_VERSION = 6
+"""Bump this when the structure of anything visuals pickles with env (env.assets*) changes."""
 
+logger = logging.getLogger(__name__)
+
+
+def configure_profiling(app):
+    """
+    Connected before event_builder_inited, so that builder-inited can be profiled too.
+
+    :param sphinx.application.Sphinx app: Sphinx Application
+    """
+    profiler.reset(app.config.visuals_profile, app.config.visuals_profile_tools)
+
+
+def write_profiles(app, exception):
+    """
+    Connected after event_build_finished, so that finished can be profiled too.
+
+    :param sphinx.application.Sphinx app: Sphinx Application
+    :param None|Exception exception:
+    """
+    if profiler.phases:
+        profiler.write(app.outdir)
+
+
+@instrumented
+@profiled('builder-inited')
 def event_builder_inited(app):
     """
     visual assets are externally sourced from some DAM (digital asset manager)
@@ -58,49 +99,187 @@ def event_builder_inited(app):
     :param sphinx.application.Sphinx app: Sphinx Application
     """
 
+    env = app.env
+    """:type env: sphinx.environment.BuildEnvironment"""
+
+    recorder.reset(enabled=app.config.visuals_instrumentation)
+
+    # Checked once here: otherwise Visual.run fails with a ValueError for every definition.
+    if not is_supported_fingerprint_algorithm(app.config.visuals_fingerprint_algorithm):
+        raise ConfigError('visuals_fingerprint_algorithm {0!r} is not a hashlib algorithm that fingerprints can use '
+                          '(eg md5, sha1, sha256)'.format(app.config.visuals_fingerprint_algorithm))
+
     # the primary list of all visual assets, extracted from the doctree.
-    assets = app.env.assets = AssetsDict()
-    assets_state = app.env.assets_state = AssetsMetadataDict()
+    # Keep the pickled assets so that docs that are not re-read keep their assets.
+    if getattr(env, 'visuals_env_version', None) != ENV_VERSION:
+        env.assets = AssetsDict()
+        env.assets_state = AssetsMetadataDict()
+        env.visuals_env_version = ENV_VERSION
+        # Anything pickled before this is unusable, so all docs must be read again (see event_env_get_outdated)
+        env.visuals_reread_all = True
+    # This may discard the pickled asset state as well (if visuals_state_store changed), so it goes first.
+    state_factory = make_state_factory(app, env)
+    assets = env.assets
+    assets_state = env.assets_state
     # NOTE: before using assets_state, run:
-    #       app.env.assets_state.update_or_init_from_assets(app.env.assets, AssetState)
+    #       app.env.assets_state.update_or_init_from_assets(app.env.assets, VisualAsset.state_factory)
 
     # Homegrown Dependency Injection :)
     VisualAsset.class_init(assets, assets_state)
+    VisualAsset.state_factory = state_factory
+    # Definition bodies are kept next to the doctrees, outside of them (see Visual.run)
+    app.visuals_content_store = ContentStore(path.join(app.doctreedir, 'visuals', 'content'))
+    VisualAsset.content_store = app.visuals_content_store
+    # The pickled state was discarded: content of definitions that it knew about may be left over.
+    app.visuals_content_store.may_have_garbage = getattr(env, 'visuals_reread_all', False)
     AssetsStateMachine.backends_config = app.config.visuals_asset_backends
 
     app.assets_statemachine = AssetsStateMachine()
+    app.assets_scheduler = AvailabilityScheduler(app.assets_statemachine, app.config.visuals_availability_polling)
+    cache_dir = app.config.visuals_cache_dir or path.join(app.doctreedir, 'visuals', 'cache')
+    if app.config.visuals_cache_max_bytes:
+        app.assets_statemachine.cache = AssetCache(cache_dir, app.config.visuals_cache_max_bytes)
+    if should_download_assets(app):
+        # Downloads are stored in the cache. Without a cache, keep them (uncapped) next to the doctrees,
+        # in a dir of their own.
+        store = app.assets_statemachine.cache or AssetCache(path.join(app.doctreedir, 'visuals', 'downloads'))
+        app.assets_statemachine.downloader = AssetDownloader(store, max_workers=app.config.visuals_download_workers)
+    oembed_config = app.config.visuals_oembed
+    if oembed_config.get('endpoint'):
+        # Not inside the cache dir: AssetCache.evict would count (and evict) the responses as cache entries.
+        app.assets_statemachine.oembed = OEmbedResolver(
+            oembed_config['endpoint'],
+            oembed_config.get('cache_dir') or path.join(app.doctreedir, 'visuals', 'oembed'),
+            default_ttl=oembed_config.get('ttl', 24 * 60 * 60),
+            timeout=oembed_config.get('timeout', 30),
+            max_workers=oembed_config.get('workers', 4))
 
     # the final uri or oembed block with info for builder
     app.builder.assets = {}
 
+    # Generated placeholders are kept next to the doctrees, and copied to outdir at finish.
+    app.builder.visuals_placeholders = PlaceholderImages(path.join(app.doctreedir, 'visuals', 'placeholders'))
+    # Downloads used by this build are copied to outdir at finish as well (see use_downloaded_image).
+    app.builder.visuals_downloader = app.assets_statemachine.downloader
+
     # TODO:2 It might be good to have a Dict that is not per instance, but per asset.
     app.builder.assets_instances = {}
 
 
-def event_env_purge_doc(app, docname):
+def should_download_assets(app):
     """
-    This triggers the assets merge in the environment
-    :param docname: see AssetsDict.purge_doc
+    visuals_download_assets can be True, False, or None (the default).
+    None means: download for builders that need local image files (eg latex for PDFs).
+
     :param sphinx.application.Sphinx app: Sphinx Application
+    :return bool:
     """
-    env = app.env
-    """:type env: sphinx.environment.BuildEnvironment"""
+    if app.config.visuals_download_assets is None:
+        return app.builder.format in ('latex', 'texinfo')
+    return bool(app.config.visuals_download_assets)
+
+
+def uses_state_table(app):
+    """
+    :param sphinx.application.Sphinx app: Sphinx Application
+    :return bool: Whether asset state is stored in an AssetStateTable (see make_state_factory)
+    """
+    return app.config.visuals_state_store == 'table' and numpy_available
+
+
+def make_state_factory(app, env):
+    """
+    Pick how new asset state entries are stored, based on the visuals_state_store config:
+        'objects': one AssetState object per asset instance (default)
+        'table':   rows in a columnar AssetStateTable (env.assets_state_table), which requires numpy
+
+    If the store differs from the one the pickled state was made with, that state (and table) is
+    discarded, and every doc is read again: entries of both kinds must not end up in one env.
+
+    :param sphinx.application.Sphinx app: Sphinx Application
+    :param sphinx.environment.BuildEnvironment env: Sphinx Environment
+    :return: a callable that returns a new state entry
+    """
+    if app.config.visuals_state_store == 'table' and not numpy_available:
+        logger.warning('visuals_state_store = "table" requires numpy; using "objects" instead')
+    store = 'table' if uses_state_table(app) else 'objects'
+    if getattr(env, 'visuals_state_store', 'objects') != store:
+        env.assets_state = AssetsMetadataDict()
+        env.visuals_reread_all = True
+    env.visuals_state_store = store
+
+    if store == 'table':
+        if getattr(env, 'assets_state_table', None) is None:
+            env.assets_state_table = AssetStateTable()
+        return env.assets_state_table.new_row
+    if hasattr(env, 'assets_state_table'):
+        del env.assets_state_table
+    return AssetState
+
+
+def state_adopter(app, env):
+    """
+    Rows of an AssetStateTable made in another process (parallel read or processing workers) point at
+    that process's copy of the table. When merging, they have to be moved into this process's table.
+
+    :param sphinx.application.Sphinx app: Sphinx Application
+    :param sphinx.environment.BuildEnvironment env: Sphinx Environment
+    :return: AssetStateTable.adopt of env.assets_state_table, or None if state is not stored in a table
+    """
+    return env.assets_state_table.adopt if uses_state_table(app) else None
+
+
+@instrumented
+@profiled('read')
+def event_env_get_outdated(app, env, added, changed, removed):
+    """
+    Re-read every doc if the pickled visuals state was discarded in event_builder_inited.
+
+    :param sphinx.application.Sphinx app: Sphinx Application
+    :param sphinx.environment.BuildEnvironment env: Sphinx Environment
+    :param set added: docnames that are new in this build
+    :param set changed: docnames that changed since the last build
+    :param set removed: docnames that were removed since the last build
+    :return list: additional docnames that need to be re-read
+    """
+    if getattr(env, 'visuals_reread_all', False):
+        env.visuals_reread_all = False
+        return list(env.found_docs)
+    return []
+
 
+@instrumented
+@profiled('read')
+def event_env_purge_doc(app, env, docname):
+    """
+    This triggers the assets merge in the environment
+    :param sphinx.application.Sphinx app: Sphinx Application
+    :param sphinx.environment.BuildEnvironment env: Sphinx Environment
+    :param docname: see AssetsDict.purge_doc
+    """
     env.assets.purge_doc(docname)
     env.assets_state.purge_doc(docname)
+    # Its definitions might be gone (or changed) once it is read again (see event_build_finished)
+    app.visuals_content_store.may_have_garbage = True
+    VisualAsset.forget_docs([docname])
+    app.assets_statemachine.router.forget_docs([docname])
 
 
-def event_visual_node_generated(app, visual_node):
+@instrumented
+def event_visual_node_generated(app, directive, visual_node):
     """
     Modify the visual_node, as required without shoving everything into visual itself.
 
     :param sphinx.application.Sphinx app: Sphinx Application
+    :param visuals.rst.directives.Visual directive: The directive that generated visual_node
     :param visual visual_node: The just generated visual node
     """
     # TODO: Maybe move the type-specific visual processing here? (eg image runs Figure/Image)
     pass
 
 
+@instrumented
+@profiled('read')
 def event_doctree_read(app, doctree):
     """
     Visuals processing at the "doctree-read" event
@@ -110,63 +289,141 @@ def event_doctree_read(app, doctree):
     :param sphinx.application.Sphinx app: Sphinx Application
     :param nodes.document doctree: The doctree of a particular docname in the project
     """
-    sm = app.assets_statemachine
-    """:type sm: AssetsStateMachine"""
-
-    definitions = []
-    for visual_node in doctree.traverse(visual):
-        """:type visual_node: visual"""
-
-        asset = VisualAsset(visual_node)
+    # Register the assets. Generation is requested in bulk after reading (see AvailabilityScheduler)
+    # In the same walk, record where the visual nodes are, so later phases don't walk the tree again.
+    index_visuals(doctree, register=VisualAsset.for_node)
 
-        if not asset.is_ref:
-            definitions.append(asset)
 
-    sm.request_asset_generation(definitions)
-
-
-def event_env_merge_info(app, docnames, other):
+@instrumented
+@profiled('read')
+def event_env_merge_info(app, env, docnames, other):
     """
     This triggers the assets merge in the environment
     :param sphinx.application.Sphinx app: Sphinx Application
+    :param sphinx.environment.BuildEnvironment env: The Sphinx Environment to merge into
     :param list docnames: Only include asset instances in these docnames
     :param sphinx.environment.BuildEnvironment other: The other Sphinx Environment to be merged
     """
-    app.env.assets.merge_other(docnames, other.assets)
-    app.env.assets_state.merge_other(docnames, other.assets_state)
+    env.assets.merge_other(docnames, other.assets)
+    env.assets_state.merge_other(docnames, other.assets_state, adopt=state_adopter(app, env))
+    VisualAsset.forget_docs(docnames)
 
 
+@instrumented
+@profiled('extra-processing')
 def event_env_updated(app, env):
     """
     This emits some additional sphinx events to allow additional processing
     after "Phase 1: Read", but before the env is pickled (which happens during
     "Phase 2: Consistency Checks").
 
+    Only outdated docs get doctree-extra-processing: docs that were read in this build,
+    and docs that reference an asset whose definition changed type in this build.
+    Unpickling every doctree in the project is too expensive to do on every build.
+
+    Then the AvailabilityScheduler requests and polls, at once, the assets of the processed docs
+    and the assets that were still pending after the previous build (env.assets_state.pending),
+    including those in docs that did not change. Afterwards, the pending index is updated for all of them.
+
     :param sphinx.application.Sphinx app: Sphinx Application
     :param sphinx.environment.BuildEnvironment env: Sphinx Environment
+    :return list: docnames that have to be written: the processed docs, and docs with an asset whose state changed
     """
-    sphinx_emit(app, 'before-doctree-extra-processing', app, env)
+    sphinx_emit(app, 'before-doctree-extra-processing', env)
+
+    docnames = env.assets.pop_outdated_docs(env.all_docs)
 
-    # TODO:PARALLEL add parallel processing with ParallelTasks or see sphinx.builders.linkcheck
-    # from sphinx.util.parallel import ParallelTasks, parallel_available
-    # if parallel_available and app.parallel > 1:  # based on sphinx.environment #598
-    #   nproc = app.parallel
-    #
-    # env.asset_tasks = ParallelTasks(nproc)
+    if parallel_available and app.parallel > 1 and len(docnames) > 1:  # based on sphinx.environment
+        process_doctrees_parallel(app, env, docnames)
+    else:
+        process_doctrees(app, env, docnames)
 
-    for docname in env.all_docs:
-        doctree = env.get_doctree(docname)
-        # Return True if the doctree needs to be re-pickled.
-        re_pickle = sphinx_emit(app, 'doctree-extra-processing', app, env, docname, doctree)
-        if True in re_pickle:
-            pickle_doctree(env, docname, doctree)
+    scheduler = app.assets_scheduler
+    collected = [VisualAsset.for_location(asset_id, location)
+                 for asset_id, location in env.assets.iter_instances(docnames)]
+    collected.extend(VisualAsset.for_location(asset_id, location)
+                     for asset_id, location in list(env.assets_state.iter_pending()))
+    scheduler.collect(collected)
+    changed = scheduler.run()
+    for asset in collected:
+        env.assets_state.set_pending((asset.id, asset.location), scheduler.is_pending(asset))
 
-    # merge parallel:
-    # env.asset_tasks.join()
+    sphinx_emit(app, 'before-pickle-env', env)
+    return sorted(set(docnames).union(asset.location.docname for asset in changed))
 
-    sphinx_emit(app, 'before-pickle-env', app, env)
 
+def process_doctrees(app, env, docnames):
+    """
+    Emit doctree-extra-processing for each of the docnames, re-pickling doctrees as needed.
 
+    :param sphinx.application.Sphinx app: Sphinx Application
+    :param sphinx.environment.BuildEnvironment env: Sphinx Environment
+    :param list docnames: The docs to process
+    :return list: The docnames whose doctrees were re-pickled
+    """
+    re_pickled = []
+    # Doctrees are written in the background while the next doc is processed.
+    with DoctreePickler(env) as pickler:
+        for docname in docnames:
+            with recorder.timer('doctree.unpickle'):
+                doctree = env.get_doctree(docname)
+            # Listeners mark the visual nodes they change dirty (or return True), so that only
+            # doctrees that changed are re-pickled.
+            re_pickle = sphinx_emit(app, 'doctree-extra-processing', env, docname, doctree)
+            if clear_dirty_visuals(doctree) or True in re_pickle:
+                pickler.submit(docname, doctree)
+                re_pickled.append(docname)
+    return re_pickled
+
+
+def process_doctrees_parallel(app, env, docnames):
+    """
+    Fan process_doctrees out over app.parallel worker processes (see sphinx.util.parallel).
+
+    Each worker re-pickles its own doctrees and sends back the asset state of its docs, and which
+    doctrees it re-pickled. The workers finish in any order, so their state is merged in chunk order
+    once all are done. Each chunk only changes the asset state of its own docs, so the result matches
+    a serial run. The workers don't talk to the backends: the pending assets of their docs are in the
+    merged state, and event_env_updated requests and polls them once, in this process.
+
+    :param sphinx.application.Sphinx app: Sphinx Application
+    :param sphinx.environment.BuildEnvironment env: Sphinx Environment
+    :param list docnames: The docs to process
+    :return list: The docnames whose doctrees were re-pickled
+    """
+    chunks = make_chunks(docnames, app.parallel)
+    results = {}
+
+    def process_chunk(args):
+        index, chunk = args
+        # The worker starts with a copy of the main process's timers: only send back its own.
+        recorder.reset(recorder.enabled)
+        re_pickled = process_doctrees(app, env, chunk)
+        return env.assets_state.subset(chunk), re_pickled, recorder.snapshot()
+
+    def collect_chunk(args, result):
+        index, chunk = args
+        results[index] = result
+
+    tasks = ParallelTasks(app.parallel)
+    for index, chunk in enumerate(chunks):
+        tasks.add_task(process_chunk, (index, chunk), collect_chunk)
+    tasks.join()
+
+    all_re_pickled = []
+    for index, chunk in enumerate(chunks):
+        assets_state, re_pickled, instrumentation = results[index]
+        env.assets_state.merge_other(chunk, assets_state, adopt=state_adopter(app, env))
+        recorder.merge(instrumentation)
+        VisualAsset.forget_docs(chunk)
+        # The doctrees that this process has in memory are older than the ones the worker pickled.
+        for docname in re_pickled:
+            update_doctree_caches(env, docname)
+        all_re_pickled.extend(re_pickled)
+    return all_re_pickled
+
+
+@instrumented
 def event_before_doctree_extra_processing(app, env):
     """
     Adds the asset state tracking dicts
@@ -178,9 +435,10 @@ def event_before_doctree_extra_processing(app, env):
     assets_state = env.assets_state
     """:type assets_state: AssetsMetadataDict"""
 
-    assets_state.update_or_init_from_assets(assets, AssetState)
+    assets_state.update_or_init_from_assets(assets, VisualAsset.state_factory)
 
 
+@instrumented
 def event_doctree_extra_processing(app, env, docname, doctree):
     """
     Secondary pass through all doctrees, after Read phase, before env pickling.
@@ -195,24 +453,20 @@ def event_doctree_extra_processing(app, env, docname, doctree):
     :param nodes.document doctree: The doctree of a particular docname in the project
     :return boolean: True if doctree needs to be re-pickled.
     """
-    sm = app.assets_statemachine
-    """:type sm: AssetsStateMachine"""
-
     fix_types_on_visual_references(doctree, env.assets)
 
     # TODO: Perhaps, if is_ref and definition is available, then mark dependency to def file in env.dependencies
     # mark_dependencies_for_visual_references(doctree, env)
 
-    assets = []
-    for visual_node in doctree.traverse(visual):
+    # Share the VisualAssets (with their nodes) with the rest of the build.
+    # They are requested and polled once for the whole build, after processing (see event_env_updated).
+    for visual_node in visuals_in(doctree):
         """:type visual_node: visual"""
 
-        asset = VisualAsset(visual_node)
-        assets.append(asset)
-
-    sm.ensure_available(assets)
+        VisualAsset.for_node(visual_node)
 
 
+@instrumented
 def event_before_pickle_env(app, env):
     """
 
@@ -223,11 +477,16 @@ def event_before_pickle_env(app, env):
     pass
 
 
+@instrumented
+@profiled('resolved')
 def event_doctree_resolved(app, doctree, docname):
     """
-    This should recheck for any visuals that need to be rendered
-    For those, it sends the full visual content (if needed)
-    and marks the visual as a placeholder
+    This puts everything the writers need on the visual nodes, so visit_visual only reads the node.
+
+    Sphinx emits doctree-resolved in the main process, also when writing in parallel, and only
+    the writing happens in worker processes. Asset state is settled by the AvailabilityScheduler
+    before writing starts, so this only reads it: no asset state changes, and no network calls,
+    happen while writing, and there is nothing for the workers to send back.
 
     :param sphinx.application.Sphinx app: Sphinx Application
     :param nodes.document doctree: The doctree of all docs in the project
@@ -236,27 +495,81 @@ def event_doctree_resolved(app, doctree, docname):
     sm = app.assets_statemachine
     """:type sm: AssetsStateMachine"""
 
-    assets = []
-    for visual_node in doctree.traverse(visual):
+    needs_placeholder = []
+    for visual_node in visuals_in(doctree):
         """:type visual_node: visual"""
 
-        asset = VisualAsset(visual_node)
-        assets.append(asset)
+        asset = VisualAsset.for_node(visual_node)
+        if not asset.state.available or asset.state.placeholder:
+            needs_placeholder.append(asset)
+            continue
+
+        if sm.downloader is not None and asset.state.downloaded and use_downloaded_image(app, docname, asset):
+            continue
+
+        # Resolved before writing (see AssetsStateMachine.retrieve_oembed_or_download), so this is a lookup.
+        oembed = sm.get_oembed(asset)
+        if oembed is None:
+            continue
+        if oembed.get('type') == 'photo' and oembed.get('url'):
+            for image_node in findall(visual_node, nodes.image):
+                image_node['uri'] = oembed['url']
+        elif oembed.get('html'):
+            visual_node['oembed_html'] = oembed['html']
+
+    use_placeholder_images(app, docname, needs_placeholder)
 
-        # Make the sm available in the visitors
-        visual_node.assets_statemachine = sm
 
-    sm.retrieve_oembed_or_download(assets)
-    sm.mark_for_placeholder_on_unavailable(assets)
-    # for placeholders:
-    sm.request_asset_generation(assets)
-    sm.check_availability(assets)
+def use_placeholder_images(app, docname, assets):
+    """
+    Point the images of assets at a placeholder of the same size as the image (see placeholder_size).
+
+    :param sphinx.application.Sphinx app: Sphinx Application
+    :param str docname: the doc that is being resolved
+    :param list assets: list of VisualAsset that need a placeholder
+    """
+    builder = app.builder
+    if not builder.supported_image_types or not assets:
+        return
+    placeholders = builder.visuals_placeholders
+    """:type placeholders: PlaceholderImages"""
+    base_uri = builder.get_target_uri(docname)
+    for asset in assets:
+        for image_node in findall(asset.node, nodes.image):
+            size = placeholder_size(image_node.get('width'), image_node.get('height'), image_node.get('scale'))
+            filename = placeholders.use(size)
+            # Writers use the uri as alt text if there is none: use the directive's alt, or the visual id.
+            image_node.setdefault('alt', asset.id)
+            image_node['uri'] = relative_uri(base_uri, posixpath.join(builder.imagedir, filename))
+
+
+def use_downloaded_image(app, docname, asset):
+    """
+    Point the images of asset at its download (see AssetDownloader.use), for builders that need
+    local image files (see should_download_assets), such as latex and texinfo.
+
+    :param sphinx.application.Sphinx app: Sphinx Application
+    :param str docname: the doc that is being resolved
+    :param VisualAsset asset: an asset that is downloaded
+    :return bool: Whether the images use the download
+    """
+    builder = app.builder
+    if not builder.supported_image_types:
+        return False
+    filename = app.assets_statemachine.downloader.use(asset)
+    if filename is None:
+        return False
+    base_uri = builder.get_target_uri(docname)
+    for image_node in findall(asset.node, nodes.image):
+        image_node.setdefault('alt', asset.id)
+        image_node['uri'] = relative_uri(base_uri, posixpath.join(builder.imagedir, filename))
+    return True
 
 
 def monkey_patch_builder_finish(app):
     """
     Though html-collect-pages is an event at about the right point
-    to copy the placeholder image, it is not called for latex or texinfo.
+    to copy the placeholder and downloaded images, it is not called for latex or texinfo.
 
     So, monkey patch it!
 
@@ -271,32 +584,38 @@ def monkey_patch_builder_finish(app):
         patch_target = builder.__class__
         original_finish = patch_target.finish
 
-        def copy_visual_placeholder(self):
+        def copy_visual_images(self):
             """
             based on builders.html.copy_image_files
+            Only the placeholders and downloads used in this build are copied, and only if missing or stale.
 
             :param sphinx.builders.Builder self:
             """
 
             outdir = path.join(self.outdir, self.imagedir)
-            ensuredir(outdir)
-            source = path.join(package_dir, 'theme', 'default', 'static', 'FFFFFF-0.png')
             try:
-                copy_static_entry(source, outdir, self)
+                self.visuals_placeholders.copy_to(outdir)
             except Exception as err:
-                self.warn('cannot copy image file %r: %s' %
-                          (source, err))
+                logger.warning('cannot copy placeholder images to %r: %s', outdir, err)
+            if self.visuals_downloader is None:
+                return
+            try:
+                self.visuals_downloader.copy_to(outdir)
+            except Exception as err:
+                logger.warning('cannot copy downloaded images to %r: %s', outdir, err)
 
         def finish(self):
             """
             :param sphinx.builders.Builder self:
             """
             original_finish(self)
-            self.finish_tasks.add_task(copy_visual_placeholder)
+            self.finish_tasks.add_task(copy_visual_images, self)
 
         patch_target.finish = finish
 
 
+@instrumented
+@profiled('finished')
 def event_build_finished(app, exception):
     """
     Do any necessary cleanup, such as cleaning up downloads
@@ -308,7 +627,32 @@ def event_build_finished(app, exception):
     :return:
     """
     # TODO: Cleanup and/or handle exceptions
-    pass
+    content_store = app.visuals_content_store
+    if exception is None and content_store.may_have_garbage:
+        content_store.collect_garbage(app.env.assets.content_hashes())
+    cache = app.assets_statemachine.cache
+    if cache is not None:
+        cache.evict()
+    if recorder.enabled:
+        write_instrumentation_report(app, exception)
+
+
+def write_instrumentation_report(app, exception):
+    """
+    Write the timers and counters of this build to outdir/visuals-instrumentation.json
+
+    :param sphinx.application.Sphinx app: Sphinx Application
+    :param None|Exception exception:
+    """
+    report = recorder.report(
+        builder=app.builder.name,
+        parallel=app.parallel,
+        failed=exception is not None,
+        assets=len(app.env.assets),
+        placeholders=len(app.builder.visuals_placeholders.used),
+    )
+    write_atomic(path.join(app.outdir, 'visuals-instrumentation.json'),
+                 json.dumps(report, indent=2, sort_keys=True).encode('utf-8'))
 
 
 def setup(app):
@@ -317,6 +661,7 @@ def setup(app):
     """
     # Phase 0: Initialization
     #   sphinx init
+    app.connect('builder-inited', configure_profiling)
     app.connect('builder-inited', event_builder_inited)
     app.add_config_value('temp_image_uri', 'cpip://rfc/1149', '')
     default_asset_backends_config = {
@@ -325,6 +670,28 @@ def setup(app):
         'dummy': {'enabled': True}
     }
     app.add_config_value('visuals_asset_backends', default_asset_backends_config, 'env')
+    # Batched availability polling, see AvailabilityScheduler.default_config
+    app.add_config_value('visuals_availability_polling', {}, '')
+    # Download available assets to local files (None: only for builders that need local images)
+    app.add_config_value('visuals_download_assets', None, '')
+    # Maximum number of concurrent downloads
+    app.add_config_value('visuals_download_workers', 4, '')
+    # How asset state is stored: 'objects' or 'table' (columnar, requires numpy)
+    app.add_config_value('visuals_state_store', 'objects', 'env')
+    # hashlib algorithm for definition fingerprints (see visuals.asset.fingerprint)
+    app.add_config_value('visuals_fingerprint_algorithm', 'md5', 'env')
+    # Where resolved assets are cached between builds ('' means next to the doctrees, in visuals/cache).
+    # Set it to share the cache between checkouts.
+    app.add_config_value('visuals_cache_dir', '', '')
+    # Size budget for that cache in bytes (0 disables the cache)
+    app.add_config_value('visuals_cache_max_bytes', 1024 ** 3, '')
+    # Profile these phases (see visuals.profiling.PHASES) with cProfile and/or tracemalloc; results go to outdir
+    app.add_config_value('visuals_profile', [], '')
+    app.add_config_value('visuals_profile_tools', ['cprofile', 'tracemalloc'], '')
+    # Record timers and counters, and write them to outdir/visuals-instrumentation.json (see visuals.instrumentation)
+    app.add_config_value('visuals_instrumentation', False, '')
+    # oEmbed provider for backends with use_oembed: {'endpoint': uri, 'ttl': seconds, 'timeout', 'workers', 'cache_dir'}
+    app.add_config_value('visuals_oembed', {}, '')
 
     # Phase 1: Reading
     #   docutils parsing (and writer visitors for Phase 4)
@@ -346,7 +713,7 @@ def setup(app):
 
     # Phase 1: Reading
     #   Sphinx start reading
-    # app.connect('env-get-outdated', event_env_get_outdated)
+    app.connect('env-get-outdated', event_env_get_outdated)
     app.connect('env-purge-doc', event_env_purge_doc)
     #   docutils transforms (per docname)
     # app.add_transform(Transform)
@@ -381,6 +748,7 @@ def setup(app):
 
     #   cleanup / handle exceptions
     app.connect('build-finished', event_build_finished)
+    app.connect('build-finished', write_profiles)
 
-    # TODO:PARALLEL Make sure that everything really is parallel safe (parallel is important!)
-    return {'version': __version__, 'parallel_read_safe': True}
+    # Writers only read what event_doctree_resolved put on the nodes (see visit_visual)
+    return {'version': __version__, 'parallel_read_safe': True, 'parallel_write_safe': True}
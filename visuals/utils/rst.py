@@ -17,6 +17,19 @@ from docutils.parsers.rst.states import Inliner
 from docutils.statemachine import ViewList
 
 
+def findall(node, condition):
+    """
+    node.findall(condition) on docutils >= 0.18.1, where traverse is deprecated; node.traverse before that.
+
+    :param nodes.Node node: The node to search (including node itself)
+    :param condition: A node class, or a function that takes a node and returns a bool
+    :return: iterator over the matching nodes, in document order
+    """
+    if hasattr(node, 'findall'):
+        return node.findall(condition)
+    return iter(node.traverse(condition))
+
+
 # noinspection PyUnresolvedReferences
 def set_type_info(directive, node):
     """
@@ -29,8 +42,6 @@ def set_type_info(directive, node):
         # TODO: throw an error or at least a warning
         pass
 
-    node['allowed_types'] = directive.allowed_types
-
     node_type = directive.options.get('type', directive.default_type)
 
     if node_type not in directive.allowed_types:
@@ -85,9 +96,10 @@ def make_dummy_directive(directive_name,
                          final_argument_whitespace=True,
                          **kwargs):
     """
-    Creates a dummy_directive that does not have a usable run()
+    Creates a dummy_directive class that does not have a usable run()
     This makes it possible to do some manual processing of directives with
     self.state.parse_directive_* (where self.state = docutils.parsers.rst.states.Body)
+    which, like docutils itself, only uses the attributes of the directive class.
 
     Defaults differ from Directive defaults because we don't know what content will exist
     in the dummy_directive. So, we assume has_content, no options, and one long argument.
@@ -98,27 +110,105 @@ def make_dummy_directive(directive_name,
     :param dict option_spec:
     :param int optional_arguments:
     :param bool final_argument_whitespace:
+    :return type: a subclass of Directive
     """
-    dummy_directive = Directive(directive_name, None, None, None, None, None, None, None, None)
-    dummy_directive.has_content = has_content
-    dummy_directive.option_spec = option_spec
-    dummy_directive.optional_arguments = optional_arguments
-    dummy_directive.final_argument_whitespace = final_argument_whitespace
-    for name, value in kwargs:
-        dummy_directive.__setattr__(name, value)
+    attributes = {
+        'has_content': has_content,
+        'option_spec': option_spec,
+        'optional_arguments': optional_arguments,
+        'final_argument_whitespace': final_argument_whitespace,
+    }
+    attributes.update(kwargs)
+    return type('dummy_{0}_directive'.format(directive_name), (Directive,), attributes)
 
-    return dummy_directive
+
+directive_pattern = make_directive_pattern()
+"""Compiled once, at import"""
+
+
+class DirectiveScanner(object):
+    """
+    Finds directives in a block of content (eg a visual's content), without parsing them.
+
+    Only lines that start with '..' are matched against the (precompiled) directive pattern,
+    and split() finds a directive and the end of its block in the same pass, so the cost
+    only depends on where the directive is, not on how large the rest of the content is.
+    """
+
+    def __init__(self, names=None):
+        """
+        :param list names: only find directives with these names (all directives if None)
+        """
+        self.names = frozenset(names) if names is not None else None
+
+    def scan(self, content_block, limit=None):
+        """
+        :param docutils.statemachine.StringList content_block: A list of lines in the content block
+        :param int limit: stop after this many matches
+        :return: list[(int, str, re.__Match)] of (index in content_block, directive name, match)
+        """
+        found = []
+        for index, line in enumerate(content_block.data):
+            if not line.startswith('..'):
+                continue
+            match = directive_pattern.match(line)
+            if match is None or (self.names is not None and match.group(1) not in self.names):
+                continue
+            found.append((index, match.group(1), match))
+            if limit is not None and len(found) == limit:
+                break
+        return found
+
+    @staticmethod
+    def block_end(content_block, start):
+        """
+        :param docutils.statemachine.StringList content_block: A list of lines in the content block
+        :param int start: index of the directive's first line
+        :return int: index of the first line after the directive's (indented) block
+        """
+        data = content_block.data
+        end = start + 1
+        while end < len(data) and (not data[end].strip() or data[end][0] in ' \t'):
+            end += 1
+        return end
+
+    def split(self, content_block):
+        """
+        Separate the first matching directive from the rest of the content.
+
+        If the directive is at the start or at the end of content_block, the rest of the content is
+        one slice of content_block. Otherwise, it is the slices before and after the directive joined
+        into a new StringList. Either way, the lines are copied once (not the whole block followed by
+        deletes), and the rest is disconnected from content_block so it pickles on its own.
+
+        :param docutils.statemachine.StringList content_block: A list of lines in the content block
+        :return: None if there is no matching directive,
+                 else (start, end, directive name, match, the rest of the content)
+        """
+        found = self.scan(content_block, limit=1)
+        if not found:
+            return None
+        start, directive_name, match = found[0]
+        end = self.block_end(content_block, start)
+        if start == 0 or end == len(content_block):
+            rest = content_block[end:] if start == 0 else content_block[:start]
+            rest.disconnect()
+        else:
+            rest = content_block[:start] + content_block[end:]
+        return start, end, directive_name, match, rest
 
 
 def list_directives_in_block(content_offset, content_block, type_limit=None, limit=None):
     """
     Find all the directives in the given block of content, returning a list of where they start.
+    This is kept for existing callers; it is a thin wrapper over DirectiveScanner.scan.
 
     :param int content_offset: Initial offset (0-based lineno) in source (typically self.content_offset)
     :param docutils.statemachine.StringList content_block: A list of lines in the content block
     :param list type_limit: a list of allowed directive types/names
     :param int limit: stop processing directives after this many matches
-    :return: list[(int, int, str, re.__Match)]
+    :return: list[(int, int, str, re.__Match)] of
+             (line offset - content_offset, 0-based lineno in source, directive name, match)
     """
 
     if type_limit is not None:
@@ -126,23 +216,9 @@ def list_directives_in_block(content_offset, content_block, type_limit=None, lim
     if limit is not None and limit < 1:
         limit = None
 
-    directive_pattern = make_directive_pattern()
+    scanner = DirectiveScanner(type_limit or None)
     directives_in_block = []
-
-    for source, line_offset, line in content_block.xitems():
-        offset_in_block = line_offset - content_offset
-        directive_first_line_match = directive_pattern.match(line)
-        if directive_first_line_match:
-            directive_name = directive_first_line_match.group(1)
-
-            if type_limit and directive_name not in type_limit:
-                continue
-
-            directives_in_block.append(
-                (offset_in_block, line_offset, directive_name, directive_first_line_match)
-            )
-
-        if limit is not None and len(directives_in_block) == limit:
-            break
-
+    for index, directive_name, match in scanner.scan(content_block, limit):
+        line_offset = content_block.offset(index)
+        directives_in_block.append((line_offset - content_offset, line_offset, directive_name, match))
     return directives_in_block
@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 """
-    visuals.sphinx_ext
-    ~~~~~~~~~~~~~~~~~~
+    visuals.utils.sphinx
+    ~~~~~~~~~~~~~~~~~~~~
 
     This contains sphinx-specific utility functions
 
@@ -10,27 +10,131 @@
 """
 
 import os
+import pickle
+import queue
+import tempfile
+import threading
 from os import path
-# noinspection PyUnresolvedReferences,PyPep8Naming
-from six.moves import cPickle as pickle
+
+from visuals.instrumentation import recorder
+
+
+def detach_doctree(doctree):
+    """
+    Drop what must not be pickled with a doctree (copied from the end of env.read_doc())
+    :param docutils.nodes.document doctree: The doctree
+    """
+    doctree.reporter = None
+    doctree.transformer = None
+    doctree.settings.warning_stream = None
+    doctree.settings.env = None
+    doctree.settings.record_dependencies = None
 
 
 def pickle_doctree(env, docname, doctree):
     """
-    save the parsed doctree (copied from the end of env.read_doc()
+    save the parsed doctree (like the end of env.read_doc())
+    It is written to a temp file, then renamed, so a crash never leaves a truncated doctree.
     :param sphinx.environment.BuildEnvironment env: Sphinx Environment
     :param string docname: The docname
     :param docutils.nodes.document doctree: The docname's doctree
     """
-    doctree_filename = env.doc2path(docname, env.doctreedir, '.doctree')
+    doctree_filename = path.join(env.doctreedir, docname + '.doctree')
     dirname = path.dirname(doctree_filename)
     if not path.isdir(dirname):
-        os.makedirs(dirname)
-    f = open(doctree_filename, 'wb')
+        os.makedirs(dirname, exist_ok=True)
+    detach_doctree(doctree)
+    fd, tmp_filename = tempfile.mkstemp(dir=dirname, prefix='.tmp-', suffix='.doctree')
     try:
-        pickle.dump(doctree, f, pickle.HIGHEST_PROTOCOL)
-    finally:
-        f.close()
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(doctree, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_filename, doctree_filename)
+    except BaseException:
+        if path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        raise
+    update_doctree_caches(env, docname, doctree)
+
+
+def update_doctree_caches(env, docname, doctree=None):
+    """
+    Newer Sphinx versions cache doctrees in env, and use the cache instead of the pickle:
+        env._pickled_doctree_cache    the pickled bytes (used by env.get_doctree)
+        env._write_doc_doctree_cache  the doctrees read in this process (used first when writing)
+    Drop docname from the pickled cache, and put doctree in the write cache (if docname is in it),
+    so the re-pickled doctree is what gets written. Without doctree, docname is only dropped.
+
+    :param sphinx.environment.BuildEnvironment env: Sphinx Environment
+    :param string docname: The docname
+    :param docutils.nodes.document doctree: The docname's doctree, as pickled
+    """
+    getattr(env, '_pickled_doctree_cache', {}).pop(docname, None)
+    write_cache = getattr(env, '_write_doc_doctree_cache', {})
+    if doctree is None:
+        write_cache.pop(docname, None)
+    elif docname in write_cache:
+        write_cache[docname] = doctree
+
+
+class DoctreePickler(object):
+    """
+    Re-pickles doctrees (with pickle_doctree) in a background thread, so that processing
+    the next doc overlaps with writing the previous one.
+
+    At most max_pending doctrees wait to be written; submit() blocks when that many are queued,
+    which bounds the memory held by doctrees that were already processed.
+
+    Usage:
+        with DoctreePickler(env) as pickler:
+            pickler.submit(docname, doctree)  # doctree must not be modified after this
+        # Every doctree is written here, or the first error is raised.
+    """
+
+    def __init__(self, env, max_pending=2):
+        """
+        :param sphinx.environment.BuildEnvironment env: Sphinx Environment
+        :param int max_pending: Maximum number of doctrees queued for writing
+        """
+        self.env = env
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.errors = []
+        self.written = []
+        self._thread = None
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._run, name='visuals-doctree-pickler', daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.queue.put(None)
+        self._thread.join()
+        if exc_type is None and self.errors:
+            raise self.errors[0]
+
+    def submit(self, docname, doctree):
+        """
+        :param string docname: The docname
+        :param docutils.nodes.document doctree: The docname's doctree (do not modify it after this)
+        """
+        if self.errors:
+            raise self.errors[0]
+        self.queue.put((docname, doctree))
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            docname, doctree = item
+            if self.errors:
+                continue
+            try:
+                with recorder.timer('doctree.re_pickle'):
+                    pickle_doctree(self.env, docname, doctree)
+                self.written.append(docname)
+            except Exception as err:
+                self.errors.append(err)
 
 
 def sphinx_emit(app, event, *args):
@@ -40,8 +144,9 @@ def sphinx_emit(app, event, *args):
     :param sphinx.application.Sphinx app: Sphinx Application
     :param string event: represents an event registered with Sphinx
     :param args:
-    :return:
+    :return list: The return values of the listeners
     """
     # app is only available when app.update() is running
     if app is not None:
-        app.emit(event, *args)
\ No newline at end of file
+        return app.emit(event, *args)
+    return []
\ No newline at end of file